@@ -0,0 +1,120 @@
+"""
+Typed Parquet / Arrow output
+
+The CSV output keeps the decoder's strings, including NOAA's '*' for values that were not
+reported.  ArrowWeatherResponses writes the same rows as typed columns instead: measurements
+as numbers, HR_TIME as a UTC timestamp, code fields (sky cover, cloud types, present and past
+weather) as dictionary-encoded strings, and nulls wherever the CSV would have '*'.
+
+Rows are buffered and written out one row group (Parquet) or record batch (Arrow IPC file) at
+a time, so a large batch never has to be held in memory as a whole.  Code columns use a fixed
+dictionary per field, so every batch shares it.
+
+Needs pyarrow.
+"""
+
+from stats import STATS, timer
+from obsstore import KINDS, convert
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+FORMATS = ['parquet', 'arrow']
+ROW_GROUP_SIZE = 64 * 1024
+
+DIGITS = [str(i) for i in range(10)]
+CODES = ['%02d' % i for i in range(100)]
+
+def column_types():
+    """ fld -> (kind, arrow type), or ('code', [allowed values]) for dictionary-encoded fields """
+    arrow_types = {'int': pa.int16(), 'float': pa.float64(), 'str': pa.string(), 'time': pa.timestamp('s')}
+    codes = {'SKC': ['CLR', 'SCT', 'BKN', 'OVC', 'OBS', 'POB'] + CODES}
+    for fld in ['L', 'M', 'H', 'W']:
+        codes[fld] = DIGITS
+    types = {}
+    for fld, kind in KINDS.items():
+        types[fld] = (kind, codes.get(fld, CODES)) if kind == 'code' else (kind, arrow_types[kind])
+    return types
+
+def column_type(types, fld):
+    """ (kind, type) of a column, including rolled-up ones: DATE, FLD_MODE like FLD, FLD_N, FLD_MEAN, ... """
+    if fld in types:
+        return types[fld]
+    if fld == 'DATE':
+        return ('str', pa.string())
+    base, reducer = fld.rsplit('_', 1)
+    if reducer == 'MODE':
+        return types[base]
+    if reducer == 'N':
+        return ('int', pa.int32())
+    return ('float', pa.float64())
+
+class ArrowWeatherResponses(object):
+    """
+    Same interface as StreamingWeatherResponses: write_response() for each request's rows, in
+    any order, then close().  'fld_names' fixes the columns up front
+    """
+    def __init__(self, fld_names, dest, fmt='parquet', row_group_size=ROW_GROUP_SIZE):
+        if pa is None:
+            raise ImportError("pyarrow is required for --format %s" % fmt)
+        if fmt not in FORMATS:
+            raise ValueError("unknown output format: %s" % fmt)
+        types = column_types()
+        self.fld_names = fld_names
+        self.kinds = [column_type(types, fld)[0] for fld in fld_names]
+        self.dictionaries = {}
+        fields = []
+        for fld in fld_names:
+            kind, typ = column_type(types, fld)
+            if kind == 'code':
+                self.dictionaries[fld] = (pa.array(typ, type=pa.string()), {code: i for i, code in enumerate(typ)})
+                typ = pa.dictionary(pa.int16(), pa.string())
+            fields.append(pa.field(fld, typ))
+        self.schema = pa.schema(fields)
+        self.row_group_size = row_group_size
+        self.rows = [[] for fld in fld_names]
+        if fmt == 'parquet':
+            self.writer = pq.ParquetWriter(dest, self.schema)
+        else:
+            self.writer = pa.RecordBatchFileWriter(dest, self.schema)
+        self.fmt = fmt
+
+    def write_response(self, resp):
+        with timer('write'):
+            for obs in resp:
+                for col, fld, kind in zip(self.rows, self.fld_names, self.kinds):
+                    col.append(convert(kind, obs.get(fld)))
+                if len(self.rows[0]) >= self.row_group_size:
+                    self.flush()
+        STATS.count('rows_written', len(resp))
+
+    def write(self, responses):
+        for resp in responses:
+            self.write_response(resp)
+        self.close()
+
+    def column(self, field, kind, vals):
+        if kind == 'code':
+            dictionary, codes = self.dictionaries[field.name]
+            indices = pa.array([codes.get(val) for val in vals], type=pa.int16())
+            return pa.DictionaryArray.from_arrays(indices, dictionary)
+        return pa.array(vals, type=field.type)
+
+    def flush(self):
+        if not self.rows[0]:
+            return
+        arrays = [self.column(field, kind, vals) for field, kind, vals in zip(self.schema, self.kinds, self.rows)]
+        batch = pa.RecordBatch.from_arrays(arrays, self.fld_names)
+        if self.fmt == 'parquet':
+            self.writer.write_table(pa.Table.from_batches([batch], self.schema))
+        else:
+            self.writer.write_batch(batch)
+        self.rows = [[] for fld in self.fld_names]
+
+    def close(self):
+        with timer('write'):
+            self.flush()
+            self.writer.close()
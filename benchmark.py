@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks on synthetic NOAA data
+
+Generates a synthetic station catalog (ISH-HISTORY.TXT / stn_flds.txt format) and raw ISD
+station-year .gz files with realistic hourly records, serves them from a local stand-in mirror
+(http:// on a loopback port, or file://), and times each stage of a run:
+
+* catalog: parsing the text catalog, compiling and loading the binary one, building the index
+* resolve: nearest-station lookups, and building requests for many locations, one by one or in one geo-join pass
+* decode: download + decode of every station-year, and decode from the local cache
+* filter: fetching a few days out of a station-year, as run_fetch() does for a request
+* format: writing rows with AllWeatherResponses
+* batch_N: a whole --infile batch of N locations (request building, fetch plan, output)
+
+Results are written as JSON: one entry per stage with the best wall time over --repeat runs,
+the number of items processed and the throughput, so runs can be compared across versions.
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import threading
+from multiprocessing import Pool
+import datetime as dt
+import SimpleHTTPServer
+import SocketServer
+
+import isd
+import noaahist
+from isd import fetch_station_year, station_year_path
+from noaahist import (FetchPlan, AllWeatherResponses, run_fetch, load_stations, stn_covg,
+                      req_from_infile_line, batch_requests, haversine)
+from stncache import StationYearCache, StationListings
+from stnindex import StationIndex
+from download import Downloader
+
+YEAR = 2010
+STATIONS = 50
+HOURS_STEP = 1
+SEED = 0
+BATCH_SIZES = [1, 100, 10000]
+FLDS = ['HR','MN','DIR','SPD','GUS','CLG','SKC','L','M','H','VSB','MW1','MW2','MW3','MW4','AW1','AW2','AW3','AW4','W',
+        'TEMP','DEWP','SLP','ALT','STP','MAX','MIN','PCP01','PCP06','PCP24','PCPXX','SD']
+REQ_FLDS = ['TEMP', 'SPD', 'PCP01', 'SKC']
+# continental US
+LAT_RANGE = (25., 49.)
+LON_RANGE = (-124., -67.)
+
+## synthetic fixtures
+def station_ids(n):
+    return ['7%05d-%05d' % (i, 10000 + i) for i in range(n)]
+
+def write_catalog(path, stns, yr):
+    """ ISH-HISTORY.TXT and stn_flds.txt for stns {_id: (lat, lon)}, every station active around 'yr' """
+    covg_path, flds_path = os.path.join(path, 'ISH-HISTORY.TXT'), os.path.join(path, 'stn_flds.txt')
+    sd, ed = '%d0101' % (yr - 20), '%d1231' % (yr + 1)
+    with open(covg_path, 'w') as f:
+        for _id in sorted(stns):
+            lat, lon = stns[_id]
+            name = ('SYNTHETIC %s' % _id).ljust(30)
+            f.write('%s %s %sUS US CA KXXX  %+06d %+07d +00100    %s %s\n'
+                    % (_id[:6], _id[7:], name, int(lat * 1000), int(lon * 1000), sd, ed))
+    with open(flds_path, 'w') as f:
+        f.write(",".join(['ID'] + FLDS) + "\n")
+        for _id in sorted(stns):
+            f.write(",".join([_id] + ['1'] * len(FLDS)) + "\n")
+    return covg_path, flds_path
+
+def isd_record(rng, _id, t, lat, lon):
+    """ one raw ISD record (control + mandatory sections, and the additional data noaahist decodes) """
+    usaf, wban = _id.split('-')
+    temp = int(rng.gauss(150, 80))
+    dewp = temp - rng.randint(0, 100)
+    fixed = ''.join([
+        '0000', usaf, wban, t.strftime('%Y%m%d%H%M'), '4',
+        '%+06d' % int(lat * 1000), '%+07d' % int(lon * 1000), 'FM-15', '+0100', 'KXXX ', 'V020',
+        '%03d' % (rng.randint(1, 36) * 10), '1', rng.choice('NNNNV'), '%04d' % rng.randint(0, 150), '1',
+        '%05d' % rng.choice([99999, 22000, rng.randint(3, 300) * 30]), '1', '9', 'N',
+        '%06d' % rng.choice([16093, 11265, rng.randint(1, 16) * 1000]), '1', '9', '9',
+        '%+05d' % temp, '1', '%+05d' % dewp, '1', '%05d' % rng.randint(9800, 10400), '1'])
+    add = ['ADD',
+           'GF1%02d%02d1%02d1%02d1%05d1%02d1%02d1' % (rng.randint(0, 10), rng.randint(0, 8), rng.randint(0, 8),
+                                                      rng.randint(0, 9), rng.randint(0, 9999), rng.randint(0, 9),
+                                                      rng.randint(0, 9)),
+           'MA1%05d1%05d1' % (rng.randint(9900, 10300), rng.randint(9000, 10200)),
+           'OC1%04d1' % rng.randint(50, 250)]
+    if t.hour % 6 == 0:
+        add.append('AA106%04d91' % rng.choice([0, 0, 0, rng.randint(1, 300)]))
+    if t.hour == 0:
+        add.append('KA1024N%+05d1' % (temp - 50))
+        add.append('KA2024M%+05d1' % (temp + 50))
+        add.append('AJ1%04d1%s' % (rng.choice([0, 0, rng.randint(1, 60)]), '1' * 9))
+    if rng.random() < .2:
+        add.append('AA101%04d91' % rng.randint(1, 100))
+        add.append('MW1%02d1' % rng.randint(0, 99))
+        add.append('AW1%02d1' % rng.randint(0, 99))
+        add.append('AY1%d101' % rng.randint(0, 9))
+    rec = fixed + ''.join(add)
+    return '%04d' % (len(rec) - 105) + rec[4:]
+
+def write_station_year(mirror, _id, yr, lat, lon, rng, hours_step=HOURS_STEP):
+    """ <mirror>/<yr>/<_id>-<yr>.gz with one record every 'hours_step' hours -> number of records """
+    path = os.path.join(mirror, station_year_path(_id, yr))
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    t, end, n = dt.datetime(yr, 1, 1), dt.datetime(yr + 1, 1, 1), 0
+    with gzip.open(path, 'wb') as f:
+        while t < end:
+            f.write(isd_record(rng, _id, t + dt.timedelta(minutes=rng.choice([0, 51, 53])), lat, lon) + '\n')
+            t += dt.timedelta(hours=hours_step)
+            n += 1
+    return n
+
+def make_fixtures(path, n_stations=STATIONS, yr=YEAR, hours_step=HOURS_STEP, seed=SEED):
+    rng = random.Random(seed)
+    stns = {_id: (rng.uniform(*LAT_RANGE), rng.uniform(*LON_RANGE)) for _id in station_ids(n_stations)}
+    covg_path, flds_path = write_catalog(path, stns, yr)
+    mirror = os.path.join(path, 'mirror')
+    records = sum(write_station_year(mirror, _id, yr, lat, lon, rng, hours_step) for _id, (lat, lon) in sorted(stns.items()))
+    return dict(covg_path=covg_path, flds_path=flds_path, mirror=mirror, records=records,
+                gz_bytes=sum(os.path.getsize(os.path.join(root, fn)) for root, dirs, files in os.walk(mirror) for fn in files))
+
+def serve(directory):
+    """ serve 'directory' over http on a loopback port -> (server, base url) """
+    class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            return os.path.join(directory, path.split('?')[0].lstrip('/'))
+        def log_message(self, *args):
+            pass
+    class Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+        allow_reuse_address = True
+        daemon_threads = True
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+## timing
+class quiet(object):
+    """ discard the tool's progress prints while a stage runs """
+    def __enter__(self):
+        self.stdout, sys.stdout = sys.stdout, NullDest()
+    def __exit__(self, *exc):
+        sys.stdout = self.stdout
+
+def timed(func, repeat, setup=None):
+    """ best wall time of 'repeat' runs of func() (after setup(), untimed) -> (secs, last result) """
+    best, result = None, None
+    for i in range(repeat):
+        if setup:
+            setup()
+        with quiet():
+            t0 = time.time()
+            result = func()
+            secs = time.time() - t0
+        best = secs if best is None else min(best, secs)
+    return best, result
+
+def stage(results, name, secs, n, unit, **extra):
+    results[name] = dict(secs=round(secs, 6), n=n, unit=unit, per_sec=round(n / secs, 1) if secs else None, **extra)
+    sys.stderr.write('%-24s %10.4fs  %10s %s\n' % (name, secs, n, unit))
+
+class NullDest(object):
+    def write(self, s):
+        pass
+    def writelines(self, lines):
+        for line in lines:
+            pass
+    def flush(self):
+        pass
+
+def random_locations(rng, n):
+    return [(rng.uniform(*LAT_RANGE), rng.uniform(*LON_RANGE)) for i in range(n)]
+
+def infile_lines(rng, n, yr=YEAR):
+    """ --infile lines for n random locations, each asking for a few days of REQ_FLDS """
+    lines = []
+    for i, (lat, lon) in enumerate(random_locations(rng, n)):
+        sd = dt.date(yr, 1, 1) + dt.timedelta(days=rng.randint(1, 355))
+        ed = sd + dt.timedelta(days=rng.randint(0, 6))
+        lines.append('loc%d|%s,%s|%.4f,%.4f|%s' % (i, '{:%Y%m%d}'.format(sd), '{:%Y%m%d}'.format(ed), lat, lon, ','.join(REQ_FLDS)))
+    return lines
+
+## benchmarks
+def run(args):
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='noaahist-bench-')
+    server = None
+    try:
+        t0 = time.time()
+        fx = make_fixtures(workdir, args.stations, YEAR, args.hours_step, args.seed)
+        stage(results, 'fixtures', time.time() - t0, fx['records'], 'records', gz_bytes=fx['gz_bytes'])
+        if args.mirror == 'http':
+            server, base_url = serve(fx['mirror'])
+        else:
+            base_url = 'file://' + fx['mirror']
+        isd.NOAA_URL = base_url
+        isd.DOWNLOADER = Downloader(base_url)
+        isd.CACHE = isd.STORE = None
+        noaahist.LISTINGS = StationListings(None)
+        rng = random.Random(args.seed)
+
+        # catalog
+        catalog_path = os.path.join(workdir, 'stations.cat')
+        secs, stns = timed(lambda: stn_covg(fx['covg_path']), args.repeat)
+        stage(results, 'catalog_parse', secs, len(stns), 'stations')
+        def compile_catalog():
+            if os.path.exists(catalog_path):
+                os.remove(catalog_path)
+            return load_stations(fx['covg_path'], fx['flds_path'], catalog_path)
+        secs, stns = timed(compile_catalog, args.repeat)
+        stage(results, 'catalog_compile', secs, len(stns), 'stations')
+        secs, stns = timed(lambda: load_stations(fx['covg_path'], fx['flds_path'], catalog_path), args.repeat)
+        stage(results, 'catalog_load', secs, len(stns), 'stations')
+        secs, index = timed(lambda: StationIndex(stns), args.repeat)
+        stage(results, 'index_build', secs, len(stns), 'stations')
+
+        # resolve
+        points = random_locations(rng, args.lookups)
+        date = dt.date(YEAR, 6, 1)
+        def nearest():
+            filt = index.active(date=date)
+            return [index.nearest(lat, lon, 1, filt) for lat, lon in points]
+        secs, _ = timed(nearest, args.repeat)
+        stage(results, 'resolve_index', secs, len(points), 'lookups')
+        def nearest_scan():
+            # what resolution cost before the index: haversine to every station, then sort
+            return [sorted((haversine(lat, lon, stns[_id]['lat'], stns[_id]['lon']), _id) for _id in stns)[0] for lat, lon in points]
+        secs, _ = timed(nearest_scan, args.repeat)
+        stage(results, 'resolve_scan', secs, len(points), 'lookups')
+        lines = infile_lines(rng, args.lookups)
+        secs, reqs = timed(lambda: [req_from_infile_line(line, stns, False, index) for line in lines], args.repeat)
+        stage(results, 'resolve_requests', secs, len(reqs), 'requests')
+        # the same locations sharing one week, their stations picked in a single geo-join pass
+        sd = dt.date(YEAR, 6, 1)
+        secs, reqs = timed(lambda: batch_requests(sd, sd + dt.timedelta(days=6), [lat for lat, lon in points],
+                                                  [lon for lat, lon in points], REQ_FLDS, stns, False, index), args.repeat)
+        stage(results, 'resolve_batch', secs, len(reqs), 'requests')
+
+        # download and decode
+        keys = [(_id, YEAR) for _id in sorted(stns)]
+        def decode_all():
+            return sum(1 for stn, yr in keys for obs in fetch_station_year(stn, yr, REQ_FLDS))
+        secs, n = timed(decode_all, args.repeat)
+        stage(results, 'download_decode', secs, n, 'records', station_years=len(keys))
+        cache_dir = os.path.join(workdir, 'cache')
+        isd.CACHE = StationYearCache(cache_dir)
+        with quiet():
+            for key in isd.prefetch(keys):
+                pass
+        secs, n = timed(decode_all, args.repeat)
+        stage(results, 'cached_decode', secs, n, 'records', station_years=len(keys))
+        secs, n = timed(lambda: sum(1 for stn, yr in keys for obs in fetch_station_year(stn, yr, FLDS[2:])), args.repeat)
+        stage(results, 'cached_decode_all_flds', secs, n, 'records', station_years=len(keys))
+
+        # date filtering: a week out of each station-year
+        datestrs = set('{:%Y%m%d}'.format(dt.date(YEAR, 7, 1) + dt.timedelta(days=d)) for d in range(7))
+        secs, out = timed(lambda: [run_fetch((stn, yr, REQ_FLDS, datestrs)) for stn, yr in keys], args.repeat)
+        stage(results, 'filter_week', secs, sum(len(res[2]) for res in out), 'records', station_years=len(keys))
+
+        # output formatting
+        rows = [dict(NAME='loc', HR_TIME=obs['HR_TIME'], LAT=34.05, LON=-118.25, **{fld: obs[fld] for fld in REQ_FLDS})
+                for stn, yr in keys[:10] for obs in fetch_station_year(stn, yr, REQ_FLDS)]
+        secs, _ = timed(lambda: AllWeatherResponses([rows]).write(NullDest()), args.repeat)
+        stage(results, 'format_csv', secs, len(rows), 'rows')
+
+        # whole batches, from a cold cache each time
+        def fresh_cache():
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            isd.CACHE = StationYearCache(cache_dir)
+        pool = Pool(processes=args.nprocs) if args.nprocs else None
+        for size in args.batch_sizes:
+            lines = infile_lines(rng, size)
+            def batch():
+                reqs = [req_from_infile_line(line, stns, False, index) for line in lines]
+                resps = FetchPlan(reqs).run(pool)
+                AllWeatherResponses([resp[0] for resp in resps]).write(NullDest())
+                return sum(len(resp[0]) for resp in resps)
+            secs, n = timed(batch, args.repeat, setup=fresh_cache)
+            stage(results, 'batch_%d' % size, secs, size, 'locations', rows=n)
+        if pool:
+            pool.close()
+    finally:
+        if server is not None:
+            server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return dict(python=platform.python_version(), platform=platform.platform(), date=dt.datetime.utcnow().isoformat(),
+                params=dict(stations=args.stations, hours_step=args.hours_step, seed=args.seed, repeat=args.repeat,
+                            lookups=args.lookups, batch_sizes=args.batch_sizes, mirror=args.mirror, year=YEAR,
+                            nprocs=args.nprocs),
+                results=results)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='./benchmark.py')
+    parser.add_argument('--stations', type=int, default=STATIONS,
+                        help='number of synthetic stations, each with one station-year file (default: %(default)s)')
+    parser.add_argument('--hours-step', type=int, default=HOURS_STEP,
+                        help='hours between synthetic observations (default: %(default)s)')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=BATCH_SIZES,
+                        help='numbers of locations in the end-to-end batches (default: %(default)s)')
+    parser.add_argument('--lookups', type=int, default=1000,
+                        help='number of random locations for the station resolution stages (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per stage; the best wall time is reported (default: %(default)s)')
+    parser.add_argument('--mirror', choices=['http', 'file'], default='http',
+                        help='serve the synthetic files over http on a loopback port, or as a file:// mirror (default: %(default)s)')
+    parser.add_argument('--nprocs', type=int, default=0,
+                        help='run the end-to-end batches on a Pool of this many processes (default: serial)')
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('-o', '--outfile', nargs='?', type=argparse.FileType('w'), default=sys.stdout,
+                        help='write the JSON results to a file (default: stdout)')
+    args = parser.parse_args()
+
+    report = run(args)
+    json.dump(report, args.outfile, indent=2, sort_keys=True)
+    args.outfile.write("\n")
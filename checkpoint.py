@@ -0,0 +1,48 @@
+"""
+Checkpoints for long batch runs
+
+A RunDirectory keeps each completed request's rows and metadata in its own part file, written
+as soon as the request finishes.  Parts are keyed by a hash of the request's infile line (plus
+the options that change its output), so rerunning the same infile skips every request that
+already has a part and only does the rest.  The final output is written by reading the parts
+back one at a time, in request order.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+
+class RunDirectory(object):
+    def __init__(self, path, salt=''):
+        self.path = path
+        # options that change a request's output (e.g. --fallback) go in every key
+        self.salt = salt
+
+    def key(self, line):
+        return hashlib.sha1(self.salt + "\n" + line.strip()).hexdigest()
+
+    def part_path(self, key):
+        return os.path.join(self.path, key[:2], key + '.json')
+
+    def done(self, key):
+        return os.path.exists(self.part_path(key))
+
+    def save(self, key, line, rows, meta_str):
+        path = self.part_path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dict(line=line.strip(), rows=list(rows), meta=meta_str), f)
+        # only a complete part counts as done
+        os.rename(tmp, path)
+
+    def load(self, key):
+        """ (rows, meta_str) of a completed request """
+        with open(self.part_path(key)) as f:
+            part = json.load(f)
+        return part['rows'], part['meta']
@@ -0,0 +1,253 @@
+"""
+Columnar response of one WeatherDataRequest
+
+ColumnarResponse holds a request's hourly rows as one typed array per field, over every hour of
+the request's date range: hour h is h hours after midnight (UTC) of the start date.  Each field
+has a validity mask (1 = a value was reported), and a row mask says which hours have a row at
+all.  Values use obsstore.py's column types and render back to exactly the decoder's strings,
+so the CSV written from the arrays is the same as before (the rare reported string a column
+can't hold is kept aside as it is).  With --fallback, the rank and station of the value kept
+for each hour and field are recorded too.
+
+Iterating yields the rows as dicts, for writers that want them (parquet, --run-dir).  The CSV
+writers use csv_lines() instead, which renders straight from the arrays, and rollups reduce
+float_column() and value_counts().  to_numpy() and
+to_pandas() hand over the arrays themselves; to_numpy(dense=True) makes no copies at all.
+"""
+
+import array
+import datetime as dt
+from bisect import bisect_left
+from collections import Counter
+
+from obsstore import COLUMN_TYPES, KINDS, encode, render, convert, to_minutes
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class ColumnarResponse(object):
+    def __init__(self, start, end, flds, lat, lon, name=None, fallback=False):
+        ndays = (end - start).days + 1
+        self.start = start
+        self.first_hour = to_minutes(start) // 60
+        self.n = ndays * 24
+        self.lat, self.lon, self.name = lat, lon, name
+        self.flds = list(flds)
+        days = [start + dt.timedelta(days=i) for i in range(ndays)]
+        self.day_strs = ["{:%Y%m%d}".format(d) for d in days]
+        # YYYYMMDD -> hour index of its midnight
+        self.day_hours = {day: i * 24 for i, day in enumerate(self.day_strs)}
+        self.present = bytearray(self.n)
+        self.nrows = 0
+        self.values = {fld: array.array(COLUMN_TYPES[fld][0], [0]) * self.n for fld in self.flds}
+        self.valid = {fld: bytearray(self.n) for fld in self.flds}
+        # fields written at least once (even with '*'): the columns this response has
+        self.touched = set()
+        # (h, fld) -> reported strings the column type can't hold, kept as they are (masked in to_numpy())
+        self.raw = {}
+        self.fallback = fallback
+        if fallback:
+            # rank of the station whose value is kept (-1: none yet), and that station
+            self.ranks = {fld: array.array('b', [-1]) * self.n for fld in self.flds}
+            self.stns = {fld: array.array('h', [-1]) * self.n for fld in self.flds}
+            self.stn_ids, self.stn_index = [], {}
+
+    def hour(self, hr_time):
+        """ 'YYYYMMDDHH' -> hour index, or None outside the date range """
+        day = self.day_hours.get(hr_time[:8])
+        return None if day is None else day + int(hr_time[8:10])
+
+    def hr_time(self, h):
+        return "%s%02d" % (self.day_strs[h // 24], h % 24)
+
+    def add_row(self, h):
+        if not self.present[h]:
+            self.present[h] = 1
+            self.nrows += 1
+
+    def set(self, h, fld, val):
+        """ store decoded string 'val' ('*' for not reported) for hour h """
+        self.touched.add(fld)
+        v = encode(fld, val)
+        if self.raw:
+            self.raw.pop((h, fld), None)
+        if v is None:
+            self.valid[fld][h] = 0
+            if val != '*':
+                self.raw[(h, fld)] = val
+        else:
+            self.values[fld][h] = v
+            self.valid[fld][h] = 1
+
+    def is_set(self, h, fld):
+        """ was a value (not '*') reported for hour h? """
+        return bool(self.valid[fld][h]) or (h, fld) in self.raw
+
+    def get(self, h, fld):
+        """ decoded string for hour h, '*' if not reported """
+        if self.valid[fld][h]:
+            return render(fld, self.values[fld][h])
+        return self.raw.get((h, fld), '*')
+
+    def filled_rank(self, h, fld):
+        """ rank of the station whose value hour h * fld holds, or None """
+        rank = self.ranks[fld][h]
+        return None if rank < 0 else rank
+
+    def set_filled(self, h, fld, rank, stn):
+        if stn not in self.stn_index:
+            self.stn_index[stn] = len(self.stn_ids)
+            self.stn_ids.append(stn)
+        self.ranks[fld][h] = rank
+        self.stns[fld][h] = self.stn_index[stn]
+
+    def backup_values(self):
+        """ yields (h, fld, stn) for each reported value kept from a backup station """
+        if not self.fallback:
+            return
+        rows = self.rows()
+        for fld in self.flds:
+            ranks, stns = self.ranks[fld], self.stns[fld]
+            for h in rows:
+                if ranks[h] > 0 and self.is_set(h, fld):
+                    yield h, fld, self.stn_ids[stns[h]]
+
+    def rows(self):
+        """ hour indexes that have a row, in time order """
+        return [h for h, present in enumerate(self.present) if present]
+
+    def __len__(self):
+        return self.nrows
+
+    def fld_names(self):
+        """ the columns rows have: HR_TIME, LAT, LON, NAME if named, and each field written """
+        return ['HR_TIME', 'LAT', 'LON'] + (['NAME'] if self.name else []) + [fld for fld in self.flds if fld in self.touched]
+
+    def __iter__(self):
+        flds = [fld for fld in self.flds if fld in self.touched]
+        for h in self.rows():
+            row = dict(HR_TIME=self.hr_time(h), DATE=self.day_strs[h // 24], LAT=self.lat, LON=self.lon)
+            if self.name:
+                row['NAME'] = self.name
+            for fld in flds:
+                row[fld] = self.get(h, fld)
+            yield row
+
+    def csv_lines(self, fld_names):
+        """ rows as AllWeatherResponses writes them, rendered from the arrays """
+        consts = dict(LAT=str(round(self.lat, 2)), LON=str(round(self.lon, 2)))
+        if self.name:
+            consts['NAME'] = str(self.name)
+        cols = []
+        for fld in fld_names:
+            if fld in self.touched:
+                cols.append((fld, self.values[fld], self.valid[fld], COLUMN_TYPES[fld][1]))
+            else:
+                cols.append((fld, None, None, consts.get(fld, '*')))
+        for h in self.rows():
+            vals = []
+            for fld, values, valid, fmt in cols:
+                if fld == 'HR_TIME':
+                    vals.append(self.hr_time(h))
+                elif values is None:
+                    vals.append(fmt)
+                elif not valid[h]:
+                    vals.append(self.raw.get((h, fld), '*') if self.raw else '*')
+                elif fmt is None:
+                    vals.append(render(fld, values[h]))
+                else:
+                    vals.append(fmt % values[h])
+            yield ",".join(vals) + "\n"
+
+    def float_column(self, fld):
+        """
+        the rows' values of 'fld' as floats, NaN where not reported, each equal to float() of the
+        decoder's string (trace 'T' is 0): a numpy array with numpy installed, else a list
+        """
+        rows = self.rows()
+        nan = float('nan')
+        if fld not in self.touched:
+            return np.full(len(rows), nan) if np is not None else [nan] * len(rows)
+        values, valid = self.values[fld], self.valid[fld]
+        fmt = COLUMN_TYPES[fld][1]
+        if fmt is None:
+            # stored as codes (sky cover), not as the numbers their strings may stand for
+            out = [convert('float', self.get(h, fld)) for h in rows]
+            out = [nan if v is None else v for v in out]
+            return np.array(out, dtype=float) if np is not None else out
+        # float32 values rounded back to the decimals they were reported with
+        digits = int(fmt[2:-1]) if values.typecode == 'f' else None
+        if np is not None:
+            present = np.frombuffer(self.present, dtype=bool)
+            out = np.frombuffer(values, dtype=values.typecode)[present].astype(float)
+            if digits is not None:
+                out = np.round(out, digits)
+            out[~np.frombuffer(valid, dtype=bool)[present]] = nan
+        elif digits is not None:
+            out = [round(values[h], digits) if valid[h] else nan for h in rows]
+        else:
+            out = [float(values[h]) if valid[h] else nan for h in rows]
+        for (h, f), val in self.raw.items():
+            if f == fld:
+                v = convert('float', val)
+                out[bisect_left(rows, h)] = nan if v is None else v
+        return out
+
+    def value_counts(self, fld, hours):
+        """ Counter of the decoded strings reported (not '*') for 'fld' over hour indexes 'hours' """
+        if fld not in self.touched:
+            return Counter()
+        values, valid = self.values[fld], self.valid[fld]
+        counts = Counter(values[h] for h in hours if valid[h])
+        out = Counter()
+        for v, n in counts.items():
+            out[render(fld, v)] += n
+        for (h, f), val in self.raw.items():
+            if f == fld and h in hours:
+                out[val] += 1
+        return out
+
+    def to_numpy(self, dense=False):
+        """
+        {'HR_TIME': datetime64[h] array, fld: numpy.ma.MaskedArray, ...} for the rows, or with
+        dense=True for every hour of the date range, as views on this response's own buffers
+        (hours without a row then have every field masked)
+        """
+        out = {'HR_TIME': np.arange(self.first_hour, self.first_hour + self.n).astype('datetime64[h]')}
+        for fld in self.flds:
+            if fld not in self.touched:
+                continue
+            vals = np.frombuffer(self.values[fld], dtype=self.values[fld].typecode)
+            valid = np.frombuffer(self.valid[fld], dtype=bool)
+            out[fld] = np.ma.MaskedArray(vals, mask=~valid)
+        if dense:
+            return out
+        rows = np.frombuffer(self.present, dtype=bool)
+        return {name: col[rows] for name, col in out.items()}
+
+    def to_pandas(self):
+        """
+        DataFrame indexed by HR_TIME: measurements as numbers (NaN where not reported; integers
+        as nullable Int columns where pandas has them), code fields as categoricals
+        """
+        import pandas as pd
+        cols = self.to_numpy()
+        index = pd.DatetimeIndex(cols.pop('HR_TIME'), name='HR_TIME')
+        names = [fld for fld in self.flds if fld in cols]
+        data = {}
+        for fld in names:
+            col = cols[fld]
+            if KINDS.get(fld) == 'code':
+                # categories from the observed values only, not the fill behind masked slots
+                uniq = np.unique(col.compressed())
+                codes = np.where(np.ma.getmaskarray(col), -1, np.searchsorted(uniq, col.data))
+                data[fld] = pd.Categorical.from_codes(codes, [render(fld, v) for v in uniq])
+            elif col.dtype.kind == 'f':
+                data[fld] = col.filled(np.nan)
+            elif hasattr(pd, 'arrays') and hasattr(pd.arrays, 'IntegerArray'):
+                data[fld] = pd.arrays.IntegerArray(col.data, np.ma.getmaskarray(col))
+            else:
+                data[fld] = col.astype(float).filled(np.nan)
+        return pd.DataFrame(data, index=index, columns=names)
@@ -0,0 +1,317 @@
+"""
+Download engine for NOAA station-year files
+
+A Downloader keeps a bounded pool of persistent connections to one mirror (ftp://, http://,
+https:// or a local file:// directory), so many station-year fetches reuse the same control /
+keep-alive connections instead of spawning a curl per file.  Transfers are streamed as chunks,
+so bytes go straight into the decoder.  Failed transfers are retried with exponential backoff,
+resuming from the last byte received (FTP REST / HTTP Range) rather than starting over.
+
+fetch_many() runs a function over many jobs on a bounded set of threads and yields results in
+completion order, which keeps the link busy while earlier files are being decoded.
+"""
+
+import os
+import re
+import time
+import socket
+import ftplib
+import httplib
+import threading
+import Queue
+import calendar
+from email.utils import formatdate
+from urlparse import urlparse
+
+from stats import STATS
+
+CONNECTIONS = 4
+RETRIES = 3
+BACKOFF_SECS = 1.
+TIMEOUT_SECS = 60
+CHUNK_SIZE = 64 * 1024
+
+class NotFound(Exception):
+    """ the mirror has no such file """
+
+class DownloadError(Exception):
+    """ a transfer still failed after all retries """
+
+class NotRanged(DownloadError):
+    """ the mirror won't serve the file from that offset (no ranged reads, or the file got shorter) """
+
+RETRY_ERRORS = (socket.error, EOFError, IOError, httplib.HTTPException, ftplib.error_temp, ftplib.error_reply,
+                ftplib.error_proto)
+
+## connections: get(path, offset, if_modified_since) -> file-like reader, or None if not modified
+class _FTPConnection(object):
+    def __init__(self, url, timeout):
+        self.ftp = ftplib.FTP(timeout=timeout)
+        self.ftp.connect(url.hostname, url.port or 21)
+        self.ftp.login(url.username or 'anonymous', url.password or '')
+        self.ftp.voidcmd('TYPE I')
+        self.root = url.path.rstrip('/')
+
+    def get(self, path, offset=0, if_modified_since=None):
+        path = self.root + '/' + path
+        try:
+            if if_modified_since is not None:
+                resp = self.ftp.sendcmd('MDTM ' + path)
+                stamp = resp.split()[-1][:14]
+                mtime = calendar.timegm(time.strptime(stamp, '%Y%m%d%H%M%S'))
+                if mtime <= if_modified_since:
+                    return None
+            sock = self.ftp.transfercmd('RETR ' + path, rest=offset or None)
+        except ftplib.error_perm as e:
+            if str(e).startswith('550'):
+                raise NotFound(path)
+            if offset:
+                raise NotRanged('%s from byte %d: %s' % (path, offset, e))
+            raise
+        return _FTPReader(self.ftp, sock)
+
+    def listdir(self, path):
+        try:
+            return [os.path.basename(name) for name in self.ftp.nlst(self.root + '/' + path)]
+        except ftplib.error_perm as e:
+            if str(e).startswith('550'):
+                raise NotFound(path)
+            raise
+
+    def close(self):
+        try:
+            self.ftp.close()
+        except Exception:
+            pass
+
+class _FTPReader(object):
+    def __init__(self, ftp, sock):
+        self.ftp = ftp
+        self.sock = sock
+        self.f = sock.makefile('rb')
+
+    def read(self, n):
+        return self.f.read(n)
+
+    def close(self):
+        self.f.close()
+        self.sock.close()
+        # '226 Transfer complete' -> the control connection is ready for the next file
+        self.ftp.voidresp()
+
+class _HTTPConnection(object):
+    def __init__(self, url, timeout):
+        cls = httplib.HTTPSConnection if url.scheme == 'https' else httplib.HTTPConnection
+        self.conn = cls(url.hostname, url.port, timeout=timeout)
+        self.root = url.path.rstrip('/')
+
+    def request(self, path, headers):
+        self.conn.request('GET', self.root + '/' + path, headers=headers)
+        resp = self.conn.getresponse()
+        if resp.status == 404:
+            resp.read()
+            raise NotFound(path)
+        return resp
+
+    def get(self, path, offset=0, if_modified_since=None):
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+        if if_modified_since is not None:
+            headers['If-Modified-Since'] = formatdate(if_modified_since, usegmt=True)
+        resp = self.request(path, headers)
+        if resp.status == 304:
+            resp.read()
+            return None
+        if offset and resp.status in (200, 416):
+            resp.read()
+            raise NotRanged('%s from byte %d: %s %s' % (path, offset, resp.status, resp.reason))
+        if resp.status not in (200, 206) or (offset and resp.status != 206):
+            resp.read()
+            raise httplib.HTTPException('%s %s for %s' % (resp.status, resp.reason, path))
+        return resp
+
+    def listdir(self, path):
+        resp = self.request(path.rstrip('/') + '/', {})
+        if resp.status != 200:
+            resp.read()
+            raise httplib.HTTPException('%s %s for %s' % (resp.status, resp.reason, path))
+        return re.findall('href="([^"/?]+)"', resp.read())
+
+    def close(self):
+        self.conn.close()
+
+class _FileConnection(object):
+    def __init__(self, url, timeout):
+        self.root = url.path.rstrip('/')
+
+    def get(self, path, offset=0, if_modified_since=None):
+        fp = self.root + '/' + path
+        if not os.path.isfile(fp):
+            raise NotFound(path)
+        if if_modified_since is not None and os.path.getmtime(fp) <= if_modified_since:
+            return None
+        f = open(fp, 'rb')
+        f.seek(offset)
+        return f
+
+    def listdir(self, path):
+        try:
+            return os.listdir(self.root + '/' + path)
+        except OSError:
+            raise NotFound(path)
+
+    def close(self):
+        pass
+
+CONNECTION_TYPES = {'ftp': _FTPConnection, 'http': _HTTPConnection, 'https': _HTTPConnection, 'file': _FileConnection}
+
+class Downloader(object):
+    def __init__(self, base_url, connections=CONNECTIONS, retries=RETRIES, backoff_secs=BACKOFF_SECS,
+                 timeout_secs=TIMEOUT_SECS):
+        self.base_url = base_url
+        self.url = urlparse(base_url)
+        if self.url.scheme not in CONNECTION_TYPES:
+            raise ValueError("unsupported mirror url: %s" % base_url)
+        self.connections = connections
+        self.retries = retries
+        self.backoff_secs = backoff_secs
+        self.timeout_secs = timeout_secs
+        self._reset()
+
+    def _reset(self):
+        # connections can't be shared with forked worker processes: each process gets its own pool
+        self.pid = os.getpid()
+        self.idle = Queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(self.connections)
+
+    def _acquire(self):
+        if self.pid != os.getpid():
+            self._reset()
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            try:
+                return CONNECTION_TYPES[self.url.scheme](self.url, self.timeout_secs)
+            except Exception:
+                self.slots.release()
+                raise
+
+    def _release(self, conn, reusable):
+        if reusable:
+            self.idle.put(conn)
+        else:
+            conn.close()
+        self.slots.release()
+
+    def _with_retries(self, func):
+        attempt = 0
+        while True:
+            try:
+                return func()
+            except RETRY_ERRORS as e:
+                attempt += 1
+                if attempt > self.retries:
+                    raise DownloadError(str(e))
+                time.sleep(self.backoff_secs * 2 ** (attempt - 1))
+
+    def chunks(self, path, offset=0, if_modified_since=None, info=None):
+        """
+        yields the bytes of 'path' (relative to the mirror's base url) from 'offset' on, in chunks.
+        raises NotFound, or DownloadError once retries (each resuming where the last stopped) run out.
+        if 'if_modified_since' (epoch secs) is given and the file is older, yields nothing and sets
+        info['not_modified'] = True
+        """
+        attempt = 0
+        while True:
+            conn, reader, reusable = None, None, False
+            try:
+                conn = self._acquire()
+                reader = conn.get(path, offset, if_modified_since)
+                if reader is None:
+                    reusable = True
+                    STATS.count('not_modified')
+                    if info is not None:
+                        info['not_modified'] = True
+                    return
+                while True:
+                    # time only the transfer, not whoever is consuming the chunks
+                    with STATS.timer('download'):
+                        chunk = reader.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    offset += len(chunk)
+                    STATS.count('bytes_downloaded', len(chunk))
+                    yield chunk
+                reader.close()
+                reader, reusable = None, True
+                STATS.count('downloads')
+                return
+            except NotFound:
+                reusable = True
+                raise
+            except RETRY_ERRORS as e:
+                attempt += 1
+                STATS.count('download_retries')
+                if attempt > self.retries:
+                    raise DownloadError('%s: %s' % (path, e))
+            finally:
+                if reader is not None:
+                    try:
+                        reader.close()
+                    except Exception:
+                        pass
+                if conn is not None:
+                    self._release(conn, reusable)
+            time.sleep(self.backoff_secs * 2 ** (attempt - 1))
+            # the file may have changed between attempts; a conditional retry would be ambiguous
+            if_modified_since = None
+
+    def download(self, path, dest, if_modified_since=None):
+        """ write 'path' to the open file 'dest' -> False if not modified since 'if_modified_since' """
+        info = {}
+        for chunk in self.chunks(path, if_modified_since=if_modified_since, info=info):
+            dest.write(chunk)
+        return not info.get('not_modified')
+
+    def listdir(self, path):
+        """ names in directory 'path' of the mirror """
+        def listdir():
+            conn, reusable = self._acquire(), False
+            try:
+                names = conn.listdir(path)
+                reusable = True
+                return names
+            except NotFound:
+                reusable = True
+                raise
+            finally:
+                self._release(conn, reusable)
+        return self._with_retries(listdir)
+
+    def fetch_many(self, jobs, func, threads=None):
+        """
+        run func(job) for every job on up to 'threads' (default: the connection limit) threads.
+        yields (job, result, exception) in completion order
+        """
+        jobs = list(jobs)
+        todo, done = Queue.Queue(), Queue.Queue()
+        for job in jobs:
+            todo.put(job)
+        def work():
+            while True:
+                try:
+                    job = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    done.put((job, func(job), None))
+                except Exception as e:
+                    done.put((job, None, e))
+        workers = [threading.Thread(target=work) for i in range(min(threads or self.connections, len(jobs)))]
+        for w in workers:
+            w.daemon = True
+            w.start()
+        for i in range(len(jobs)):
+            yield done.get()
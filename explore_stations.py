@@ -1,12 +1,10 @@
-from noaahist import stn_covg, stn_flds, haversine, coords_from_zip
+from noaahist import load_stations
+from zipgeo import coords_from_zip
+from stnindex import StationIndex, haversine_many
 
 # load data about stations
-stns = stn_covg()
-flds_by_stn = stn_flds()
-for _id in flds_by_stn:
-    for fld in flds_by_stn[_id]:
-        if flds_by_stn[_id][fld]:
-            stns[_id]['flds'].append(fld)
+stns = load_stations()
+index = StationIndex(stns)
 
 def stns_near_lat_lon(latitude, longitude, year, N=20, id_filter=None):
     """
@@ -23,20 +21,23 @@ def stns_near_lat_lon(latitude, longitude, year, N=20, id_filter=None):
     if longitude > 0.:
         longitude = -1. * longitude
     lines = [" ".join(['   ', "Station ID".ljust(12), "Station Name".ljust(30), "    ", "Dist. (miles)"]) + "\n"]
-    def show_stn(stn_id, rank):
+    def show_stn(stn_id, rank, dist):
         d = stns[stn_id]
         info_str = " ".join([(str(rank)+".").ljust(3),
                              stn_id.ljust(12),
                              stns[stn_id]['name'].ljust(30),
                              stns[stn_id]['state'].ljust(4),
-                             str(round(haversine(latitude, longitude, stns[stn_id]['lat'], stns[stn_id]['lon']), 1))]) + "\n"
+                             str(round(dist, 1))]) + "\n"
         return info_str
-    stn_ids = [_id for _id in stns if int(stns[_id]['sd'].year) <= year and int(stns[_id]['ed'].year) >= year]
+    active = index.active(year=year)
     # optionally filter station ids
     if id_filter:
-        stn_ids = id_filter(stn_ids)
-    _ids = sorted(stn_ids, key=lambda _id: haversine(latitude, longitude, stns[_id]['lat'], stns[_id]['lon']))[:N]
-    lines += [show_stn(_id, j) for j, _id in enumerate(_ids)]
+        filt = lambda _id: active(_id) and bool(id_filter([_id]))
+    else:
+        filt = active
+    _ids = [_id for dist, _id in index.nearest(latitude, longitude, N, filt)]
+    dists = haversine_many(latitude, longitude, [stns[_id]['lat'] for _id in _ids], [stns[_id]['lon'] for _id in _ids])
+    lines += [show_stn(_id, j, float(dist)) for j, (_id, dist) in enumerate(zip(_ids, dists))]
     if len(lines) > 1:
         print "".join(lines)
     else:
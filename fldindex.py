@@ -0,0 +1,75 @@
+"""
+Per-year field coverage of weather stations
+
+stn_flds.txt says which fields a station reported in one sample year.  FieldCoverage records
+it per station and year, in static/stn_yr_flds.txt (same layout, with a YEAR column): one
+line per scanned station-year, appended as scans finish, so the index grows incrementally
+and an interrupted scan loses nothing.
+
+scan_station_year() decodes a station-year (from the cache or store when it's there) only
+until every field has been seen at least once, then stops reading.
+"""
+
+import os
+
+from isd import fetch_station_year
+
+COVERAGE_PATH = 'static/stn_yr_flds.txt'
+FLDS = ['HR','MN','DIR','SPD','GUS','CLG','SKC','L','M','H','VSB','MW1','MW2','MW3','MW4','AW1','AW2','AW3','AW4','W',
+        'TEMP','DEWP','SLP','ALT','STP','MAX','MIN','PCP01','PCP06','PCP24','PCPXX','SD']
+
+def scan_station_year(stn, yr, flds=FLDS):
+    """ set of 'flds' reported at least once in station-year stn * yr, reading no further than needed """
+    seen, todo = set(), set(flds)
+    observations = fetch_station_year(stn, yr, flds)
+    try:
+        for obs in observations:
+            found = [fld for fld in todo if obs[fld] != '*']
+            if found:
+                seen.update(found)
+                todo.difference_update(found)
+                if not todo:
+                    break
+    finally:
+        # stops the download / decode of the rest of the file
+        observations.close()
+    return seen
+
+class FieldCoverage(object):
+    """ {(stn, yr): set of fields} from COVERAGE_PATH, loaded on first use """
+    def __init__(self, path=COVERAGE_PATH):
+        self.path = path
+        self.years = None
+
+    def load(self):
+        # stn -> {yr: frozenset of fields}
+        self.years = {}
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            flds = f.readline().strip().split(',')[2:]
+            for line in f:
+                vals = line.strip().split(',')
+                if len(vals) != len(flds) + 2:
+                    continue    # partly written line
+                self.years.setdefault(vals[0], {})[int(vals[1])] = frozenset(fld for fld, v in zip(flds, vals[2:]) if v == '1')
+
+    def flds(self, stn, yr):
+        """ fields stn reported in yr, or None if that station-year hasn't been scanned """
+        if self.years is None:
+            self.load()
+        return self.years.get(stn, {}).get(int(yr))
+
+    def has(self, stn, yr):
+        return self.flds(stn, yr) is not None
+
+    def add(self, stn, yr, flds):
+        """ record (and append to the file) the fields stn reported in yr """
+        if self.years is None:
+            self.load()
+        new = not os.path.exists(self.path)
+        with open(self.path, 'a') as f:
+            if new:
+                f.write(",".join(['ID', 'YEAR'] + FLDS) + "\n")
+            f.write(",".join([stn, str(yr)] + ['1' if fld in flds else '0' for fld in FLDS]) + "\n")
+        self.years.setdefault(stn, {})[int(yr)] = frozenset(flds)
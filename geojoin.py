@@ -0,0 +1,193 @@
+"""
+Batch geo-join: nearest stations for many locations at once
+
+A WeatherDataRequest picks its stations one location at a time, walking the StationIndex
+outward until every field has a station.  For a grid of thousands of locations sharing a date
+range and fields, assign_stations() makes the same choices for all of them in one pass per year:
+the stations active that year (and listed by NOAA) are filtered once, and with numpy the
+distances from a block of locations to every active station are computed as one array, so the
+nearest station reporting each field is an argmin over it.  Without numpy, each location walks
+the index as a single request would.
+
+The result is a StationAssignment: per year and field, one array of station numbers with an
+entry per location (plus one per fallback rank).  Requests built from it skip their own search,
+and FetchPlan fetches the distinct station-years it names once for the whole batch.
+"""
+
+import array
+from collections import Counter
+
+from stnindex import to_xyz
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# distances computed at once per block of locations (locations * active stations)
+BLOCK_CELLS = 4 * 1024 * 1024
+
+def nearest_stations(index, lat, lon, filt, flds, reports, fallback=0):
+    """
+    walk the stations passing 'filt' outward from (lat, lon) -> (nearest_ids, backup_ids):
+    nearest_ids: fld -> closest station that 'reports' (a function of _id) says has it
+    backup_ids: fld -> the next 'fallback' closest stations after that one, whatever they report
+    """
+    nearest_ids = {}
+    backup_ids = {fld: [] for fld in flds}
+    for dist, cand_id in index.iter_nearest(lat, lon, filt):
+        cand_flds = reports(cand_id)
+        for fld in flds:
+            if fld not in nearest_ids and fld in cand_flds:
+                nearest_ids[fld] = cand_id
+            elif len(backup_ids[fld]) < fallback:
+                backup_ids[fld].append(cand_id)
+        if len(nearest_ids) == len(flds) and all(len(backup_ids[fld]) == fallback for fld in flds):
+            break
+    return nearest_ids, backup_ids
+
+def first_dates(start, end):
+    """ {yr: first date of the range in yr}, the date a request picks that year's stations on """
+    out = {}
+    for yr in range(start.year, end.year + 1):
+        out[yr] = start if yr == start.year else start.replace(year=yr, month=1, day=1)
+    return out
+
+class StationAssignment(object):
+    """
+    stations chosen for n locations, one date range and a list of fields
+
+    ids: station ids the table refers to
+    nearest[(yr, fld)]: array('i') of n positions in ids, -1 where no station reports fld
+    backups[(yr, fld)]: one such array per fallback rank
+    """
+    def __init__(self, n, flds, years, fallback=0):
+        self.n = n
+        self.flds = list(flds)
+        self.years = sorted(years)
+        self.fallback = fallback
+        self.ids = []
+        self.positions = {}
+        self.nearest = {}
+        self.backups = {}
+
+    def position(self, _id):
+        if _id not in self.positions:
+            self.positions[_id] = len(self.ids)
+            self.ids.append(_id)
+        return self.positions[_id]
+
+    def set_column(self, yr, fld, rank, col):
+        """ rank 0: nearest station, 1..fallback: backups """
+        if rank == 0:
+            self.nearest[(yr, fld)] = col
+        else:
+            self.backups.setdefault((yr, fld), [None] * self.fallback)[rank - 1] = col
+
+    def picks(self, i, yr):
+        """ (nearest_ids, backup_ids) for location i in yr, as nearest_stations() gives them """
+        nearest_ids, backup_ids = {}, {}
+        for fld in self.flds:
+            j = self.nearest[(yr, fld)][i]
+            if j >= 0:
+                nearest_ids[fld] = self.ids[j]
+            backup_ids[fld] = [self.ids[col[i]] for col in self.backups.get((yr, fld), []) if col[i] >= 0]
+        return nearest_ids, backup_ids
+
+    def station_years(self):
+        """ {(stn, yr): number of (location, field, rank) assignments to it} """
+        out = Counter()
+        for (yr, fld), col in self.nearest.items():
+            for c in [col] + self.backups.get((yr, fld), []):
+                for j, k in Counter(c).items():
+                    if j >= 0:
+                        out[(self.ids[j], yr)] += k
+        return dict(out)
+
+    def rows(self):
+        """ (location, yr, fld, rank, stn) for every assignment, rank 0 being the nearest station """
+        for yr in self.years:
+            for fld in self.flds:
+                cols = [self.nearest[(yr, fld)]] + self.backups.get((yr, fld), [])
+                for i in range(self.n):
+                    for rank, col in enumerate(cols):
+                        if col[i] >= 0:
+                            yield (i, yr, fld, rank, self.ids[col[i]])
+
+def assign_stations(index, lats, lons, start, end, flds, listed, reports, fallback=0):
+    """
+    the stations WeatherDataRequest.resolve() would pick for each (lats[i], lons[i]), in one pass
+    per year -> StationAssignment
+
+    listed: yr -> ids NOAA has a file for (e.g. StationListings.ids)
+    reports: (_id, yr) -> fields the station reports that year
+    """
+    n = len(lats)
+    dates = first_dates(start, end)
+    out = StationAssignment(n, flds, dates, fallback)
+    for yr in out.years:
+        filt = index.active(date=dates[yr], listed=listed(yr))
+        active = sorted(_id for _id in index.stns if filt(_id))
+        if np is not None:
+            assign_year_vectorized(out, yr, index, active, lats, lons, lambda _id: reports(_id, yr))
+            continue
+        cols = [[array.array('i', [-1] * n) for fld in flds] for rank in range(fallback + 1)]
+        active_set = frozenset(active)
+        for i in range(n):
+            nearest_ids, backup_ids = nearest_stations(index, lats[i], lons[i], active_set.__contains__,
+                                                       flds, lambda _id: reports(_id, yr), fallback)
+            for k, fld in enumerate(flds):
+                if fld in nearest_ids:
+                    cols[0][k][i] = out.position(nearest_ids[fld])
+                for rank, _id in enumerate(backup_ids[fld]):
+                    cols[rank + 1][k][i] = out.position(_id)
+        for rank in range(fallback + 1):
+            for k, fld in enumerate(flds):
+                out.set_column(yr, fld, rank, cols[rank][k])
+    return out
+
+def assign_year_vectorized(out, yr, index, active, lats, lons, reports):
+    """ fill out's columns for yr: nearest by argmin over (location, station) distance blocks """
+    n, flds, fallback = out.n, out.flds, out.fallback
+    nearest = np.full((len(flds), n), -1, dtype=np.int32)
+    backups = np.full((len(flds), fallback, n), -1, dtype=np.int32)
+    if active:
+        pos = np.array([out.position(_id) for _id in active], dtype=np.int32)
+        pts = np.array([to_xyz(index.stns[_id]['lat'], index.stns[_id]['lon']) for _id in active])
+        # which active stations report each field
+        reported = [reports(_id) for _id in active]
+        masks = np.array([[fld in r for r in reported] for fld in flds], dtype=bool)
+        xyz = np.array([to_xyz(lat, lon) for lat, lon in zip(lats, lons)]).reshape(-1, 3)
+        block = max(1, BLOCK_CELLS // len(active))
+        for lo in range(0, n, block):
+            hi = min(n, lo + block)
+            p = xyz[lo:hi]
+            # squared chord distances, summed in the same order as StationIndex.iter_nearest(),
+            # so equal distances tie the same way: to the lower station id
+            d2 = (pts[None, :, 0] - p[:, 0, None]) ** 2 + (pts[None, :, 1] - p[:, 1, None]) ** 2 + (pts[None, :, 2] - p[:, 2, None]) ** 2
+            rows = np.arange(hi - lo)
+            # the fallback + 1 closest active stations, whatever they report
+            closest = np.zeros((hi - lo, fallback + 1), dtype=np.int64)
+            found = np.zeros((hi - lo, fallback + 1), dtype=bool)
+            left = d2.copy()
+            for rank in range(min(fallback + 1, len(active))):
+                j = left.argmin(axis=1)
+                closest[:, rank], found[:, rank] = j, np.isfinite(left[rows, j])
+                left[rows, j] = np.inf
+            for k in range(len(flds)):
+                masked = np.where(masks[k], d2, np.inf)
+                j = masked.argmin(axis=1)
+                has = np.isfinite(masked[rows, j])
+                nearest[k, lo:hi] = np.where(has, pos[j], -1)
+                if not fallback:
+                    continue
+                # backups: the closest stations other than the chosen one
+                chosen = np.where(has, j, -1)
+                skip = np.cumsum(closest == chosen[:, None], axis=1)[:, :fallback] > 0
+                take = np.where(skip, closest[:, 1:], closest[:, :fallback])
+                ok = np.where(skip, found[:, 1:], found[:, :fallback])
+                backups[k, :, lo:hi] = np.where(ok, pos[take], -1).T
+    for k, fld in enumerate(flds):
+        out.set_column(yr, fld, 0, array.array('i', nearest[k].tolist()))
+        for rank in range(fallback):
+            out.set_column(yr, fld, rank + 1, array.array('i', backups[k, rank].tolist()))
@@ -0,0 +1,115 @@
+"""
+Seek index for cached station-year files
+
+A gzip stream can only be inflated from its start, so reading one day out of a cached
+station-year used to mean inflating (and decoding) the whole year.  Raw ISD files are in time
+order, so build() rewrites a cached file once as a series of gzip members, each holding whole
+days and at least BLOCK_BYTES of raw text, and records the first day and byte offset of every
+member in <file>.idx.  The rewritten file is still an ordinary gzip file with the same content.
+A query for a few days then seeks to the member holding its first day, and inflates only until
+the member after its last day.
+
+(zlib's deflate checkpoints can't be restored from Python, which has no inflatePrime(), so
+members that start fresh stand in for them; the file grows by a few percent.)
+
+New observations of the current year are added to a cached file as one more member at its end
+(StationYearCache.append()), and to its index, so a day may then start in one member and
+continue in the next.  The index notes the size of the file it belongs to, so a file
+downloaded again whole is indexed again once it has been read for narrow date ranges a few more times.
+"""
+
+import os
+import json
+import zlib
+import struct
+import tempfile
+from bisect import bisect_left, bisect_right
+
+VERSION = 1
+# raw bytes per gzip member, at least (a few days of a busy station)
+BLOCK_BYTES = 64 * 1024
+# header of every member written: no file name, no mtime, so the same content gives the same bytes
+HEADER = '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+def index_path(path):
+    return path + '.idx'
+
+def gzip_member(data):
+    c = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return HEADER + c.compress(data) + c.flush() + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+
+class SeekIndex(object):
+    """
+    days: first YYYYMMDD of each member, in order
+    offsets: byte offset of each member
+    size: size of the indexed file
+    """
+    def __init__(self, days, offsets, size):
+        self.days = days
+        self.offsets = offsets
+        self.size = size
+
+    @classmethod
+    def load(cls, path):
+        """ the index of the file at 'path', or None if it has none or the file has changed since """
+        try:
+            with open(index_path(path)) as f:
+                meta = json.load(f)
+            with open(path, 'rb') as f:
+                header = f.read(len(HEADER))
+            size = os.path.getsize(path)
+        except (IOError, OSError, ValueError):
+            return None
+        if meta.get('version') != VERSION or meta.get('size') != size or header != HEADER:
+            return None
+        return cls(meta['days'], meta['offsets'], size)
+
+    def save(self, path):
+        """ write this as the index of the file at 'path' """
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dict(version=VERSION, size=self.size, days=self.days, offsets=self.offsets), f)
+        os.rename(tmp, index_path(path))
+
+    def span(self, start, end):
+        """ (offset, stop): the bytes holding every line dated start..end (YYYYMMDD strings) """
+        # a day may continue from the end of one member into the next (see StationYearCache.append())
+        lo = max(0, bisect_left(self.days, start) - 1)
+        hi = bisect_right(self.days, end)
+        return self.offsets[lo], self.offsets[hi] if hi < len(self.offsets) else self.size
+
+def build(path, lines):
+    """
+    rewrite the file at 'path', whose decompressed 'lines' are given, as one gzip member per
+    block of days, and index it -> SeekIndex, or None if its lines aren't in time order
+    """
+    days = [line[15:23] for line in lines]
+    if not lines or any(days[i] < days[i - 1] for i in range(1, len(days))):
+        return None
+    st = os.stat(path)
+    fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+    index = SeekIndex([], [], 0)
+    with os.fdopen(fd, 'wb') as f:
+        block, nbytes = [], 0
+        for i, line in enumerate(lines):
+            block.append(line)
+            nbytes += len(line) + 1
+            if nbytes >= BLOCK_BYTES and (i + 1 == len(lines) or days[i + 1] != days[i]):
+                index.days.append(days[i - len(block) + 1])
+                index.offsets.append(f.tell())
+                f.write(gzip_member('\n'.join(block) + '\n'))
+                block, nbytes = [], 0
+        if block:
+            index.days.append(days[len(lines) - len(block)])
+            index.offsets.append(f.tell())
+            f.write(gzip_member('\n'.join(block) + '\n'))
+        index.size = f.tell()
+    if os.path.getsize(path) != st.st_size:
+        # downloaded again meanwhile: leave the new file alone
+        os.remove(tmp)
+        return None
+    os.rename(tmp, path)
+    # mtime is when the file was last downloaded or revalidated (see stncache.py)
+    os.utime(path, (st.st_atime, st.st_mtime))
+    index.save(path)
+    return index
@@ -0,0 +1,477 @@
+"""
+Read NOAA's raw ISD (ISH) station-year files in-process
+
+Replaces the curl | gunzip | java ishJava pipeline.  The gzipped station-year stream is
+inflated in memory and each raw record is decoded directly, only for the fields that were
+asked for.  Decoded values match what slicing ishJava's abbreviated output used to give:
+stripped strings in the same units, with '*' for anything not reported.
+
+Cached files read for a few days at a time, again and again, get a seek index (gzindex.py), so
+only the part of the year asked for is inflated and decoded.
+
+Raw format documentation: ftp://ftp.ncdc.noaa.gov/pub/data/noaa/ish-format-document.pdf
+Reference implementation: static/ishJava.java
+"""
+
+import os
+import re
+import struct
+import zlib
+import sys
+
+from download import Downloader, NotFound, DownloadError
+from stats import STATS
+from gzindex import SeekIndex
+
+NOAA_URL = 'ftp://ftp.ncdc.noaa.gov/pub/data/noaa'
+CHUNK_SIZE = 64 * 1024
+# a cached file read for at most this many days INDEX_AFTER_READS times gets a seek index (see
+# gzindex.py).  building one costs more than a plain read, so a one-off query doesn't
+INDEX_MAX_DAYS = 92
+INDEX_AFTER_READS = 3
+
+# optional stncache.StationYearCache used by every fetch in this process (and forked workers)
+CACHE = None
+# optional obsstore.ObservationStore of decoded station-years (needs CACHE)
+STORE = None
+# download.Downloader for NOAA_URL, shared by every fetch in this process (see downloader())
+DOWNLOADER = None
+
+def downloader():
+    global DOWNLOADER
+    if DOWNLOADER is None or DOWNLOADER.base_url != NOAA_URL:
+        DOWNLOADER = Downloader(NOAA_URL)
+    return DOWNLOADER
+
+def station_year_path(stn, yr):
+    """ path of a station-year file relative to the mirror's base url """
+    return '{1}/{0}-{1}.gz'.format(stn, yr)
+
+def station_year_url(stn, yr, base_url=None):
+    return '{0}/{1}'.format(base_url or NOAA_URL, station_year_path(stn, yr))
+
+def station_ids_for_year(yr, base_url=None):
+    """ set of USAFID-WBAN ids with a file in NOAA's directory for year 'yr' """
+    dl = Downloader(base_url) if base_url else downloader()
+    try:
+        listing = "\n".join(dl.listdir(str(yr)))
+    except (NotFound, DownloadError):
+        listing = ''
+    return set(re.findall('[0-9]{6}-[0-9]{5}', listing))
+
+## decompression
+def read_chunks(fileobj, size=CHUNK_SIZE):
+    while True:
+        chunk = fileobj.read(size)
+        if not chunk:
+            break
+        yield chunk
+
+def read_span(fileobj, nbytes, size=CHUNK_SIZE):
+    """ chunks of the next 'nbytes' bytes of fileobj """
+    while nbytes > 0:
+        chunk = fileobj.read(min(size, nbytes))
+        if not chunk:
+            break
+        nbytes -= len(chunk)
+        yield chunk
+
+def gunzip_lines(chunks):
+    """
+    chunks: iterable of gzip-compressed byte strings (possibly several gzip members)
+
+    yields decompressed lines without line endings, as soon as each one is complete
+    """
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    buf = ''
+    for chunk in chunks:
+        data = []
+        while chunk:
+            data.append(d.decompress(chunk))
+            chunk = d.unused_data
+            if chunk:
+                # concatenated gzip members: start over on the next one
+                data.append(d.flush())
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        buf += ''.join(data)
+        lines = buf.split('\n')
+        buf = lines.pop()
+        for line in lines:
+            yield line.rstrip('\r')
+    buf += d.flush()
+    for line in buf.split('\n'):
+        if line.rstrip('\r'):
+            yield line.rstrip('\r')
+
+## numeric helpers that mimic ishJava's float / int arithmetic
+def _f32(x):
+    return struct.unpack('f', struct.pack('f', x))[0]
+
+def _to_fahrenheit(tenths_c):
+    if tenths_c < -178:
+        return int((tenths_c / 10.0) * 1.8 + 32.0 - .5)     # handle temps below 0F
+    return int((tenths_c / 10.0) * 1.8 + 32.0 + .5)
+
+def _to_mph(tenths_ms):
+    return int((tenths_ms / 10.0) * 2.237 + .5)
+
+def _element(line, tag, length, rem):
+    """ an additional-data element (e.g. 'AA1...') if it appears before the REM section """
+    i = line.find(tag)
+    if 0 <= i < rem:
+        return line[i:i+length]
+    return None
+
+## field decoders
+# each takes (raw record, offset of REM section) and returns {fld: value}
+def _dir(line, rem):
+    val = line[60:63]
+    if val == '999':
+        val = '*'
+    if line[64:65] == 'V':
+        val = '990'
+    return {'DIR': val}
+
+def _spd(line, rem):
+    val = line[65:69]
+    try:
+        return {'SPD': '*' if val == '9999' else str(_to_mph(int(val)))}
+    except ValueError:
+        return {'SPD': '*'}
+
+def _gus(line, rem):
+    el = _element(line, 'OC1', 8, rem)
+    if el is None or el[3:7] == '9999':
+        return {'GUS': '*'}
+    try:
+        return {'GUS': str(_to_mph(int(el[3:7])))}
+    except ValueError:
+        return {'GUS': '*'}
+
+def _clg(line, rem):
+    val = line[70:75]
+    try:
+        return {'CLG': '*' if val == '99999' else str(int(int(val) * 3.281 / 100.0 + .5))}
+    except ValueError:
+        return {'CLG': '*'}
+
+def _vsb(line, rem):
+    val = line[78:84]
+    if val == '999999':
+        return {'VSB': '*'}
+    try:
+        miles = _f32(_f32(float(val)) * _f32(0.000625))   # meters to miles, CDO's value
+    except ValueError:
+        return {'VSB': '*'}
+    if miles > 99.9:
+        miles = 99.0
+    if miles == _f32(10.058125):
+        miles = 10.0
+    return {'VSB': '%.1f' % miles}
+
+def _temp_fld(fld, sign_col, start, end):
+    def decode(line, rem):
+        val = line[start:end]
+        if val == '9999':
+            return {fld: '*'}
+        try:
+            tenths_c = int(val)
+        except ValueError:
+            return {fld: '*'}
+        if line[sign_col:sign_col+1] == '-':
+            tenths_c *= -1
+        return {fld: str(_to_fahrenheit(tenths_c))}
+    return decode
+
+def _slp(line, rem):
+    val = line[99:104]
+    try:
+        return {'SLP': '*' if val == '99999' else '%.1f' % _f32(_f32(float(val)) / 10.0)}
+    except ValueError:
+        return {'SLP': '*'}
+
+def _gf1(line, rem):
+    out = {'SKC': '*', 'L': '*', 'M': '*', 'H': '*'}
+    el = _element(line, 'GF1', 26, rem)
+    if el is None:
+        return out
+    skc = el[3:5]
+    if skc != '99':
+        try:
+            n = int(skc)
+            skc = {0: 'CLR', 1: 'SCT', 2: 'SCT', 3: 'SCT', 4: 'SCT', 5: 'BKN', 6: 'BKN', 7: 'BKN',
+                   8: 'OVC', 9: 'OBS', 10: 'POB'}.get(n, skc)
+            out['SKC'] = skc
+        except ValueError:
+            pass
+    for fld, (start, end) in [('L', (11, 13)), ('M', (20, 22)), ('H', (23, 25))]:
+        if el[start:end] != '99':
+            out[fld] = el[start+1:end] or '*'
+    return out
+
+def _weather_group(prefix):
+    # ishJava sorts the 4 present weather codes and reports them in descending order
+    flds = ['%s%d' % (prefix, n) for n in range(1, 5)]
+    def decode(line, rem):
+        codes = []
+        for fld in flds:
+            el = _element(line, fld, 6, rem)
+            codes.append(el[3:5] if el is not None and el[3:5] else '**')
+        codes.sort(reverse=True)
+        return {fld: code if '*' not in code else '*' for fld, code in zip(flds, codes)}
+    return decode
+
+def _ay1(line, rem):
+    el = _element(line, 'AY1', 8, rem)
+    return {'W': el[3:4] if el is not None and el[3:4] else '*'}
+
+def _ma1(line, rem):
+    out = {'ALT': '*', 'STP': '*'}
+    el = _element(line, 'MA1', 15, rem)
+    if el is None:
+        return out
+    alt, stp = el[3:8], el[9:14]
+    try:
+        if alt != '99999':
+            # hectopascals to inches
+            out['ALT'] = '%.2f' % _f32(_f32((_f32(float(alt)) / 10.0) * 100.0) / _f32(3386.39))
+    except ValueError:
+        pass
+    try:
+        if stp != '99999':
+            out['STP'] = '%.1f' % _f32(_f32(float(stp)) / 10.0)
+    except ValueError:
+        pass
+    return out
+
+def _ka(line, rem):
+    out = {'MAX': '*', 'MIN': '*'}
+    for tag in ['KA1', 'KA2']:
+        el = _element(line, tag, 13, rem)
+        if el is None or el[7:12] == '+9999':
+            continue
+        try:
+            temp = str(_to_fahrenheit(_f32(float(el[7:12]))))
+        except ValueError:
+            continue
+        if el[6:7] == 'N':
+            out['MIN'] = temp
+        elif el[6:7] == 'M':
+            out['MAX'] = temp
+    return out
+
+def _aa(line, rem):
+    out = {'PCP01': '*', 'PCP06': '*', 'PCP24': '*', 'PCPXX': '*'}
+    for tag in ['AA1', 'AA2', 'AA3', 'AA4']:
+        el = _element(line, tag, 11, rem)
+        if el is None or el[5:9] == '9999':
+            continue
+        try:
+            mm = _f32(float(el[5:9]))
+        except ValueError:
+            continue
+        inches = _f32(_f32(mm / _f32(10.0)) * _f32(.03937008))
+        out[{'01': 'PCP01', '06': 'PCP06', '24': 'PCP24'}.get(el[3:5], 'PCPXX')] = '%.2f' % inches
+    return out
+
+def _aj1(line, rem):
+    el = _element(line, 'AJ1', 17, rem)
+    if el is None or el[3:7] == '9999':
+        return {'SD': '*'}
+    try:
+        return {'SD': str(int(_f32(_f32(float(el[3:7])) * _f32(.3937008)) + .5))}
+    except ValueError:
+        return {'SD': '*'}
+
+# field -> decoder that produces it (some decoders produce a group of fields at once)
+DECODERS = {
+    'HR':   lambda line, rem: {'HR': line[23:25]},
+    'MN':   lambda line, rem: {'MN': line[25:27]},
+    'DIR':  _dir,
+    'SPD':  _spd,
+    'GUS':  _gus,
+    'CLG':  _clg,
+    'VSB':  _vsb,
+    'TEMP': _temp_fld('TEMP', 87, 88, 92),
+    'DEWP': _temp_fld('DEWP', 93, 94, 98),
+    'SLP':  _slp,
+    'W':    _ay1,
+    'SD':   _aj1,
+}
+for _group, _decoder in [(('SKC', 'L', 'M', 'H'), _gf1),
+                         (('MW1', 'MW2', 'MW3', 'MW4'), _weather_group('MW')),
+                         (('AW1', 'AW2', 'AW3', 'AW4'), _weather_group('AW')),
+                         (('ALT', 'STP'), _ma1),
+                         (('MAX', 'MIN'), _ka),
+                         (('PCP01', 'PCP06', 'PCP24', 'PCPXX'), _aa)]:
+    for _fld in _group:
+        DECODERS[_fld] = _decoder
+
+FIELDS = sorted(DECODERS)
+
+class ISDDecoder(object):
+    """
+    Decode raw ISD records into {'HR_TIME': 'YYYYMMDDHH', fld: value, ...} dicts,
+    running only the decoders needed for 'flds'
+    """
+    def __init__(self, flds):
+        unknown = [fld for fld in flds if fld not in DECODERS and fld != 'HR_TIME']
+        if unknown:
+            raise ValueError("fields not recognized: %s" % ", ".join(unknown))
+        self.flds = [fld for fld in flds if fld != 'HR_TIME']
+        self.decoders = []
+        for fld in self.flds:
+            if DECODERS[fld] not in self.decoders:
+                self.decoders.append(DECODERS[fld])
+
+    def decode(self, line):
+        rem = line.find('REM')
+        if rem == -1:
+            rem = len(line)
+        vals = {}
+        for decoder in self.decoders:
+            vals.update(decoder(line, rem))
+        obs = {fld: vals[fld] for fld in self.flds}
+        obs['HR_TIME'] = line[15:25]
+        return obs
+
+    def decode_lines(self, lines):
+        n = 0
+        try:
+            for line in lines:
+                if len(line) >= 105:
+                    n += 1
+                    yield self.decode(line)
+        finally:
+            STATS.count('lines_decoded', n)
+
+def fetch_station_year(stn, yr, flds, start=None, end=None):
+    """
+    stn: USAFID-WBAN station id
+    yr: int year
+    flds: fields to decode
+    start, end: optional dates; observations outside start..end may be skipped
+
+    yields decoded observation dicts for one station-year, in time order
+    """
+    if STORE is not None and CACHE is not None:
+        for obs in stored_station_year(stn, yr, flds, start, end):
+            yield obs
+        return
+    decoder = ISDDecoder(flds)
+    if CACHE is not None:
+        path = CACHE.fetch(stn, yr)
+        if path is None:
+            return
+        for obs in decoder.decode_lines(cached_lines(path, start, end)):
+            yield obs
+        return
+    try:
+        # read the file to the end before decoding: a caller holding several station-years open at
+        # once (observations.py merges them) would otherwise keep one connection per year, and
+        # block for good once there are more years than the downloader has connections
+        data = ''.join(downloader().chunks(station_year_path(stn, yr)))
+    except NotFound:
+        return
+    except DownloadError as e:
+        sys.stderr.write("download failed: %s\n" % e)
+        return
+    for obs in decoder.decode_lines(gunzip_lines([data])):
+        yield obs
+
+def cached_lines(path, start=None, end=None):
+    """
+    raw lines of a cached station-year file.  with start and end dates, only the gzip members
+    holding start..end are inflated once the file has a seek index, and only those lines are kept
+    """
+    index = SeekIndex.load(path) if start is not None and end is not None else None
+    if (index is None and start is not None and end is not None and (end - start).days < INDEX_MAX_DAYS
+            and CACHE.narrow_read(path) >= INDEX_AFTER_READS):
+        with STATS.timer('index_build'):
+            index = CACHE.build_index(path)
+        STATS.count('index_builds')
+    if index is None:
+        with open(path, 'rb') as f:
+            for line in gunzip_lines(read_chunks(f)):
+                yield line
+        return
+    STATS.count('index_reads')
+    first, last = "{:%Y%m%d}".format(start), "{:%Y%m%d}".format(end)
+    offset, stop = index.span(first, last)
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in gunzip_lines(read_span(f, stop - offset)):
+            day = line[15:23]
+            if day > last:
+                break
+            if day >= first:
+                yield line
+
+def prefetch(keys):
+    """
+    download (stn, yr) station-years into CACHE concurrently, over the downloader's connections.
+    yields each key once its file is available locally, in completion order
+    """
+    def fetch(key):
+        stn, yr = key
+        if STORE is not None and CACHE.is_closed(yr) and STORE.source_size(stn, yr) is not None:
+            return
+        CACHE.fetch(stn, yr)
+    for key, result, err in downloader().fetch_many(keys, fetch):
+        # on failure the decoding step just tries again itself
+        yield key
+
+def warm_station_year(stn, yr):
+    """
+    make one station-year ready to read locally: downloaded (or revalidated) into CACHE and, with
+    a STORE, decoded into it.  returns False if NOAA has no such file
+    """
+    source = STORE.source(stn, yr) if STORE is not None else None
+    if STORE is not None and source is not None and CACHE.is_closed(yr):
+        return True
+    # new entry, or the current year's file may have grown since it was stored
+    path = CACHE.fetch(stn, yr)
+    if path is None:
+        return False
+    if STORE is not None and (source is None or os.path.getsize(path) != source[0]):
+        with open(path, 'rb') as f:
+            data = f.read()
+        stored = STORE.entry_path(stn, yr)
+        before = os.path.getsize(stored) if os.path.exists(stored) else 0
+        update_store(stn, yr, data, source)
+        # the stored columns count against the cache's budget too
+        CACHE.evict(keep=path, added=(os.path.getsize(stored) if os.path.exists(stored) else 0) - before)
+    return True
+
+def stored_station_year(stn, yr, flds, start=None, end=None):
+    """ fetch_station_year() answered from STORE, decoding (all fields) into it first if needed """
+    if not warm_station_year(stn, yr):
+        return
+    STATS.count('store_reads')
+    CACHE.touch(STORE.entry_path(stn, yr))
+    cols = STORE.open(stn, yr)
+    try:
+        for obs in cols.observations(flds, start, end):
+            yield obs
+    finally:
+        cols.close()
+
+def update_store(stn, yr, data, source):
+    """
+    bring STORE's entry up to date with the cached file's bytes 'data'.  a file that only had
+    gzip members appended since it was stored (see StationYearCache.update()) has just those
+    decoded and appended; anything else is decoded whole
+    """
+    crc = zlib.crc32(data) & 0xffffffff
+    if source is not None and source[1] is not None and len(data) > source[0]:
+        size, source_crc = source
+        if zlib.crc32(data[:size]) & 0xffffffff == source_crc:
+            try:
+                observations = list(ISDDecoder(FIELDS).decode_lines(gunzip_lines([data[size:]])))
+                STORE.append(stn, yr, observations, len(data), crc)
+                STATS.count('store_appends')
+                return
+            except (zlib.error, KeyError):
+                pass
+    STATS.count('store_builds')
+    STORE.write(stn, yr, ISDDecoder(FIELDS).decode_lines(gunzip_lines([data])), len(data), crc)
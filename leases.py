@@ -0,0 +1,156 @@
+"""
+Leases on shared work, for workers coordinating through a directory
+
+Several noaahist.py --shard workers, on one host or on several sharing a filesystem, split a
+batch between them by taking leases on its pieces.  A lease is a small file, <key>.lease,
+created with O_EXCL so only one worker gets it, naming its owner and when it expires.  Finished
+pieces get <key>.done and are never handed out again.  A worker that dies leaves its lease to
+expire after 'lease_secs', and the first worker to see it expired takes the piece over: it
+renames the stale lease away first, which only one worker can do, so only one takes it.
+
+locked() holds the same kind of lease on a single file, <file>.lease, for a with block, waiting
+while another process holds it: stncache.py serializes writes to a cached entry with it.  The
+lease is renewed from a thread while the block runs, however long a download inside it takes, so
+it only expires once its holder is gone.
+
+Expiry compares wall clocks, so hosts sharing a directory should keep their clocks in sync
+(to well within 'lease_secs').
+"""
+
+import os
+import json
+import time
+import errno
+import socket
+import tempfile
+import threading
+from contextlib import contextmanager
+
+LEASE_SECS = 10 * 60
+# locked(): how long a lock left by a crashed process blocks the others, and how often they look.
+# a live holder renews its lock every LOCK_SECS / LOCK_RENEWALS
+LOCK_SECS = 5 * 60
+LOCK_RENEWALS = 3
+LOCK_POLL_SECS = 0.1
+
+def read_lease(path):
+    """ (owner, expires) from a lease file, or None """
+    try:
+        with open(path) as f:
+            lease = json.load(f)
+        return lease['owner'], lease['expires']
+    except (IOError, ValueError, KeyError):
+        return None
+
+class LeaseTable(object):
+    def __init__(self, path, owner=None, lease_secs=LEASE_SECS):
+        self.path = path
+        self.owner = owner or '%s-%d' % (socket.gethostname(), os.getpid())
+        self.lease_secs = lease_secs
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                pass    # another worker made it
+
+    def lease_path(self, key):
+        return os.path.join(self.path, key + '.lease')
+
+    def done_path(self, key):
+        return os.path.join(self.path, key + '.done')
+
+    def is_done(self, key):
+        return os.path.exists(self.done_path(key))
+
+    def holder(self, key):
+        """ (owner, expires) of the lease on 'key', or None if nobody holds one """
+        return read_lease(self.lease_path(key))
+
+    def claim(self, key):
+        """ take the lease on 'key' -> False if the piece is done or another worker holds it """
+        for attempt in range(2):
+            if self.is_done(key):
+                return False
+            try:
+                fd = os.open(self.lease_path(key), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                lease = self.holder(key)
+                try:
+                    # a lease still being written (or left empty by a crash) counts from its mtime
+                    expires = lease[1] if lease else os.path.getmtime(self.lease_path(key)) + self.lease_secs
+                except OSError:
+                    continue    # just released
+                if expires > time.time():
+                    return False
+                stale = '%s.stale-%s' % (self.lease_path(key), self.owner)
+                try:
+                    os.rename(self.lease_path(key), stale)
+                except OSError:
+                    return False    # another worker got there first
+                moved = read_lease(stale)
+                if moved is not None and moved[1] > time.time():
+                    # another worker took it over between our look and the rename: give it back
+                    try:
+                        os.link(stale, self.lease_path(key))
+                    except OSError:
+                        pass
+                    os.remove(stale)
+                    return False
+                os.remove(stale)
+                continue
+            with os.fdopen(fd, 'w') as f:
+                json.dump(dict(owner=self.owner, expires=time.time() + self.lease_secs), f)
+            # done while we were taking it over
+            if self.is_done(key):
+                self.release(key)
+                return False
+            return True
+        return False
+
+    def renew(self, key):
+        """ push back the expiry of a lease this worker holds """
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dict(owner=self.owner, expires=time.time() + self.lease_secs), f)
+        os.rename(tmp, self.lease_path(key))
+
+    def done(self, key):
+        """ mark 'key' finished, for good, and let go of its lease """
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.owner + "\n")
+        os.rename(tmp, self.done_path(key))
+        self.release(key)
+
+    def release(self, key):
+        """ let go of a lease without finishing, so another worker can take the piece """
+        lease = self.holder(key)
+        if lease is not None and lease[0] != self.owner:
+            return  # expired and taken over meanwhile
+        try:
+            os.remove(self.lease_path(key))
+        except OSError:
+            pass
+
+@contextmanager
+def locked(path, lease_secs=LOCK_SECS, poll_secs=LOCK_POLL_SECS):
+    """ hold the lock on the file at 'path' for the with block, waiting for it while another process has it """
+    locks = LeaseTable(os.path.dirname(path) or '.', lease_secs=lease_secs)
+    key = os.path.basename(path)
+    while not locks.claim(key):
+        time.sleep(poll_secs)
+    stop = threading.Event()
+    def heartbeat():
+        while not stop.wait(float(lease_secs) / LOCK_RENEWALS):
+            locks.renew(key)
+    renewer = threading.Thread(target=heartbeat)
+    renewer.daemon = True
+    renewer.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        renewer.join()
+        locks.release(key)
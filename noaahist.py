@@ -2,25 +2,42 @@
 
 import os
 import sys
-import re
 import time
 import datetime as dt
-from copy import deepcopy
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 import argparse
+from functools import partial
+import cProfile
+import hashlib
 from multiprocessing import Pool, cpu_count
 from subprocess import Popen, PIPE
 from math import radians, cos, sin, asin, sqrt
 
-# multiprocessing PickleError workaround
-def run_req(req):
-    req.get_response()
-    if req.meta:
-        req.set_metastr()
-    return (req.response_list, req.meta_str)
+import isd
+from isd import fetch_station_year, station_year_url
+from stncache import StationYearCache, StationListings, CACHE_DIR, CACHE_BYTES
+from stnindex import StationIndex, haversine_many
+from stncatalog import StationCatalog, write_catalog, CATALOG_PATH
+from obsstore import ObservationStore
+from download import Downloader, CONNECTIONS, RETRIES
+from stats import STATS, timer, init_worker
+from checkpoint import RunDirectory
+from leases import LeaseTable, LEASE_SECS
+from fldindex import FieldCoverage
+from geojoin import assign_stations, nearest_stations
+from rollup import Rollup, parse_reducers
+from zipgeo import coords_from_zip, coords_from_zips
+from columnar import ColumnarResponse
+
+# NOAA's per-year station directory listings, fetched at most once per run
+LISTINGS = StationListings()
+# optional directory for a cProfile dump of every station-year fetch (see run_fetch())
+PROFILE_DIR = None
+# fields each station reported, by year, where stnflds.py has scanned them
+COVERAGE = FieldCoverage()
 
 class WeatherDataRequest(object):
-    def __init__(self, start_date, end_date, lat, lon, flds, stns, meta, name=None):
+    def __init__(self, start_date, end_date, lat, lon, flds, stns, meta, name=None, index=None, fallback=0, assigned=None):
         ndays = (end_date-start_date).days
         # self.dates --> map each date to --> map each fld to a station _id
         self.dates = {date: {} for date in [end_date - dt.timedelta(days=n) for n in range(ndays,-1,-1)]}
@@ -28,84 +45,74 @@ class WeatherDataRequest(object):
         self.lon = float(lon)
         self.flds = flds
         self.name = name
-        # NOAA field explanations: ftp://ftp.ncdc.noaa.gov/pub/data/noaa/ish-abbreviated.txt
-        # *'s IN FIELD INDICATES ELEMENT NOT REPORTED
-        self.NOAA_fields = {
-            'HR_TIME':  [13,23], # YYYYMMDDHH
-            'HR':    [21,23], # GREENWICH MEAN TIME HOUR
-            'MN':    [23,25], # GREENWICH MEAN TIME MINUTES 
-            'DIR':   [26,29], # WIND DIRECTION IN COMPASS DEGREES, 990 = VARIABLE, REPORTED AS '***' WHEN AIR IS CALM (SPD WILL THEN BE 000)
-            'SPD':   [30,33], # WIND SPEED IN MILES PER HOUR 
-            'GUS':   [34,37], # GUST IN MILES PER HOUR 
-            'CLG':   [38,41], # CLOUD CEILING--LOWEST OPAQUE LAYER WITH 5/8 OR GREATER COVERAGE, IN HUNDREDS OF FEET, 722 = UNLIMITED 
-            'SKC':   [42,45], # SKY COVER -- CLR-CLEAR, SCT-SCATTERED-1/8 TO 4/8, BKN-BROKEN-5/8 TO 7/8, OVC-OVERCAST, OBS-OBSCURED, POB-PARTIAL OBSCURATION
-            'L':     [46,47], # LOW CLOUD TYPE
-            'M':     [48,49], # MEDIUM CLOUD TYPE
-            'H':     [50,51], # HIGH CLOUD TYPE
-            'VSB':   [52,56], # VISIBILITY IN STATUTE MILES TO NEAREST TENTH
-            'MW1':   [57,59], # MANUALLY OBSERVED PRESENT WEATHER (see table on website listed above for detail)
-            'MW2':   [60,62], #
-            'MW3':   [63,65], #
-            'MW4':   [66,68], #
-            'AW1':   [69,71], # AUTO-OBSERVED PRESENT WEATHER (see table on website listed above for detail)
-            'AW2':   [72,74], #
-            'AW3':   [75,77], #
-            'AW4':   [78,80], #
-            'W':     [81,82], # PAST WEATHER INDICATOR
-            'TEMP':  [83,87], # TEMPERATURE IN FARENHEIT
-            'DEWP':  [88,92], # DEWPOINT IN FARENHEIT
-            'SLP':   [93,99], # SEA LEVEL PRESSURE IN MILLIBARS TO NEAREST TENTH
-            'ALT':   [100,105], # ALTIMETER SETTING IN INCHES TO NEAREST HUNDREDTH
-            'STP':   [106,112], # STATION PRESSURE IN MILLIBARS TO NEAREST TENTH
-            'MAX':   [113,116], # MAXIMUM TEMPERATURE IN FAHRENHEIT (TIME PERIOD VARIES)
-            'MIN':   [117,120], # MINIMUM TEMPERATURE IN FAHRENHEIT (TIME PERIOD VARIES)
-            'PCP01': [121,126], # 1-HOUR LIQUID PRECIP REPORT IN INCHES AND HUNDREDTHS -- THAT IS, THE PRECIP FOR THE PRECEDING 1 HOUR PERIOD
-            'PCP06': [127,132], # 6-HOUR LIQUID PRECIP REPORT IN INCHES AND HUNDREDTHS -- THAT IS, THE PRECIP FOR THE PRECEDING 6 HOUR PERIOD
-            'PCP24': [133,138], # 24-HOUR LIQUID PRECIP REPORT IN INCHES AND HUNDREDTHS -- THAT IS, THE PRECIP FOR THE PRECEDING 24 HOUR PERIOD
-            'PCPXX': [139,144], # LIQUID PRECIP REPORT IN INCHES AND HUNDREDTHS, FOR A PERIOD OTHER THAN 1, 6, OR 24 HOURS (USUALLY FOR 12 HOUR PERIOD FOR STATIONS OUTSIDE THE U.S., AND FOR 3 HOUR PERIOD FOR THE U.S.) T = TRACE FOR ANY PRECIP FIELD
-            'SD':    [145,147], # SNOW DEPTH IN INCHES
-            }
         self.stns = stns
         self.meta = meta  # flag for whether to get metadata
         self.meta_str = None
         # station _id maps to -->  names / dists in miles from location
         self.stns_metadata = defaultdict(dict)
+        # fallback: how many next-nearest stations may fill in hours / fields the chosen station didn't report.
+        # self.fallbacks maps date -> fld -> [backup station _ids, nearest first]
+        self.fallback = fallback
+        self.fallbacks = {date: {} for date in self.dates}
+        # (stn, yr) -> fld -> rank of the station for that field (0: chosen station, 1..: backups)
+        self.ranks = defaultdict(dict)
 
         # get mapping of date to closest station with data, by month
-        lastdate, cand_ids, actual_ids = None, [],  []
+        if index is None and assigned is None:
+            index = StationIndex(stns)
+        with timer('resolve'):
+            self.resolve(index, assigned)
+        # columnar.ColumnarResponse, made by new_response() when the first station-year arrives
+        self.response = None
+        self.response_list = None
+    # __init__() ENDS
+
+    def resolve(self, index, assigned=None):
+        """
+        pick the closest station with data for every date * field, via 'index', or from
+        'assigned': yr -> (nearest_ids, backup_ids), e.g. a geojoin.StationAssignment's picks
+        """
+        lastdate, actual_ids = None, set()
         for d in sorted([date for date in self.dates]):
             if (not lastdate) or d.year != lastdate.year:
                 # some stations have gaps in data.  find stations that acutally exist for this year on NOAA's site
-                print "\nretrieving list of stations for year: %s ... \n" % str(d.year)
-                p1 = Popen(['curl','ftp://ftp.ncdc.noaa.gov/pub/data/noaa/%s/' % str(d.year)], stdout=PIPE)
-                p2 = Popen(['grep','-o','[0-9]\{6\}-[0-9]\{5\}'], stdin=p1.stdout, stdout=PIPE)
-                actual_ids = p2.communicate()[0].split("\n")[:-1]
+                if assigned is None:
+                    actual_ids = LISTINGS.ids(d.year)
             
-                cand_ids = [_id for _id in self.stns if
-                            self.stns[_id]['sd'] < d and
-                            self.stns[_id]['ed'] > d and
-                            _id in actual_ids]
                 # get closest station with each field for this date
-                # first sort candidate _ids by distance to the location
-                cand_ids_sorted = sorted(cand_ids, key=lambda cand_id: haversine(self.lat, self.lon,
-                                                                                 stns[cand_id]['lat'], stns[cand_id]['lon']))
+                # walk candidate _ids outward from the location until every field has a station
+                # (and, with fallback, the next-nearest stations after it, whatever stn_flds.txt says),
+                # unless a batch geo-join already picked them
+                if assigned is not None:
+                    nearest_ids, backup_ids = assigned(d.year)
+                else:
+                    nearest_ids, backup_ids = nearest_stations(index, self.lat, self.lon, index.active(date=d, listed=actual_ids),
+                                                               self.flds, lambda _id: station_flds(self.stns, _id, d.year), self.fallback)
                 for fld in self.flds:
-                    found = False
-                    for cand_id in cand_ids_sorted:
-                        if fld in self.stns[cand_id]['flds']:
-                            _id = cand_id
-                            found = True
-                            break
+                    found = fld in nearest_ids
+                    _id = nearest_ids.get(fld)
+                    # backups only count after the chosen station
+                    backups = backup_ids[fld] if not found else [b for b in backup_ids[fld] if b != _id]
 
                     if found:
                         # store the station _id from which to pull data for this date * field combination
                         self.dates[d][fld] = _id
-                        
-                        if _id not in self.stns_metadata:
-                            self.stns_metadata[_id]['dist'] = haversine(self.lat, self.lon, self.stns[_id]['lat'], self.stns[_id]['lon'])
-                            self.stns_metadata[_id]['name'] = self.stns[_id]['name']
-                    else:
-                        print "\n\nWARNING: no data found for fld=< {0} > for date=< {1} >\n".format(fld, "{:%Y-%m-%d}".format(d))
+                        self.ranks[(_id, d.year)][fld] = 0
+                    if backups:
+                        self.fallbacks[d][fld] = backups
+                        for rank, b in enumerate(backups):
+                            self.ranks[(b, d.year)][fld] = rank + 1
+                    for stn in ([_id] if found else []) + backups:
+                        if stn not in self.stns_metadata:
+                            self.stns_metadata[stn]['name'] = self.stns[stn]['name']
+                    if not found:
+                        print "\n\nWARNING: no station known to report fld=< {0} > for date=< {1} >\n".format(fld, "{:%Y-%m-%d}".format(d))
+                        if self.fallback:
+                            # non-interactive: the backups fill in whatever they actually reported
+                            continue
+                        if not sys.stdin.isatty():
+                            # nobody to ask (e.g. a batch job): leave the field empty and carry on
+                            continue
                         keep_going = raw_input("Proceed anyhow? [y/n]\n")
                         if keep_going and keep_going[0].lower() == 'y':
                             pass
@@ -113,75 +120,111 @@ class WeatherDataRequest(object):
                             sys.exit("noaahist.py process has been terminated.")
             # else clause -> triggered if we are NOT in a new year, so most of the time
             else:
-                for fld in self.flds:
-                    self.dates[d][fld] = self.dates[lastdate][fld]
+                self.dates[d] = dict(self.dates[lastdate])
+                self.fallbacks[d] = dict(self.fallbacks[lastdate])
             # store the current date in lastdate for reference later
             lastdate = d
+        # miles to every station used, in one pass
+        used = sorted(self.stns_metadata)
+        dists = haversine_many(self.lat, self.lon, [self.stns[stn]['lat'] for stn in used], [self.stns[stn]['lon'] for stn in used])
+        for stn, dist in zip(used, dists):
+            self.stns_metadata[stn]['dist'] = float(dist)
                         
         # self.dates maps:   date -> fld -> stn _id
         # when pulling the data, getting a year of each station is the bottleneck
         # want to map:  stn -> date -> flds   for convenient data parsing.
         self.stn_date_flds = {}
         for date in self.dates:
-            for field in self.dates[date]:
-                stn = self.dates[date][field]
+            pairs = [(self.dates[date][field], field) for field in self.dates[date]]
+            pairs += [(stn, field) for field in self.fallbacks[date] for stn in self.fallbacks[date][field]]
+            for stn, field in pairs:
                 if stn not in self.stn_date_flds:
                     self.stn_date_flds[stn] = {}
                 if date not in self.stn_date_flds[stn]:
                     self.stn_date_flds[stn][date] = []
                 self.stn_date_flds[stn][date].append(field)
-    # __init__() ENDS
                     
-    def get_response(self):
-        self.response = {}
-        # loop over Request stations
+    def station_years(self):
+        """ {(stn, yr): [flds]} -> the station-year files this request needs, and which fields from each """
+        out = defaultdict(set)
         for stn in self.stn_date_flds:
-            yrs = set([d.year for d in self.stn_date_flds[stn]])
-            # loop over years this station
-            for yr in yrs:
-                yrdates = [d for d in self.stn_date_flds[stn] if d.year == yr]
-                
-                # get the data for this stn * yr combo
-                # fetch, uncompress, reformat, and read data file from NOAA
-                url = 'ftp://ftp.ncdc.noaa.gov/pub/data/noaa/{0}/{1}-{0}.gz'.format(yr, stn)
-                print '\nretrieving url: %s ... \n' % url 
-                p1 = Popen(["curl", url], stdout=PIPE)
-                p2 = Popen(["gunzip"], stdin=p1.stdout, stdout=PIPE)
-                p3 = Popen(['java', '-classpath', 'static', 'ishJava'], stdin=p2.stdout, stdout=PIPE)
-                data = p3.communicate()[0].split("\n")[1:-1]
-                print '\n'
-
-                # filter out lines for dates/times outside the query period
-                data = [x for x in data if datestr_to_dt(x[13:21]) in yrdates]
-
-                # loop over each day in the Request period
-                for date in yrdates:
-                    # subset to individual day of data
-                    day_data = [x for x in data if datestr_to_dt(x[13:21]) == date]
-                    # static data
-                    line = dict(DATE=''.join(map(lambda x: str(x).zfill(2), [date.year, date.month, date.day])),
-                                LAT=self.lat, LON=self.lon, USAFID_WBAN=stn, DIST=self.stns_metadata[stn]['dist'],
-                                STN_NAME=self.stns_metadata[stn]['name'])
-                    if self.name:
-                        line['NAME'] = self.name
-                    # hrly: separate line for each observation
-                    for obs in day_data:
-                        # index lines on YYYYMMDDHH -> one per hour
-                        hr_time = obs[self.NOAA_fields['HR_TIME'][0] : self.NOAA_fields['HR_TIME'][1]]
-                        if hr_time not in self.response:
-                            self.response[hr_time] = deepcopy(line)
-                            # include HR_TIME field in 'line' data
-                            self.response[hr_time]['HR_TIME'] = hr_time
-                        for fld in self.stn_date_flds[stn][date]:
-                            # get value and do *minimal* processing on it
-                            val = obs[self.NOAA_fields[fld][0]:self.NOAA_fields[fld][1]].strip()
-                            if len(val) == 0:
-                                val = "*"
-                            val = re.sub("\*+", "*", val)
-                            self.response[hr_time][fld] = val
-                        
-        hr_times = sorted(self.response.keys())
-        self.response_list = [self.response[hrt] for hrt in hr_times]
+            for date in self.stn_date_flds[stn]:
+                out[(stn, date.year)].update(self.stn_date_flds[stn][date])
+        return {key: sorted(out[key]) for key in out}
+
+    def new_response(self):
+        """ start an empty self.response, for add_observations() to fill """
+        self.response = ColumnarResponse(min(self.dates), max(self.dates), self.flds, self.lat, self.lon,
+                                         self.name, self.fallback)
+        self.response_list = None
+
+    def add_observations(self, stn, yr, observations):
+        """ merge decoded observations from one station-year file into self.response """
+        if self.response is None:
+            # the columns cover the whole date range: only allocate them once there is data to hold
+            self.new_response()
+        with timer('build_rows'):
+            self._add_observations(stn, yr, observations)
+
+    def _add_observations(self, stn, yr, observations):
+        resp = self.response
+        # YYYYMMDD -> fields taken from stn that day
+        day_flds = {"{:%Y%m%d}".format(date): flds for date, flds in self.stn_date_flds[stn].items() if date.year == yr}
+        ranks = self.ranks.get((stn, yr), {})
+        for obs in observations:
+            hr_time = obs['HR_TIME']
+            flds = day_flds.get(hr_time[:8])
+            # filter out observations for dates outside the query period
+            if flds is None:
+                continue
+            # one row per hour, YYYYMMDDHH
+            h = resp.hour(hr_time)
+            if self.fallback:
+                # station-years arrive in any order: keep the best-ranked station that reported a value
+                flds = [fld for fld in flds if self.fills(h, fld, ranks.get(fld, 0), obs[fld])]
+                if not flds:
+                    continue
+            resp.add_row(h)
+            for fld in flds:
+                resp.set(h, fld, obs[fld])
+                if self.fallback:
+                    resp.set_filled(h, fld, ranks.get(fld, 0), stn)
+
+    def fills(self, h, fld, rank, val):
+        """ should 'val' from a station of rank 'rank' replace what self.response has for hour h * fld? """
+        current = self.response.filled_rank(h, fld)
+        if current is None:
+            # backups only add values, never '*'
+            return rank == 0 or val != '*'
+        if val == '*':
+            return False
+        return rank < current or not self.response.is_set(h, fld)
+
+    def substitutions(self):
+        """ {(fld, stn): [dates]} for values filled in by backup stations """
+        out = defaultdict(set)
+        for h, fld, stn in self.response.backup_values():
+            out[(fld, stn)].add(datestr_to_dt(self.response.hr_time(h)))
+        return {key: sorted(out[key]) for key in out}
+
+    def set_response_list(self):
+        # the rows, in time order, are the columnar response itself
+        if self.response is None:
+            self.new_response()
+        self.response_list = self.response
+
+    def get_response(self):
+        self.response = None
+        # loop over Request station-years
+        for (stn, yr), flds in sorted(self.station_years().items()):
+            # get the data for this stn * yr combo
+            # fetch, uncompress and decode the raw data file from NOAA
+            print '\nretrieving url: %s ... \n' % station_year_url(stn, yr)
+            yrdates = [d for d in self.stn_date_flds[stn] if d.year == yr]
+            with timer('fetch_decode'):
+                observations = list(fetch_station_year(stn, yr, flds, min(yrdates), max(yrdates)))
+            self.add_observations(stn, yr, observations)
+        self.set_response_list()
 
     def run(self):
         self.get_response()
@@ -231,7 +274,200 @@ class WeatherDataRequest(object):
                 lines += date_ranges_to_lines(fld, stn, ranges)
         
         self.meta_str = "FLD|STATION_NAME|STATION_ID|START_DATE|END_DATE|MILES_FROM_LOC|QUERY_NAME\n"+"".join(lines) + "\n"
+
+        # values filled in from backup stations (--fallback)
+        subs = self.substitutions()
+        if subs:
+            lines = []
+            for (fld, stn) in sorted(subs):
+                lines += date_ranges_to_lines(fld, stn, reduce_dates(subs[(fld, stn)]))
+            self.meta_str += "SUBSTITUTED_FLD|STATION_NAME|STATION_ID|START_DATE|END_DATE|MILES_FROM_LOC|QUERY_NAME\n" + "".join(lines) + "\n"
         
+def run_fetch(task):
+    """
+    fetch and decode one station-year, keeping only the observations on 'datestrs' (YYYYMMDD).
+    also hands back the stats recorded meanwhile, since this may run in a Pool worker
+    """
+    (stn, yr, flds, datestrs) = task
+    print '\nretrieving url: %s ... \n' % station_year_url(stn, yr)
+    prof = None
+    if PROFILE_DIR:
+        prof = cProfile.Profile()
+        prof.enable()
+    with timer('fetch_decode'):
+        observations = list(fetch_station_year(stn, yr, flds, datestr_to_dt(min(datestrs)), datestr_to_dt(max(datestrs))))
+    with timer('filter'):
+        observations = [obs for obs in observations if obs['HR_TIME'][:8] in datestrs]
+    if prof is not None:
+        prof.disable()
+        prof.dump_stats(os.path.join(PROFILE_DIR, '%s-%s.prof' % (stn, yr)))
+    return (stn, yr, observations, STATS.take())
+
+# typical size of a station-year file, for weighing tasks that aren't in the cache yet
+TYPICAL_FILE_BYTES = 512 * 1024
+
+class FetchPlan(object):
+    """
+    Plan the station-year downloads for a whole batch of WeatherDataRequests
+
+    Requests near each other usually resolve to the same stations.  Every (station, year) needed by
+    any request is fetched and decoded exactly once, for the union of the fields and dates requested
+    from it, and the observations are then handed to each request that needs them.
+
+    With a Pool, station-year tasks are handed out one at a time (chunksize 1) to whichever worker
+    is free, largest first, so one request spanning many years is spread over every worker and the
+    long tasks don't end up at the tail.  Assembling rows per request stays in the parent.
+
+    With a Rollup, each request's hourly rows are replaced by its daily / monthly rows as it completes.
+    """
+    def __init__(self, reqs, rollup=None):
+        self.reqs = reqs
+        self.rollup = rollup
+        # (stn, yr) -> set of fields / set of YYYYMMDD strings / requests
+        self.flds = defaultdict(set)
+        self.datestrs = defaultdict(set)
+        self.users = defaultdict(list)
+        for req in reqs:
+            for (stn, yr), flds in req.station_years().items():
+                self.flds[(stn, yr)].update(flds)
+                self.datestrs[(stn, yr)].update("{:%Y%m%d}".format(d) for d in req.stn_date_flds[stn] if d.year == yr)
+                self.users[(stn, yr)].append(req)
+
+    def cost(self, key):
+        """ rough relative cost of fetching and decoding a station-year """
+        stn, yr = key
+        nflds = len(self.flds[key])
+        if isd.CACHE is None:
+            return TYPICAL_FILE_BYTES * nflds
+        if isd.STORE is not None and isd.CACHE.is_closed(yr) and isd.STORE.source_size(stn, yr) is not None:
+            # answered from the column store: only the rows in range are read
+            return len(self.datestrs[key]) * nflds
+        try:
+            size = os.path.getsize(isd.CACHE.entry_path(stn, yr))
+        except OSError:
+            size = TYPICAL_FILE_BYTES
+        # the whole file is decoded, for each field asked for
+        return size * nflds
+
+    def tasks(self, largest_first=False):
+        """
+        [(stn, yr, flds, datestrs), ...] -> station-years of earlier requests first, so requests
+        complete (and can be written) in order, or the most costly first for a Pool to balance
+        """
+        if largest_first:
+            keys = sorted(self.users, key=lambda key: (-self.cost(key), key))
+        else:
+            first_user = {}
+            for i, req in enumerate(self.reqs):
+                for key in req.station_years():
+                    first_user.setdefault(key, i)
+            keys = sorted(self.users, key=lambda key: (first_user[key], key))
+        return [(stn, yr, sorted(self.flds[(stn, yr)]), self.datestrs[(stn, yr)]) for (stn, yr) in keys]
+
+    def stream(self, pool=None):
+        """
+        fetch every station-year once, fan observations out to requests, and yield
+        (req, response_list, meta_str) for each request as soon as its last station-year is in.
+        each request's rows are only allocated once its first station-year is in, and released once yielded
+        """
+        pending = {}
+        for req in self.reqs:
+            req.response = req.response_list = None
+            pending[id(req)] = len(req.station_years())
+        def finish(req):
+            req.set_response_list()
+            if req.meta:
+                req.set_metastr()
+            rows = req.response_list
+            if self.rollup is not None:
+                with timer('rollup'):
+                    rows = self.rollup.apply(rows, req.flds)
+            out = (req, rows, req.meta_str)
+            req.response = req.response_list = None
+            return out
+        for req in self.reqs:
+            if not pending[id(req)]:
+                yield finish(req)
+        tasks = self.tasks(largest_first=pool is not None)
+        if isd.CACHE is not None:
+            # download into the cache over several connections at once; each station-year is
+            # decoded as soon as its file is in, while the rest are still downloading
+            by_key = {task[:2]: task for task in tasks}
+            tasks = (by_key[key] for key in isd.prefetch([task[:2] for task in tasks]))
+        results = pool.imap_unordered(run_fetch, tasks, 1) if pool else (run_fetch(task) for task in tasks)
+        for (stn, yr, observations, stats) in results:
+            STATS.merge(stats)
+            for req in self.users[(stn, yr)]:
+                req.add_observations(stn, yr, observations)
+                pending[id(req)] -= 1
+                if not pending[id(req)]:
+                    yield finish(req)
+
+    def run(self, pool=None):
+        """ fetch every station-year once, fan observations out to requests -> [(response_list, meta_str), ...] """
+        resps = {id(req): (resp, meta_str) for req, resp, meta_str in self.stream(pool)}
+        return [resps[id(req)] for req in self.reqs]
+
+def run_warm(key):
+    """ download / decode one station-year into the shared cache; hands back the stats recorded meanwhile """
+    isd.warm_station_year(*key)
+    return key, STATS.take()
+
+# requests leased to a --shard worker at a time
+SHARD_CHUNK = 16
+
+def run_shard(reqs, keys, run_dir, leases, rollup=None, pool=None, chunk=SHARD_CHUNK):
+    """
+    do one --shard worker's share of a batch that several workers split between them through
+    'leases', every worker on the same infile, --run-dir and --cache-dir.
+
+    first the station-years the unfinished requests need are downloaded (and decoded into the
+    store) into the shared cache, each by whichever worker leases it first.  then the requests, in
+    chunks of 'chunk' infile lines, are leased the same way, and each finished request is saved to
+    'run_dir' as its part.  a worker that dies leaves its leases to expire, and its unfinished pieces
+    are taken over.  --merge writes the output from the parts once they are all in.
+
+    keys: id(req) -> (part key, infile line)
+    returns (station-years, requests) done by this worker
+    """
+    todo = [req for req in reqs if not run_dir.done(keys[id(req)][0])]
+    warmed = finished = 0
+    if isd.CACHE is not None:
+        # most costly first, a downloader's worth of connections at a time
+        pending = [task[:2] for task in FetchPlan(todo).tasks(largest_first=True)]
+        step = isd.downloader().connections
+        for i in range(0, len(pending), step):
+            claimed = [key for key in pending[i:i + step] if leases.claim('sy-%s-%s' % key)]
+            try:
+                for key in isd.prefetch(claimed):
+                    pass
+                results = pool.imap_unordered(run_warm, claimed, 1) if pool else (run_warm(key) for key in claimed)
+                for key, stats in results:
+                    STATS.merge(stats)
+                    leases.done('sy-%s-%s' % key)
+                    warmed += 1
+            finally:
+                for key in claimed:
+                    leases.release('sy-%s-%s' % key)
+    # chunks of the whole batch, so every worker cuts it the same way whatever it finds done
+    for i in range(0, len(reqs), chunk):
+        group = reqs[i:i + chunk]
+        lease = 'req-' + hashlib.sha1("\n".join(keys[id(req)][0] for req in group)).hexdigest()
+        if not leases.claim(lease):
+            continue
+        try:
+            group = [req for req in group if not run_dir.done(keys[id(req)][0])]
+            for req, resp, meta_str in FetchPlan(group, rollup).stream(pool):
+                run_dir.save(keys[id(req)][0], keys[id(req)][1], resp, meta_str)
+                leases.renew(lease)
+                finished += 1
+            leases.done(lease)
+        finally:
+            leases.release(lease)
+    STATS.count('shard_station_years', warmed)
+    STATS.count('shard_requests', finished)
+    return warmed, finished
+
 class AllWeatherMetadata(object):
     def __init__(self, meta_str_list):
         self.meta_str_list = meta_str_list
@@ -239,31 +475,75 @@ class AllWeatherMetadata(object):
     def write(self, dest):
         dest.writelines(self.meta_str_list)
         
+# sensible order of output fields
+FLD_ORDER = ['NAME','HR_TIME',
+             'LAT','LON',                                        # metadata
+             'TEMP','MIN','MAX','DEWP',                          # temperature
+             'DIR','SPD','GUS',                                  # wind
+             'PCP01','PCPXX','PCP06','PCP24','SD',               # precipitation
+             'SKC','CLG','L','M','H',                            # sky conditions
+             'AW1','AW2','AW3','AW4','MW1','MW2','MW3','MW4',    # see table
+             'SLP','STP',                                        # pressure
+             'ALT','VSB', 'W',]
+
 class AllWeatherResponses(object):
-    def __init__(self, resp_dicts_list):
+    def __init__(self, resp_dicts_list, fld_order=FLD_ORDER):
         # response: dict(req_lat:lat_tuple, req_lon:lon_tuple, stn_dist:dist_tuple, dates:date_tuple, fld1:fld1_tuple, ...)
+        # each response: a ColumnarResponse, or a list of row dicts (e.g. rolled up, or from a --run-dir part)
         self.responses = resp_dicts_list
-        self.all_flds = set([key for resp in self.responses for key in resp[0].keys()])
+        self.all_flds = set([key for resp in self.responses if resp for key in response_flds(resp)])
         # make order of fields sensible
-        self.fld_names = [fld for fld in ['NAME','HR_TIME',
-                                          'LAT','LON',                                        # metadata
-                                          'TEMP','MIN','MAX','DEWP',                          # temperature
-                                          'DIR','SPD','GUS',                                  # wind
-                                          'PCP01','PCPXX','PCP06','PCP24','SD',               # precipitation
-                                          'SKC','CLG','L','M','H',                            # sky conditions
-                                          'AW1','AW2','AW3','AW4','MW1','MW2','MW3','MW4',    # see table
-                                          'SLP','STP',                                        # pressure
-                                          'ALT','VSB', 'W',] if fld in self.all_flds]
+        self.fld_names = [fld for fld in fld_order if fld in self.all_flds]
         self.lines = [','.join(self.fld_names) + "\n"]
         
     def format_line(self, obs_dict):
         return ",".join(map(lambda x: str(round(x,2)) if type(x)==float else str(x),
                             [obs_dict[fld] if obs_dict.get(fld) is not None else '*' for fld in self.fld_names])) + "\n"
 
+    def format_lines(self, resp):
+        if isinstance(resp, ColumnarResponse):
+            # rendered straight from the columns
+            return resp.csv_lines(self.fld_names)
+        return map(self.format_line, resp)
+
     def write(self, dest):
-        for resp in self.responses:
-            self.lines += map(self.format_line, resp)
-        dest.writelines(self.lines)
+        with timer('write'):
+            for resp in self.responses:
+                self.lines += self.format_lines(resp)
+                STATS.count('rows_written', len(resp))
+            dest.writelines(self.lines)
+
+def response_flds(resp):
+    """ the columns a non-empty response's rows have """
+    if isinstance(resp, ColumnarResponse):
+        return resp.fld_names()
+    return resp[0].keys()
+
+def requested_fld_names(reqs, rollup=None):
+    """ output columns for a batch, in FLD_ORDER (rolled up, with a Rollup), known before any data arrives """
+    all_flds = set(['HR_TIME', 'LAT', 'LON'] + [fld for req in reqs for fld in req.flds])
+    if any(req.name for req in reqs):
+        all_flds.add('NAME')
+    fld_names = [fld for fld in FLD_ORDER if fld in all_flds]
+    return rollup.columns(fld_names) if rollup is not None else fld_names
+
+class StreamingWeatherResponses(AllWeatherResponses):
+    """
+    Write each request's rows as soon as it completes, instead of holding the whole batch
+
+    The header comes from the requested fields, so it can be written before any data arrives.
+    """
+    def __init__(self, reqs, dest, rollup=None):
+        self.fld_names = requested_fld_names(reqs, rollup)
+        self.all_flds = set(self.fld_names)
+        self.dest = dest
+        self.dest.write(','.join(self.fld_names) + "\n")
+
+    def write_response(self, resp):
+        with timer('write'):
+            self.dest.writelines(self.format_lines(resp))
+            self.dest.flush()
+        STATS.count('rows_written', len(resp))
 
 ## Command line argument validation
 def date_action():
@@ -360,11 +640,19 @@ def haversine(lat1, lon1, lat2, lon2):
     km = 6367 * c
     return km * 0.621371
 
-def req_from_infile_line(line, stns, meta):
+def station_flds(stns, _id, yr):
+    """ fields station _id reported in year yr if that year has been scanned, else what stn_flds.txt says """
+    flds = COVERAGE.flds(_id, yr)
+    return stns[_id]['flds'] if flds is None else flds
+
+INFILE_ERROR = "Error parsing infile\nExample infile:\n\nLasVegas|19710321,19710323|89109|WSPD,TEMP\nWoodyCreek_CO|20050220|39.270833,-106.886111|BARP,VISD\n\n"
+
+def parse_infile_line(line):
+    """ infile line -> (name, start date, end date, lat, lon, [flds]) """
     try:
         [name, dates, loc, flds] = map(lambda x: x.strip(), line.strip().split("|"))
     except:
-        sys.exit("Error parsing infile\nExample infile:\n\nLasVegas|19710321,19710323|89109|WSPD,TEMP\nWoodyCreek_CO|20050220|39.270833,-106.886111|BARP,VISD\n\n")
+        sys.exit(INFILE_ERROR)
     try:
         [sd, ed] = map(datestr_to_dt, dates.split(','))
     except ValueError:
@@ -374,7 +662,34 @@ def req_from_infile_line(line, stns, meta):
     except ValueError:
         lat, lon = coords_from_zip(loc)
     flds = flds.split(',')
-    return WeatherDataRequest(sd, ed, lat, lon, flds, stns, meta, name)
+    return name, sd, ed, float(lat), float(lon), flds
+
+# what writing a request's saved --run-dir part needs of it (see --merge)
+RequestLine = namedtuple('RequestLine', ['name', 'flds'])
+
+def request_line(line):
+    """ infile line -> RequestLine, without looking up its location or stations """
+    try:
+        [name, dates, loc, flds] = map(lambda x: x.strip(), line.strip().split("|"))
+    except ValueError:
+        sys.exit(INFILE_ERROR)
+    return RequestLine(name, flds.split(','))
+
+def req_from_infile_line(line, stns, meta, index=None, fallback=0):
+    name, sd, ed, lat, lon, flds = parse_infile_line(line)
+    return WeatherDataRequest(sd, ed, lat, lon, flds, stns, meta, name, index, fallback)
+
+def batch_requests(sd, ed, lats, lons, flds, stns, meta, index, fallback=0, names=None):
+    """
+    WeatherDataRequests for many locations sharing dates and fields, with the stations for all
+    of them picked in one geo-join pass instead of one search per request
+    """
+    with timer('geojoin'):
+        assignment = assign_stations(index, lats, lons, sd, ed, flds, LISTINGS.ids,
+                                     lambda _id, yr: station_flds(stns, _id, yr), fallback)
+    names = names or [None] * len(lats)
+    return [WeatherDataRequest(sd, ed, lats[i], lons[i], flds, stns, meta, names[i], index, fallback, partial(assignment.picks, i))
+            for i in range(len(lats))]
 
 def parse_stn_line(line):
     usafid_wban = '-'.join([line[0:6], line[7:12]])
@@ -404,22 +719,46 @@ def stn_flds(path='static/stn_flds.txt'):
             out[_id][flds[i]] = data[i]
     return out
 
-def coords_from_zip(zipcode):
-    from pyzipcode import ZipCodeDatabase
-    zcdb = ZipCodeDatabase()
-    zc = zcdb[int(zipcode)]
-    return zc.latitude, zc.longitude
-
-def main(args, update_stations=False):
+def load_stations(covg_path='static/ISH-HISTORY.TXT', flds_path='static/stn_flds.txt', catalog_path=CATALOG_PATH):
     """
-    - optionally refresh NOAA stations coverage metadata
-    - if locations and fields were passed on the command line, create WeatherDataRequests from them
-    - if infile specifying requests was passed on the command line, create a WeatherDataRequest from each line
-    - run all WeatherDataRequests and dump output of resulting AllWeatherResponses
+    stn_covg() with each station's 'flds' filled in from stn_flds(), served from the compiled
+    catalog at 'catalog_path', which is rebuilt first if either text file has changed
     """
-    reqs, resps = [], []
-    stns_path = 'static/ISH-HISTORY.TXT'
-    # update if arg is True, or file doesn't exist, or over 180 days stale
+    sources = [covg_path, flds_path]
+    catalog = StationCatalog.load(catalog_path, sources)
+    if catalog is not None:
+        return catalog
+    stns = stn_covg(covg_path)
+    flds_by_stn = stn_flds(flds_path)
+    # annotate 'stns' with lists of fields each station contains
+    for _id in flds_by_stn:
+        for fld in flds_by_stn[_id]:
+            if flds_by_stn[_id][fld] and _id in stns:
+                stns[_id]['flds'].append(fld)
+    with open(flds_path) as f:
+        flds = f.readline().strip().split(',')[1:]
+    try:
+        return StationCatalog(write_catalog(catalog_path, stns, flds, sources))
+    except (IOError, OSError):
+        # can't write next to the sources: just use the parsed dict this time
+        return stns
+
+def configure_sources(args):
+    """ point isd.py at the mirror, and set up the station-year cache, listings and store from 'args' """
+    global LISTINGS
+    isd.NOAA_URL = args.mirror
+    isd.DOWNLOADER = Downloader(args.mirror, connections=args.connections, retries=args.retries)
+    if not args.no_cache:
+        # stored columns count against --cache-mb, and are evicted with their station-year's file
+        isd.STORE = ObservationStore(os.path.join(args.cache_dir, 'obs')) if args.store else None
+        isd.CACHE = StationYearCache(args.cache_dir, args.cache_mb * 1024 ** 2, incremental=not args.full_refresh,
+                                     store=isd.STORE)
+        LISTINGS = StationListings(os.path.join(args.cache_dir, 'listings'))
+    else:
+        LISTINGS = StationListings(None)
+
+def refresh_stations(update_stations=False, stns_path='static/ISH-HISTORY.TXT'):
+    """ download NOAA's station list if asked to, or if it is missing or over 180 days stale """
     if update_stations or not os.path.exists(stns_path) or (time.time() - os.path.getmtime(stns_path)) > 180 * 24 * 60 * 60:
         stns_url = 'ftp://ftp.ncdc.noaa.gov/pub/data/inventories/ISH-HISTORY.TXT'
         print "Downloading NOAA stations list to %s ..." % stns_path
@@ -433,6 +772,74 @@ def main(args, update_stations=False):
             p2.stdout.close()
             f.write(p3.communicate()[0])
 
+def add_source_args(parser):
+    """ options for where station-year files come from and how they are cached, shared with service.py """
+    parser.add_argument('--cache-dir', type=str, default=CACHE_DIR,
+                        help='directory for cached NOAA station-year files (default: %(default)s)')
+    parser.add_argument('--cache-mb', type=int, default=CACHE_BYTES // 1024 ** 2,
+                        help='size limit of the station-year cache in MB; least recently used files are evicted (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always download station-year files from NOAA')
+    parser.add_argument('--store', action='store_true',
+                        help='keep decoded station-years as memory-mapped columns in <cache-dir>/obs for fast repeat queries; they count against --cache-mb and are evicted with their station-year')
+    parser.add_argument('--full-refresh', action='store_true',
+                        help="download the current year's files whole when they change, instead of adding only what is new")
+    parser.add_argument('--mirror', type=str, default=isd.NOAA_URL,
+                        help='base url of the station-year files: ftp://, http(s):// or file:// (default: %(default)s)')
+    parser.add_argument('--connections', type=int, default=CONNECTIONS,
+                        help='how many station-year files to download at once (default: %(default)s)')
+    parser.add_argument('--retries', type=int, default=RETRIES,
+                        help='how many times to retry a failed download, with backoff (default: %(default)s)')
+
+def make_requests(args, sd, ed, lats, lons, flds, infile_lines):
+    """ WeatherDataRequests for the command line locations, then for each infile line, in order """
+    reqs = []
+    # Get station coverage data and flds coverage
+    with timer('catalog'):
+        stns = load_stations()
+        # build the nearest-station index once for every request
+        index = StationIndex(stns)
+
+    # make WeatherDataRequests (no 'name' attribute will be specified for these objects)
+    # all command line locations share dates and fields: pick their stations in one pass
+    if lats:
+        reqs += batch_requests(sd, ed, lats, lons, flds, stns, args.metadata, index, args.fallback)
+
+    # Get requests from --infile arg
+    if infile_lines:
+        parsed = map(parse_infile_line, infile_lines)
+        # one geo-join pass per distinct (dates, fields) among the lines
+        groups = defaultdict(list)
+        for k, (name, line_sd, line_ed, lat, lon, line_flds) in enumerate(parsed):
+            groups[(line_sd, line_ed, tuple(line_flds))].append(k)
+        infile_reqs = [None] * len(parsed)
+        for (line_sd, line_ed, line_flds), ks in sorted(groups.items()):
+            batch = batch_requests(line_sd, line_ed, [parsed[k][3] for k in ks], [parsed[k][4] for k in ks], list(line_flds),
+                                   stns, args.metadata, index, args.fallback, names=[parsed[k][0] for k in ks])
+            for k, req in zip(ks, batch):
+                infile_reqs[k] = req
+        reqs += infile_reqs
+    return reqs
+
+def main(args, update_stations=False):
+    """
+    - optionally refresh NOAA stations coverage metadata
+    - if locations and fields were passed on the command line, create WeatherDataRequests from them
+    - if infile specifying requests was passed on the command line, create a WeatherDataRequest from each line
+    - run all WeatherDataRequests and dump output of resulting AllWeatherResponses
+    """
+    resps = []
+    # share one on-disk cache of station-year files across requests, workers and runs
+    global PROFILE_DIR
+    wall0 = time.time()
+    if args.profile:
+        if not os.path.isdir(args.profile):
+            os.makedirs(args.profile)
+        PROFILE_DIR = args.profile
+    if (args.shard or args.merge) and not args.run_dir:
+        sys.exit("--shard and --merge need --run-dir")
+    configure_sources(args)
+
     # Process command line args
     # get longitude and latitude of all requested locations
     lons, lats = [], []
@@ -441,12 +848,14 @@ def main(args, update_stations=False):
         lats += args.lats
         lons += args.lons
     if args.zips:
-        for _zip in args.zips:
-            lat, lon = coords_from_zip(_zip)
-            lats.append(lat)
-            lons.append(lon)
+        for _zip, coords in zip(args.zips, coords_from_zips(args.zips)):
+            if coords is None:
+                sys.exit("unknown zip code: %s" % _zip)
+            lats.append(coords[0])
+            lons.append(coords[1])
 
     # start_date and end_date
+    sd = ed = None
     if args.date and len(args.date) == 2:
         sd, ed = map(datestr_to_dt, args.date)
     elif args.date:
@@ -454,48 +863,99 @@ def main(args, update_stations=False):
 
     # fields (args.flds from command line is a list, not a single comma-separated string)
     flds = args.flds 
-        
-    # Get station coverage data and flds coverage
-    stns = stn_covg()
-    flds_by_stn = stn_flds()
-    # annotate 'stns' with lists of fields each station contains
-    for _id in flds_by_stn:
-        for fld in flds_by_stn[_id]:
-            if flds_by_stn[_id][fld]:
-                stns[_id]['flds'].append(fld)
-                
-    # make WeatherDataRequests (no 'name' attribute will be specified for these objects)
-    for i in range(len(lats)):
-        reqs.append(WeatherDataRequest(sd, ed, lats[i], lons[i], flds, stns, args.metadata))
-    
-    # Get requests from --infile arg
-    if args.infile:
-        for line in map(lambda x: x.strip(), args.infile.readlines()):
-            reqs.append(req_from_infile_line(line, stns, args.metadata))
+
+    # each request's infile line (or the equivalent line for command line locations) keys its checkpoint
+    lines = ["|{:%Y%m%d},{:%Y%m%d}|{},{}|{}".format(sd, ed, lat, lon, ",".join(flds)) for lat, lon in zip(lats, lons)]
+    infile_lines = map(lambda x: x.strip(), args.infile.readlines()) if args.infile else []
+    lines += infile_lines
+
+    # daily / monthly rows instead of hourly ones
+    rollup = Rollup(args.agg, parse_reducers(args.reducers)) if args.agg else None
+
+    if args.merge:
+        # the output comes from the saved parts: no stations to pick, nothing to fetch
+        reqs = [RequestLine(None, flds) for lat in lats] + map(request_line, infile_lines)
+    else:
+        refresh_stations(update_stations)
+        reqs = make_requests(args, sd, ed, lats, lons, flds, infile_lines)
 
     # Make requests
+    # plan the whole batch so each station-year is fetched and decoded once
+    run_dir = None
+    if args.run_dir:
+        # skip requests finished by an earlier run of the same batch
+        salt = "fallback=%d,meta=%d" % (args.fallback, bool(args.metadata))
+        if rollup:
+            salt += ",agg=%s,reducers=%s" % (args.agg, sorted(rollup.reducers.items()))
+        run_dir = RunDirectory(args.run_dir, salt=salt)
+        keys = {id(req): (run_dir.key(line), line) for req, line in zip(reqs, lines)}
+        todo = [req for req in reqs if not run_dir.done(keys[id(req)][0])]
+        print "%d of %d requests already done in %s" % (len(reqs) - len(todo), len(reqs), args.run_dir)
+        if args.merge and todo:
+            sys.exit("%d of %d requests have no part in %s yet" % (len(todo), len(reqs), args.run_dir))
+        plan = FetchPlan(todo, rollup)
+    else:
+        plan = FetchPlan(reqs, rollup)
     nprocs = None
     if args.parallel:
         nprocs = max(1, cpu_count() - 1)
     elif args.nprocs:
-        nprocs = args.nprocs
-    if nprocs:
-        # make requests in parallel
+        nprocs = args.nprocs[0]
+    pool = None
+    if nprocs and not args.merge:
+        # fetch station-years in parallel
         print "making requests in parallel on < %s > processors" % str(nprocs)
-        pool = Pool(processes=nprocs)
-        result = pool.map_async(run_req, reqs)
-        resps = result.get()
-    else:
-        # make requests in series
-        for req in reqs:
-            resps.append(req.run())
+        pool = Pool(processes=nprocs, initializer=init_worker)
 
-    # Combine and write output
-    all_resp = AllWeatherResponses([resp[0] for resp in resps])
-    all_resp.write(args.outfile)
+    if args.format != 'csv' and not args.shard:
+        # typed columns, written a row group at a time
+        from arrowout import ArrowWeatherResponses
+        all_resp = ArrowWeatherResponses(requested_fld_names(reqs, rollup), args.outfile, args.format)
+    if args.shard:
+        # one of several workers on the same --run-dir: parts only, the output is written by --merge
+        leases = LeaseTable(os.path.join(args.run_dir, 'leases'), lease_secs=args.lease_secs)
+        warmed, finished = run_shard(reqs, keys, run_dir, leases, rollup, pool, args.shard_chunk)
+        print "shard %s: %d station-years and %d requests done" % (leases.owner, warmed, finished)
+    elif run_dir:
+        # save each request as soon as it completes, then write the output from the saved parts, in order
+        for req, resp, meta_str in plan.stream(pool):
+            run_dir.save(keys[id(req)][0], keys[id(req)][1], resp, meta_str)
+        if args.format == 'csv':
+            all_resp = StreamingWeatherResponses(reqs, args.outfile, rollup)
+        meta_strs = []
+        for req in reqs:
+            resp, meta_str = run_dir.load(keys[id(req)][0])
+            all_resp.write_response(resp)
+            meta_strs.append(meta_str)
+        if args.format != 'csv':
+            all_resp.close()
+    elif args.stream:
+        # write each request's rows as soon as its station-years are in
+        if args.format == 'csv':
+            all_resp = StreamingWeatherResponses(reqs, args.outfile, rollup)
+        meta_strs = []
+        for req, resp, meta_str in plan.stream(pool):
+            all_resp.write_response(resp)
+            meta_strs.append(meta_str)
+        if args.format != 'csv':
+            all_resp.close()
+    else:
+        resps = plan.run(pool)
+        meta_strs = [resp[1] for resp in resps]
+        # Combine and write output
+        if args.format == 'csv':
+            if rollup:
+                all_resp = AllWeatherResponses([resp[0] for resp in resps], requested_fld_names(reqs, rollup))
+            else:
+                all_resp = AllWeatherResponses([resp[0] for resp in resps])
+            all_resp.write(args.outfile)
+        else:
+            all_resp.write([resp[0] for resp in resps])
+    if pool:
+        pool.close()
 
-    if args.metadata:
-        all_meta = AllWeatherMetadata([resp[1] for resp in resps])
+    if args.metadata and not args.shard:
+        all_meta = AllWeatherMetadata(meta_strs)
         if args.outfile == sys.stdout:
             print "\nStation Metadata:\n"
             all_meta.write(args.outfile)
@@ -508,6 +968,12 @@ def main(args, update_stations=False):
                 metadata_filename = out_fn + "_metadata.txt"
             with open(metadata_filename, "w") as f:
                 all_meta.write(f)
+
+    STATS.count('requests', len(reqs))
+    if args.stats:
+        sys.stderr.write("\nStats (wall %.3fs):\n\n%s" % (time.time() - wall0, STATS.summary()))
+    if args.stats_file:
+        STATS.write_json(args.stats_file, wall=time.time() - wall0)
         
 
 if __name__ == "__main__":
@@ -521,7 +987,7 @@ if __name__ == "__main__":
     parser.add_argument('--lons', nargs='+', action=lons_action(), type=float,
                         help='one or more longitudes (in same order as latitudes if multiple)')
     parser.add_argument('-f', '--flds', nargs='+', action=flds_action(),
-                        help='weather data field names (see README.md or NOAA_fields in WeatherDataRequest definition)')
+                        help='weather data field names, any of those isd.py decodes: %s (described in README.md)' % ' '.join(isd.FIELDS))
     parser.add_argument('-p', '--parallel', action='store_true',
                         help='detect # of processors N, run data requests on N-1 procs')
     parser.add_argument('--nprocs', nargs=1, type=int,
@@ -532,6 +998,35 @@ if __name__ == "__main__":
                         help='direct output to a file')
     parser.add_argument('-m', '--metadata', action='store_true',
                         help='write metadata about stations data comes from to stdout or <outfilename>_metadata.txt')
+    parser.add_argument('--stream', action='store_true',
+                        help='write each request\'s rows as soon as it completes (bounded memory; requests may finish out of order)')
+    parser.add_argument('--format', choices=['csv', 'parquet', 'arrow'], default='csv',
+                        help='output format: csv, or typed columns as parquet or an arrow ipc file (needs pyarrow; default: %(default)s)')
+    add_source_args(parser)
+    parser.add_argument('--run-dir', type=str, metavar='DIR',
+                        help='checkpoint each finished request in DIR; rerunning the same batch skips the finished ones')
+    parser.add_argument('--shard', action='store_true',
+                        help='work on the batch in --run-dir alongside other --shard workers (on this or other hosts sharing '
+                             'the directory and --cache-dir), saving parts only; write the output with --merge')
+    parser.add_argument('--merge', action='store_true',
+                        help='write the output from the parts in --run-dir, without fetching anything; fails if any are missing')
+    parser.add_argument('--shard-chunk', type=int, default=SHARD_CHUNK, metavar='N',
+                        help='with --shard, how many requests a worker takes at a time (default: %(default)s)')
+    parser.add_argument('--lease-secs', type=int, default=LEASE_SECS,
+                        help='with --shard, how long a dead worker\'s piece waits before another takes it over (default: %(default)s)')
+    parser.add_argument('--fallback', type=int, default=0, metavar='N',
+                        help='fill hours / fields the nearest station did not report from the next N nearest stations that did, '
+                             'fetched in the same pass; never prompts, and substitutions are listed in the metadata')
+    parser.add_argument('--agg', choices=['daily', 'monthly'],
+                        help='write one row per UTC day or month instead of hourly rows, e.g. TEMP_MIN, TEMP_MAX, TEMP_MEAN, PCP01_SUM')
+    parser.add_argument('--reducers', nargs='+', metavar='FLD=R1,R2',
+                        help='with --agg, reducers for a field instead of its defaults: min, max, mean, sum, n, mode (e.g. TEMP=mean SPD=max)')
+    parser.add_argument('--stats', action='store_true',
+                        help='print wall / cpu time per stage and counters (bytes downloaded, lines decoded, cache hits, ...) to stderr')
+    parser.add_argument('--stats-file', type=str,
+                        help='write the same stats as JSON to this file')
+    parser.add_argument('--profile', type=str, metavar='DIR',
+                        help='write a cProfile dump of each station-year fetch to DIR/<stn>-<yr>.prof')
     args = parser.parse_args()
 
     main(args)
@@ -0,0 +1,138 @@
+"""
+Streaming observations for Python callers
+
+WeatherDataRequest.run() holds a request's whole response: a ColumnarResponse, with an entry
+for every hour of the date range in each field's column.  iter_observations() answers the same request as a
+stream instead.  It yields one small namedtuple per hour, (HR_TIME, fld1, fld2, ...), with typed
+values (ints, floats, code strings, a datetime for HR_TIME) and None where nothing was reported.
+The per-request constants (location, name, stations and their distances) are attributes of
+the stream, not of each row.
+
+Station-years are decoded as they are read.  Within a year, the observations from every station
+the request uses are merged in time order and combined hour by hour, the way
+WeatherDataRequest.add_observations() does (including --fallback substitutions).  Memory stays
+constant however many years are asked for.
+
+    >>> from observations import iter_observations
+    >>> obs = iter_observations(dt.date(1990, 1, 1), dt.date(2009, 12, 31), 38.9, -77.0, ['TEMP', 'PCP01'])
+    >>> for row in obs:
+    ...     row.HR_TIME, row.TEMP
+    >>> for batch in obs.batches(10000): ...
+"""
+
+import heapq
+from itertools import groupby, islice
+from collections import namedtuple
+
+from noaahist import WeatherDataRequest, load_stations
+from stnindex import StationIndex
+from isd import fetch_station_year
+from obsstore import KINDS, convert
+
+_RECORD_TYPES = {}
+# the catalog and index, loaded on first use when the caller doesn't pass them
+_STATIONS = None
+
+def record_type(flds):
+    """ namedtuple class with HR_TIME and 'flds', one per distinct field list """
+    flds = tuple(flds)
+    if flds not in _RECORD_TYPES:
+        _RECORD_TYPES[flds] = namedtuple('Observation', ('HR_TIME',) + flds)
+    return _RECORD_TYPES[flds]
+
+def stations():
+    global _STATIONS
+    if _STATIONS is None:
+        stns = load_stations()
+        _STATIONS = (stns, StationIndex(stns))
+    return _STATIONS
+
+class ObservationStream(object):
+    """
+    iterate for records, or batches(n) for lists of up to n of them.
+
+    lat, lon, name, flds: the request
+    stations: {station _id: {'name': ..., 'dist': miles from the location}} for every station used
+    assignments: {date: {fld: station _id}} the station chosen for each date and field
+    """
+    def __init__(self, req, typed=True):
+        self.req = req
+        self.lat, self.lon, self.name = req.lat, req.lon, req.name
+        self.flds = list(req.flds)
+        self.stations = dict(req.stns_metadata)
+        self.assignments = req.dates
+        self.typed = typed
+        self.record = record_type(self.flds)
+        self.kinds = [KINDS.get(fld, 'str') for fld in self.flds]
+
+    def __iter__(self):
+        years = sorted(set(yr for (stn, yr) in self.req.station_years()))
+        for yr in years:
+            for hr_time, row in self.merged_hours(yr):
+                yield self.make_record(hr_time, row)
+
+    def batches(self, n):
+        rows = iter(self)
+        while True:
+            batch = list(islice(rows, n))
+            if not batch:
+                return
+            yield batch
+
+    def make_record(self, hr_time, row):
+        vals = [row.get(fld) for fld in self.flds]
+        if not self.typed:
+            return self.record(hr_time, *vals)
+        return self.record(convert('time', hr_time), *[convert(kind, val) for kind, val in zip(self.kinds, vals)])
+
+    def station_stream(self, k, stn, yr, flds):
+        """ ((HR_TIME, k, seq), obs) for stn's observations on its dates in yr; k orders stations within an hour """
+        dates = [d for d in self.req.stn_date_flds[stn] if d.year == yr]
+        observations = fetch_station_year(stn, yr, flds, min(dates), max(dates))
+        days = set("{:%Y%m%d}".format(d) for d in dates)
+        for seq, obs in enumerate(observations):
+            if obs['HR_TIME'][:8] in days:
+                yield (obs['HR_TIME'], k, seq), obs
+
+    def merged_hours(self, yr):
+        """ (hr_time, {fld: value}) for each hour in yr, combining every station's observations """
+        req = self.req
+        stns = sorted(stn for (stn, y) in req.station_years() if y == yr)
+        flds_by_stn = dict((stn, flds) for (stn, y), flds in req.station_years().items() if y == yr)
+        streams = [self.station_stream(k, stn, yr, flds_by_stn[stn]) for k, stn in enumerate(stns)]
+        day_flds = [dict(("{:%Y%m%d}".format(d), flds) for d, flds in req.stn_date_flds[stn].items() if d.year == yr)
+                    for stn in stns]
+        ranks = [req.ranks.get((stn, yr), {}) for stn in stns]
+        for hr_time, group in groupby(heapq.merge(*streams), key=lambda item: item[0][0]):
+            row, filled = {}, {}
+            for (key, obs) in group:
+                k = key[1]
+                for fld in day_flds[k][hr_time[:8]]:
+                    val = obs[fld]
+                    if req.fallback:
+                        # keep the best-ranked station that reported a value, as WeatherDataRequest.fills()
+                        rank, current = ranks[k].get(fld, 0), filled.get(fld)
+                        if current is None:
+                            keep = rank == 0 or val != '*'
+                        else:
+                            keep = val != '*' and (rank < current or row[fld] == '*')
+                        if not keep:
+                            continue
+                        filled[fld] = rank
+                    row[fld] = val
+            if row:
+                yield hr_time, row
+
+def iter_observations(start, end, lat, lon, flds, name=None, fallback=0, stns=None, index=None, typed=True):
+    """
+    stream a WeatherDataRequest's hourly observations -> ObservationStream
+
+    start, end: dates; flds: field names; fallback: as noaahist.py --fallback
+    stns, index: station catalog and StationIndex, loaded once per process if not given
+    typed: False keeps the decoder's strings ('*' for not reported) instead of typed values
+    """
+    if stns is None:
+        stns, default_index = stations()
+        index = index or default_index
+    req = WeatherDataRequest(start, end, lat, lon, list(flds), stns, False, name, index, fallback)
+    return ObservationStream(req, typed)
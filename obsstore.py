@@ -0,0 +1,256 @@
+"""
+Columnar, memory-mapped store of decoded station-years
+
+Each station-year is decoded once (all fields) and written to <path>/<yr>/{stn}-{yr}.col as a
+one-line JSON header followed by typed column arrays: TIME (minutes since the epoch, sorted),
+then one value array and one missing mask (1 = reported) per field.  Reads mmap the file,
+binary-search TIME for the requested date range and slice only those rows out of the columns
+that were asked for, so the pages touched are roughly the ones actually returned.
+
+Arrays are written in native byte order: the store is a local cache, not an exchange format.
+Values are rendered back to exactly the strings the decoder produces.
+
+The header records the size and CRC-32 of the cached file an entry was built from.  When that
+file has only had observations appended since (the current year, see stncache.py), append()
+adds just the new rows instead of decoding the year again.
+"""
+
+import os
+import json
+import mmap
+import array
+import bisect
+import calendar
+import tempfile
+import datetime as dt
+
+from isd import FIELDS
+
+VERSION = 1
+SKC_CODES = ['CLR', 'SCT', 'BKN', 'OVC', 'OBS', 'POB']
+# raw, unmapped GF1 sky cover codes are stored offset by this
+SKC_RAW = 16
+TYPE_RANGES = {'b': (-2 ** 7, 2 ** 7 - 1), 'h': (-2 ** 15, 2 ** 15 - 1)}
+
+# fld -> (array typecode, format used to render values back to strings)
+COLUMN_TYPES = {
+    'HR': ('b', '%02d'), 'MN': ('b', '%02d'),
+    'DIR': ('h', '%03d'), 'SPD': ('h', '%d'), 'GUS': ('h', '%d'), 'CLG': ('h', '%d'),
+    'SKC': ('b', None), 'L': ('b', '%d'), 'M': ('b', '%d'), 'H': ('b', '%d'),
+    'VSB': ('f', '%.1f'),
+    'MW1': ('b', '%02d'), 'MW2': ('b', '%02d'), 'MW3': ('b', '%02d'), 'MW4': ('b', '%02d'),
+    'AW1': ('b', '%02d'), 'AW2': ('b', '%02d'), 'AW3': ('b', '%02d'), 'AW4': ('b', '%02d'),
+    'W': ('b', '%d'),
+    'TEMP': ('h', '%d'), 'DEWP': ('h', '%d'),
+    'SLP': ('f', '%.1f'), 'ALT': ('f', '%.2f'), 'STP': ('f', '%.1f'),
+    'MAX': ('h', '%d'), 'MIN': ('h', '%d'),
+    'PCP01': ('f', '%.2f'), 'PCP06': ('f', '%.2f'), 'PCP24': ('f', '%.2f'), 'PCPXX': ('f', '%.2f'),
+    'SD': ('h', '%d'),
+}
+
+# fld -> kind of value: int, float, time, str, or code (a string from a fixed set)
+KINDS = {'NAME': 'str', 'HR_TIME': 'time', 'LAT': 'float', 'LON': 'float'}
+for _fld in ['DIR', 'SPD', 'GUS', 'CLG', 'TEMP', 'DEWP', 'MAX', 'MIN', 'SD']:
+    KINDS[_fld] = 'int'
+for _fld in ['VSB', 'SLP', 'ALT', 'STP', 'PCP01', 'PCP06', 'PCP24', 'PCPXX']:
+    KINDS[_fld] = 'float'
+for _fld in ['SKC', 'L', 'M', 'H', 'W', 'MW1', 'MW2', 'MW3', 'MW4', 'AW1', 'AW2', 'AW3', 'AW4']:
+    KINDS[_fld] = 'code'
+
+# trace precipitation is reported as 'T' by some tools; it means less than 0.01 inches
+TRACE = 0.0
+
+EPOCH = dt.datetime(1970, 1, 1)
+
+def to_minutes(timestr):
+    """ 'YYYYMMDDHH[MN]' or a date -> minutes since the epoch """
+    if isinstance(timestr, dt.date):
+        return calendar.timegm(timestr.timetuple()) // 60
+    return calendar.timegm((int(timestr[:4]), int(timestr[4:6]), int(timestr[6:8]),
+                            int(timestr[8:10] or 0), int(timestr[10:12] or 0), 0)) // 60
+
+def hr_time(minutes):
+    return (EPOCH + dt.timedelta(minutes=minutes)).strftime('%Y%m%d%H')
+
+def encode(fld, val):
+    """ decoded string -> typed value, or None if missing / not representable """
+    if val == '*':
+        return None
+    typecode = COLUMN_TYPES[fld][0]
+    try:
+        if fld == 'SKC':
+            val = SKC_CODES.index(val) if val in SKC_CODES else SKC_RAW + int(val)
+        elif typecode == 'f':
+            return float(val)
+        else:
+            val = int(val)
+    except ValueError:
+        return None
+    lo, hi = TYPE_RANGES[typecode]
+    return val if lo <= val <= hi else None
+
+def render(fld, val):
+    """ typed value -> decoded string """
+    if fld == 'SKC':
+        return SKC_CODES[val] if val < SKC_RAW else '%02d' % (val - SKC_RAW)
+    return COLUMN_TYPES[fld][1] % val
+
+def convert(kind, val):
+    """ value as written to the CSV -> typed value, or None for missing """
+    if val is None or val == '*':
+        return None
+    try:
+        if kind == 'int':
+            return int(val)
+        if kind == 'float':
+            return TRACE if val == 'T' else float(val)
+        if kind == 'time':
+            return dt.datetime(int(val[:4]), int(val[4:6]), int(val[6:8]), int(val[8:10] or 0))
+    except ValueError:
+        return None
+    return str(val)
+
+def encode_rows(rows):
+    """ [(minutes, i, obs), ...] in order -> [(column name, array), ...]: TIME, then each field and its mask """
+    arrays = [('TIME', array.array('i', [r[0] for r in rows]))]
+    for fld in FIELDS:
+        typecode = COLUMN_TYPES[fld][0]
+        vals = [encode(fld, obs[fld]) for (t, i, obs) in rows]
+        arrays.append((fld, array.array(typecode, [0 if v is None else v for v in vals])))
+        arrays.append((fld + '.mask', array.array('B', [0 if v is None else 1 for v in vals])))
+    return arrays
+
+class StationYearColumns(object):
+    """ read-only view of one stored station-year """
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        header = self.f.readline()
+        self.meta = json.loads(header)
+        self.start = len(header)
+        self.n = self.meta['n']
+        self.columns = self.meta['columns']
+        if self.n:
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.mm = None
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.f.close()
+
+    def __len__(self):
+        return self.n
+
+    def column(self, name, lo=0, hi=None):
+        """ array of rows [lo, hi) of column 'name' """
+        hi = self.n if hi is None else hi
+        typecode, offset = self.columns[name]
+        size = array.array(typecode).itemsize
+        out = array.array(typecode)
+        if hi > lo:
+            start = self.start + offset
+            out.fromstring(self.mm[start + lo * size: start + hi * size])
+        return out
+
+    def _time(self, i):
+        return self.column('TIME', i, i + 1)[0]
+
+    def search(self, minutes):
+        """ index of the first row at or after 'minutes' """
+        class _Times(object):
+            def __len__(_):
+                return self.n
+            def __getitem__(_, i):
+                return self._time(i)
+        return bisect.bisect_left(_Times(), minutes)
+
+    def rows(self, start=None, end=None):
+        """ (lo, hi) row range for dates start..end inclusive """
+        lo = self.search(to_minutes(start)) if start else 0
+        hi = self.search(to_minutes(end + dt.timedelta(days=1))) if end else self.n
+        return lo, hi
+
+    def observations(self, flds, start=None, end=None):
+        """ yields observation dicts like isd.ISDDecoder's, for dates start..end inclusive """
+        lo, hi = self.rows(start, end)
+        times = self.column('TIME', lo, hi)
+        cols = [(fld, self.column(fld, lo, hi), self.column(fld + '.mask', lo, hi)) for fld in flds if fld != 'HR_TIME']
+        for i in xrange(hi - lo):
+            obs = {fld: render(fld, vals[i]) if mask[i] else '*' for fld, vals, mask in cols}
+            obs['HR_TIME'] = hr_time(times[i])
+            yield obs
+
+class ObservationStore(object):
+    def __init__(self, path):
+        self.path = path
+
+    def entry_path(self, stn, yr):
+        return os.path.join(self.path, str(yr), '{0}-{1}.col'.format(stn, yr))
+
+    def source_size(self, stn, yr):
+        """ size of the raw file the stored entry was built from, or None if there is no entry """
+        source = self.source(stn, yr)
+        return source[0] if source else None
+
+    def source(self, stn, yr):
+        """ (size, crc32) of the raw file the stored entry was built from (crc32 None if not recorded), or None """
+        try:
+            with open(self.entry_path(stn, yr), 'rb') as f:
+                meta = json.loads(f.readline())
+        except (IOError, ValueError):
+            return None
+        if meta.get('version') != VERSION or meta.get('source_size') is None:
+            return None
+        return meta['source_size'], meta.get('source_crc')
+
+    def open(self, stn, yr):
+        return StationYearColumns(self.entry_path(stn, yr))
+
+    def write(self, stn, yr, observations, source_size=None, source_crc=None):
+        """ store decoded observations (dicts with HR_TIME and every field in FIELDS) """
+        rows = sorted(((to_minutes(obs['HR_TIME'] + obs['MN']), i, obs) for i, obs in enumerate(observations)))
+        return self.save(stn, yr, encode_rows(rows), source_size, source_crc)
+
+    def append(self, stn, yr, observations, source_size=None, source_crc=None):
+        """
+        add decoded observations to a stored station-year: the new rows are encoded and the
+        stored columns copied, and the rows are only sorted again if the new ones aren't all later
+        """
+        rows = sorted(((to_minutes(obs['HR_TIME'] + obs['MN']), i, obs) for i, obs in enumerate(observations)))
+        cols = self.open(stn, yr)
+        try:
+            arrays = [(name, cols.column(name)) for name, empty in encode_rows([])]
+        finally:
+            cols.close()
+        times = arrays[0][1]
+        later = not times or not rows or rows[0][0] >= times[-1]
+        for (name, arr), (_, more) in zip(arrays, encode_rows(rows)):
+            arr.extend(more)
+        if not later:
+            order = sorted(range(len(times)), key=times.__getitem__)
+            arrays = [(name, array.array(arr.typecode, [arr[i] for i in order])) for name, arr in arrays]
+        return self.save(stn, yr, arrays, source_size, source_crc)
+
+    def save(self, stn, yr, arrays, source_size=None, source_crc=None):
+        """ write [(column name, array), ...], TIME first, as the stored station-year """
+        columns, offset = {}, 0
+        for name, arr in arrays:
+            columns[name] = (arr.typecode, offset)
+            offset += len(arr) * arr.itemsize
+        header = json.dumps(dict(version=VERSION, n=len(arrays[0][1]), source_size=source_size, source_crc=source_crc,
+                                 columns=columns)) + "\n"
+
+        path = self.entry_path(stn, yr)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header)
+            for name, arr in arrays:
+                arr.tofile(f)
+        os.rename(tmp, path)
+        return path
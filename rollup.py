@@ -0,0 +1,189 @@
+"""
+Daily / monthly rollups of a request's hourly rows
+
+Rollup turns the hourly rows of one request into one row per day (YYYYMMDD) or month (YYYYMM)
+of the UTC hour, with one column per field and reducer: TEMP_MIN, TEMP_MAX, TEMP_MEAN,
+PCP01_SUM, GUS_MAX, ...  '*' (not reported) is left out of every reducer, trace precipitation
+('T') counts as 0, and a period with no reported values gets '*'.
+
+Rows are already in time order, so each period is a contiguous slice.  With numpy, each
+numeric field is converted to one float array (NaN for missing) and reduced for all periods at
+once with ufunc.reduceat; without it the same reducers run period by period in Python.  Code
+fields (sky cover, weather codes, wind direction) are reduced to their most frequent value.
+
+A columnar.ColumnarResponse is reduced straight from its typed arrays (float_column(),
+value_counts()) rather than from one dict of strings per hour.
+"""
+
+from collections import Counter
+
+from columnar import ColumnarResponse
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+PERIODS = {'daily': 8, 'monthly': 6}
+NUMERIC_REDUCERS = ['min', 'max', 'mean', 'sum', 'n']
+REDUCERS = NUMERIC_REDUCERS + ['mode']
+TRACE = 0.0
+
+# fld -> default reducers
+DEFAULT_REDUCERS = {
+    'TEMP': ['min', 'max', 'mean'], 'DEWP': ['min', 'max', 'mean'], 'MAX': ['max'], 'MIN': ['min'],
+    'SPD': ['mean', 'max'], 'GUS': ['max'], 'DIR': ['mode'], 'CLG': ['min'], 'VSB': ['min', 'mean'],
+    'SLP': ['mean'], 'STP': ['mean'], 'ALT': ['mean'],
+    'PCP01': ['sum'], 'PCP06': ['sum'], 'PCP24': ['sum'], 'PCPXX': ['sum'], 'SD': ['max'],
+}
+for _fld in ['SKC', 'L', 'M', 'H', 'W', 'MW1', 'MW2', 'MW3', 'MW4', 'AW1', 'AW2', 'AW3', 'AW4']:
+    DEFAULT_REDUCERS[_fld] = ['mode']
+
+def parse_reducers(specs):
+    """ ['TEMP=min,max', 'PCP01=sum'] -> {'TEMP': ['min', 'max'], 'PCP01': ['sum']} """
+    out = {}
+    for spec in specs or []:
+        try:
+            fld, names = spec.split('=')
+        except ValueError:
+            raise ValueError("reducers must look like FLD=min,max: %s" % spec)
+        names = [name.strip().lower() for name in names.split(',')]
+        unknown = [name for name in names if name not in REDUCERS]
+        if unknown:
+            raise ValueError("unknown reducers for %s: %s" % (fld, ", ".join(unknown)))
+        out[fld.strip()] = names
+    return out
+
+def to_float(val):
+    if val is None or val == '*':
+        return float('nan')
+    if val == 'T':
+        return TRACE
+    try:
+        return float(val)
+    except ValueError:
+        return float('nan')
+
+def reduce_values(name, vals):
+    """ one reducer over one period's floats (NaN for missing), without numpy -> float or None """
+    vals = [v for v in vals if v == v]
+    if name == 'n':
+        return len(vals)
+    if not vals:
+        return None
+    if name == 'min':
+        return min(vals)
+    if name == 'max':
+        return max(vals)
+    if name == 'sum':
+        return sum(vals)
+    return sum(vals) / len(vals)
+
+def reduce_arrays(name, vals, starts):
+    """ one reducer over every period at once: vals (NaN for missing) split at 'starts' -> [float or None] """
+    present = ~np.isnan(vals)
+    n = np.add.reduceat(present.astype(int), starts)
+    if name == 'n':
+        return n.tolist()
+    if name == 'min':
+        out = np.fmin.reduceat(vals, starts)
+    elif name == 'max':
+        out = np.fmax.reduceat(vals, starts)
+    else:
+        out = np.add.reduceat(np.where(present, vals, 0.), starts)
+        if name == 'mean':
+            out = out / np.maximum(n, 1)
+    return [None if not k else float(v) for v, k in zip(out.tolist(), n.tolist())]
+
+def mode(counts):
+    """ most frequent value of a Counter of reported values, or None if it is empty """
+    if not counts:
+        return None
+    # most frequent; ties go to the smallest code so output is stable
+    return min(counts.items(), key=lambda item: (-item[1], item[0]))[0]
+
+class Rollup(object):
+    """
+    period: 'daily' or 'monthly'
+    reducers: {fld: [reducer, ...]} overriding DEFAULT_REDUCERS
+    """
+    def __init__(self, period, reducers=None):
+        if period not in PERIODS:
+            raise ValueError("unknown rollup period: %s" % period)
+        self.period = period
+        self.width = PERIODS[period]
+        self.reducers = dict(DEFAULT_REDUCERS)
+        self.reducers.update(reducers or {})
+
+    def columns(self, fld_names):
+        """ output columns for hourly columns 'fld_names' (e.g. from requested_fld_names()) """
+        out = []
+        for fld in fld_names:
+            if fld == 'HR_TIME':
+                out.append('DATE')
+            elif fld in ('NAME', 'LAT', 'LON'):
+                out.append(fld)
+            else:
+                out += ['%s_%s' % (fld, name.upper()) for name in self.reducers.get(fld, ['mean'])]
+        return out
+
+    def apply(self, rows, flds):
+        """
+        hourly rows (in time order) of one request, as dicts or a ColumnarResponse -> one row
+        per period, for fields 'flds'
+        """
+        if isinstance(rows, ColumnarResponse):
+            return self.apply_columns(rows, flds)
+        if not rows:
+            return []
+        keys = [row['HR_TIME'][:self.width] for row in rows]
+        out, starts, bounds = self.periods(keys, rows[0]['LAT'], rows[0]['LON'], rows[0].get('NAME'))
+        self.reduce(out, starts, bounds, flds, lambda fld: [to_float(row.get(fld)) for row in rows],
+                    lambda fld, lo, hi: Counter(r.get(fld) for r in rows[lo:hi] if r.get(fld) is not None and r.get(fld) != '*'))
+        return out
+
+    def apply_columns(self, resp, flds):
+        """ apply() straight from a ColumnarResponse's typed arrays """
+        hours = resp.rows()
+        if not hours:
+            return []
+        keys = [resp.day_strs[h // 24][:self.width] for h in hours]
+        out, starts, bounds = self.periods(keys, resp.lat, resp.lon, resp.name)
+        self.reduce(out, starts, bounds, flds, resp.float_column,
+                    lambda fld, lo, hi: resp.value_counts(fld, hours[lo:hi]))
+        return out
+
+    def periods(self, keys, lat, lon, name=None):
+        """ period of each hourly row -> (output rows, first row of each period, (lo, hi) of each) """
+        starts = [i for i in range(len(keys)) if i == 0 or keys[i] != keys[i - 1]]
+        bounds = list(zip(starts, starts[1:] + [len(keys)]))
+        out = [dict(DATE=keys[lo], LAT=lat, LON=lon) for lo, hi in bounds]
+        if name:
+            for row in out:
+                row['NAME'] = name
+        return out, starts, bounds
+
+    def reduce(self, out, starts, bounds, flds, floats, counts):
+        """
+        fill in each output row's reduced columns.  floats(fld): every hourly value as a float
+        (NaN for missing); counts(fld, lo, hi): Counter of the values reported in rows lo..hi
+        """
+        for fld in flds:
+            if fld in ('NAME', 'HR_TIME', 'LAT', 'LON'):
+                continue
+            names = self.reducers.get(fld, ['mean'])
+            numeric = [name for name in names if name != 'mode']
+            if numeric:
+                vals = floats(fld)
+                if np is not None:
+                    arr = np.asarray(vals, dtype=float)
+                    for name in numeric:
+                        for row, val in zip(out, reduce_arrays(name, arr, starts)):
+                            row['%s_%s' % (fld, name.upper())] = val
+                else:
+                    for row, (lo, hi) in zip(out, bounds):
+                        for name in numeric:
+                            row['%s_%s' % (fld, name.upper())] = reduce_values(name, vals[lo:hi])
+            if 'mode' in names:
+                for row, (lo, hi) in zip(out, bounds):
+                    row['%s_MODE' % fld] = mode(counts(fld, lo, hi))
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+
+"""
+Local query service
+
+Every run of noaahist.py loads the station catalog, builds the nearest-station index and starts
+with nothing decoded.  service.py does that once and then answers WeatherDataRequest queries over
+HTTP, on a localhost port or a Unix socket, for as long as it runs:
+
+    GET /query?lat=36.1&lon=-115.1&start=20050101&end=20050107&flds=TEMP,SPD[&name=LV][&fallback=N]
+               [&agg=daily|monthly][&reducers=TEMP=min,max&reducers=SPD=max][&format=csv|json][&meta=1]
+    GET /stats      timers and counters, and what is held in memory
+    GET /health
+
+Rows come back as the same CSV noaahist.py writes (or JSON: columns, rows and metadata).
+
+Decoded station-years are kept in memory as columns (HotStationYears), a column per field that
+has been asked for, with an index of rows by day, so a repeat query for a few days only touches
+those rows.  The least recently used station-years are evicted past --hot-cells values; the
+current year's are dropped after --hot-ttl seconds, as its file keeps growing.  Identical queries
+in flight at the same time are answered once, and so are loads of the same station-year.
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import threading
+import urlparse
+import datetime as dt
+from collections import OrderedDict
+from cStringIO import StringIO
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn, UnixStreamServer
+
+from isd import fetch_station_year
+from noaahist import (WeatherDataRequest, StreamingWeatherResponses, requested_fld_names, load_stations,
+                      configure_sources, refresh_stations, add_source_args, datestr_to_dt, coords_from_zip)
+from stnindex import StationIndex
+from rollup import Rollup, PERIODS, parse_reducers
+from stats import STATS, timer
+
+PORT = 8765
+HOT_CELLS = 16 * 1024 * 1024
+HOT_TTL_SECS = 60 * 60
+
+class Coalescer(object):
+    """ do(key, func): callers asking for the same key while func runs wait for its result instead """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def do(self, key, func):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = dict(done=threading.Event(), result=None, error=None)
+        if not leader:
+            STATS.count('coalesced')
+            flight['done'].wait()
+        else:
+            try:
+                flight['result'] = func()
+            except Exception as e:
+                flight['error'] = e
+            finally:
+                with self.lock:
+                    del self.flights[key]
+                flight['done'].set()
+        if flight['error'] is not None:
+            raise flight['error']
+        return flight['result']
+
+class StationYearColumns(object):
+    """ one station-year's decoded observations, a list of values per field, with rows indexed by day """
+    def __init__(self, observations, flds):
+        self.flds = frozenset(flds)
+        self.hr_times = [obs['HR_TIME'] for obs in observations]
+        self.cols = {fld: [obs[fld] for obs in observations] for fld in flds}
+        self.days = {}
+        for i, hr_time in enumerate(self.hr_times):
+            self.days.setdefault(hr_time[:8], []).append(i)
+        self.loaded = time.time()
+
+    def cells(self):
+        return len(self.hr_times) * (len(self.cols) + 1)
+
+    def observations(self, flds, datestrs):
+        """ observation dicts with 'flds', for rows on the YYYYMMDD days in 'datestrs' """
+        out = []
+        for day in sorted(datestrs):
+            for i in self.days.get(day, ()):
+                obs = {fld: self.cols[fld][i] for fld in flds}
+                obs['HR_TIME'] = self.hr_times[i]
+                out.append(obs)
+        return out
+
+class HotStationYears(object):
+    """
+    decoded station-years held in memory, least recently used evicted past 'max_cells' values.
+    a station-year asked for with more fields than it holds is decoded again with all of them
+    """
+    def __init__(self, max_cells=HOT_CELLS, ttl_secs=HOT_TTL_SECS):
+        self.max_cells = max_cells
+        self.ttl_secs = ttl_secs
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.cells = 0
+        self.loads = Coalescer()
+
+    def fresh(self, yr, entry):
+        return yr < dt.date.today().year or time.time() - entry.loaded < self.ttl_secs
+
+    def get(self, stn, yr, flds):
+        with self.lock:
+            entry = self.entries.get((stn, yr))
+            if entry is not None and self.fresh(yr, entry) and entry.flds.issuperset(flds):
+                # most recently used last
+                del self.entries[(stn, yr)]
+                self.entries[(stn, yr)] = entry
+                STATS.count('hot_hits')
+                return entry
+            flds = frozenset(flds) | (entry.flds if entry is not None and self.fresh(yr, entry) else frozenset())
+        return self.loads.do((stn, yr, flds), lambda: self.load(stn, yr, flds))
+
+    def load(self, stn, yr, flds):
+        STATS.count('hot_misses')
+        with timer('fetch_decode'):
+            entry = StationYearColumns(list(fetch_station_year(stn, yr, sorted(flds))), flds)
+        with self.lock:
+            old = self.entries.pop((stn, yr), None)
+            if old is not None:
+                self.cells -= old.cells()
+            self.entries[(stn, yr)] = entry
+            self.cells += entry.cells()
+            while self.cells > self.max_cells and len(self.entries) > 1:
+                key, evicted = self.entries.popitem(last=False)
+                self.cells -= evicted.cells()
+                STATS.count('hot_evictions')
+        return entry
+
+    def observations(self, stn, yr, flds, datestrs):
+        with timer('filter'):
+            return self.get(stn, yr, flds).observations(flds, datestrs)
+
+    def info(self):
+        with self.lock:
+            return dict(station_years=len(self.entries), cells=self.cells, max_cells=self.max_cells)
+
+class QueryError(Exception):
+    pass
+
+def parse_query(params):
+    """ query string params ({name: [values]}) -> normalized query tuple, the key for coalescing """
+    def get(name, default=None):
+        return params.get(name, [default])[0]
+    try:
+        if get('zip'):
+            lat, lon = coords_from_zip(get('zip'))
+        else:
+            lat, lon = float(get('lat')), float(get('lon'))
+        start = datestr_to_dt(get('start') or get('date'))
+        end = datestr_to_dt(get('end')) if get('end') else start
+        flds = tuple(fld.strip() for fld in get('flds', '').split(',') if fld.strip())
+        fallback = int(get('fallback', 0))
+    except KeyError as e:
+        # coords_from_zip(): not a known zip code
+        raise QueryError(e.args[0])
+    except (TypeError, ValueError):
+        raise QueryError("need lat and lon (or zip), start (YYYYMMDD) and flds; optional end, name, fallback, agg, format, meta")
+    if not flds:
+        raise QueryError("no flds given")
+    if end < start:
+        raise QueryError("end is before start")
+    agg = get('agg')
+    if agg and agg not in PERIODS:
+        raise QueryError("agg must be one of: %s" % ", ".join(sorted(PERIODS)))
+    reducers = tuple(params.get('reducers', []))
+    fmt = get('format', 'csv')
+    if fmt not in ('csv', 'json'):
+        raise QueryError("format must be csv or json")
+    return (lat, lon, start, end, flds, get('name'), fallback, agg, reducers, get('meta') == '1', fmt)
+
+class QueryService(object):
+    """ the catalog, index and hot station-years shared by every query """
+    def __init__(self, hot):
+        with timer('catalog'):
+            self.stns = load_stations()
+            self.index = StationIndex(self.stns)
+        self.hot = hot
+        self.queries = Coalescer()
+
+    def answer(self, query):
+        """ normalized query -> (content type, body); identical queries in flight share one answer """
+        STATS.count('queries')
+        return self.queries.do(query, lambda: self.run(query))
+
+    def run(self, query):
+        lat, lon, start, end, flds, name, fallback, agg, reducers, meta, fmt = query
+        try:
+            rollup = Rollup(agg, parse_reducers(reducers)) if agg else None
+        except ValueError as e:
+            raise QueryError(str(e))
+        req = WeatherDataRequest(start, end, lat, lon, list(flds), self.stns, meta, name, self.index, fallback)
+        for (stn, yr), yr_flds in sorted(req.station_years().items()):
+            datestrs = set("{:%Y%m%d}".format(d) for d in req.stn_date_flds[stn] if d.year == yr)
+            req.add_observations(stn, yr, self.hot.observations(stn, yr, yr_flds, datestrs))
+        req.set_response_list()
+        if meta:
+            req.set_metastr()
+        rows = req.response_list
+        if rollup is not None:
+            with timer('rollup'):
+                rows = rollup.apply(rows, req.flds)
+        if fmt == 'json':
+            fld_names = requested_fld_names([req], rollup)
+            body = json.dumps(dict(columns=fld_names, rows=[[row.get(fld) for fld in fld_names] for row in rows],
+                                   meta=req.meta_str))
+            return 'application/json', body
+        buf = StringIO()
+        StreamingWeatherResponses([req], buf, rollup).write_response(rows)
+        return 'text/csv', buf.getvalue()
+
+    def stats(self):
+        snap = STATS.snapshot()
+        snap['hot'] = self.hot.info()
+        return 'application/json', json.dumps(snap, indent=2, sort_keys=True)
+
+class Handler(BaseHTTPRequestHandler):
+    # keep connections open between queries
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        service = self.server.service
+        try:
+            if url.path == '/query':
+                with timer('query'):
+                    ctype, body = service.answer(parse_query(urlparse.parse_qs(url.query)))
+            elif url.path == '/stats':
+                ctype, body = service.stats()
+            elif url.path == '/health':
+                ctype, body = 'text/plain', 'ok\n'
+            else:
+                return self.reply(404, 'text/plain', 'unknown path: %s\n' % url.path)
+        except QueryError as e:
+            return self.reply(400, 'text/plain', '%s\n' % e)
+        except (SystemExit, Exception) as e:
+            # noaahist exits on some bad input; that must not take the service down
+            return self.reply(500, 'text/plain', 'error: %s\n' % e)
+        self.reply(200, ctype, body)
+
+    def reply(self, code, ctype, body):
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Unix socket peers have no address
+        peer = self.client_address[0] if self.client_address else 'unix'
+        sys.stderr.write("%s - - [%s] %s\n" % (peer, self.log_date_time_string(), format % args))
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        UnixStreamServer.server_bind(self)
+        # BaseHTTPRequestHandler wants these
+        self.server_name, self.server_port = socket.gethostname(), 0
+
+def make_server(service, host='127.0.0.1', port=PORT, socket_path=None):
+    server = ThreadingUnixHTTPServer(socket_path, Handler) if socket_path else ThreadingHTTPServer((host, port), Handler)
+    server.service = service
+    return server
+
+def main(args):
+    configure_sources(args)
+    refresh_stations()
+    # queries never stop to ask on the terminal (WeatherDataRequest prompts when stdin is a tty)
+    sys.stdin = open(os.devnull)
+    service = QueryService(HotStationYears(args.hot_cells, args.hot_ttl))
+    server = make_server(service, args.host, args.port, args.socket)
+    where = args.socket or "http://%s:%d" % server.server_address[:2]
+    # clean up (e.g. the socket file) on kill as on ^C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print "serving %d stations on %s" % (len(service.stns), where)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='./service.py')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=PORT,
+                        help='port to listen on; 0 picks a free one (default: %(default)s)')
+    parser.add_argument('--socket', type=str, metavar='PATH',
+                        help='listen on a Unix socket at PATH instead of a port')
+    parser.add_argument('--hot-cells', type=int, default=HOT_CELLS,
+                        help='decoded values (rows * fields) kept in memory; least recently used station-years are evicted (default: %(default)s)')
+    parser.add_argument('--hot-ttl', type=int, default=HOT_TTL_SECS,
+                        help='seconds before a current-year station-year is decoded again (default: %(default)s)')
+    add_source_args(parser)
+    main(parser.parse_args())
@@ -0,0 +1,105 @@
+"""
+Per-stage timers and counters
+
+Modules record into the process-wide STATS: timer(stage) around a stage adds its wall and CPU
+seconds (and a call count), count(name, n) bumps a counter (bytes downloaded, lines decoded,
+cache hits, ...).  Both are cheap enough to leave on all the time; callers count per file or
+per batch, not per record.
+
+Pool workers have their own STATS.  A worker hands back what it recorded with take(), and the
+parent adds it in with merge(), so the summary at the end covers the whole run.
+"""
+
+import os
+import json
+import time
+import threading
+from collections import defaultdict
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+class _Timer(object):
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.wall, self.cpu = time.time(), cpu_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.add_time(self.name, time.time() - self.wall, cpu_time() - self.cpu)
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # stage -> [wall secs, cpu secs, calls]
+        self.timers = defaultdict(lambda: [0., 0., 0])
+        self.counters = defaultdict(int)
+
+    def timer(self, name):
+        return _Timer(self, name)
+
+    def add_time(self, name, wall, cpu, calls=1):
+        with self.lock:
+            t = self.timers[name]
+            t[0] += wall
+            t[1] += cpu
+            t[2] += calls
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def _snapshot(self):
+        return dict(timers={name: dict(wall=t[0], cpu=t[1], calls=t[2]) for name, t in self.timers.items()},
+                    counters=dict(self.counters))
+
+    def snapshot(self):
+        with self.lock:
+            return self._snapshot()
+
+    def take(self):
+        """ snapshot() and reset(), e.g. to send a worker's numbers back with its result """
+        with self.lock:
+            snap = self._snapshot()
+            self.reset()
+        return snap
+
+    def merge(self, snap):
+        for name, t in snap['timers'].items():
+            self.add_time(name, t['wall'], t['cpu'], t['calls'])
+        for name, n in snap['counters'].items():
+            self.count(name, n)
+
+    def summary(self):
+        snap = self.snapshot()
+        lines = ["%-20s %10s %10s %8s\n" % ('STAGE', 'WALL_S', 'CPU_S', 'CALLS')]
+        for name in sorted(snap['timers']):
+            t = snap['timers'][name]
+            lines.append("%-20s %10.3f %10.3f %8d\n" % (name, t['wall'], t['cpu'], t['calls']))
+        lines.append("\n%-20s %10s\n" % ('COUNTER', 'VALUE'))
+        for name in sorted(snap['counters']):
+            lines.append("%-20s %10d\n" % (name, snap['counters'][name]))
+        return "".join(lines)
+
+    def write_json(self, path, **extra):
+        snap = self.snapshot()
+        snap.update(extra)
+        with open(path, 'w') as f:
+            json.dump(snap, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+STATS = Stats()
+timer = STATS.timer
+count = STATS.count
+
+def init_worker():
+    """ Pool initializer: start a forked worker from zero, with a lock nobody holds """
+    STATS.lock = threading.Lock()
+    STATS.reset()
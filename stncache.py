@@ -0,0 +1,448 @@
+"""
+Persistent on-disk cache of NOAA station-year files
+
+Raw {stn}-{yr}.gz files are kept under <path>/<yr>/, shared by every request, worker process
+and script that points at the same directory.  Entries are written to a temporary file and
+renamed into place, so concurrent Pool workers never see a partial file.  The access time of
+each entry is set explicitly on every hit, and the least recently used entries are evicted
+once the total size goes over the byte budget.  Each process walks the cache for its size once,
+then keeps a running total of what it writes, and only walks it again (seeing what other
+processes wrote meanwhile) to evict once that total is over the budget.
+
+Closed (past) years are never revalidated.  Files for the current year are still growing on
+NOAA's side, so they are revalidated with a conditional download (If-Modified-Since, or MDTM
+over FTP) at most once every 'revalidate_secs'.  An entry's mtime is the last time it was downloaded or revalidated.
+
+With 'incremental', a changed current-year file isn't simply downloaded again: update() adds
+only the observations NOAA has appended since, using <entry>.state (what of NOAA's file has
+been seen) to ask for just the new bytes, or to tell the new lines from the old ones.  Everything
+that rewrites a current-year entry (revalidating it, appending to it, indexing it) holds the
+entry's lock, <entry>.lease (see leases.py), so processes sharing the cache take turns, and the
+state records the size of the entry it describes, so an entry changed without its state being
+saved (a crash in between) is downloaded whole again rather than appended to twice.
+
+Entries read for narrow date ranges again and again (counted in <entry>.reads) are rewritten
+once with a seek index beside them (see gzindex.py); the index goes when its entry is evicted.  With an ObservationStore ('store'), a
+station-year's stored columns count against the budget together with its cached file, as one
+entry last used when either was, and are evicted with it.
+
+StationListings keeps the per-year directory listings (which stations have a file for a year)
+as sets, in memory for the life of the process and on disk for 'ttl_secs'.
+"""
+
+import os
+import json
+import time
+import zlib
+import datetime as dt
+import tempfile
+
+import isd
+from isd import station_year_path, station_ids_for_year
+from download import NotFound, DownloadError, NotRanged
+from gzindex import SeekIndex, index_path, gzip_member, build
+from leases import locked
+from stats import STATS
+
+CACHE_DIR = 'cache'
+CACHE_BYTES = 2 * 1024 ** 3
+REVALIDATE_SECS = 60 * 60
+LISTING_TTL_SECS = 24 * 60 * 60
+CLOSED_LISTING_TTL_SECS = 30 * 24 * 60 * 60
+# bytes of NOAA's file read again ahead of the new tail, to check it really only grew
+OVERLAP_BYTES = 64
+
+def state_path(path):
+    """ what has been ingested of a current-year entry: see StationYearCache.update() """
+    return path + '.state'
+
+def file_size(path):
+    """ size of the file at 'path', 0 if there is none """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def reads_path(path):
+    """ how many narrow reads the entry at 'path' has had while it has no seek index """
+    return path + '.reads'
+
+def source_state(data, lines=None):
+    """
+    what update() needs to know of NOAA's file, from its bytes 'data': its size, its last
+    OVERLAP_BYTES, and the number of lines and last observation time (YYYYMMDDHHMN) in it.
+    'local' is the size of the cached entry, which starts out as a copy of 'data'
+    """
+    if lines is None:
+        lines = list(isd.gunzip_lines([data]))
+    return dict(size=len(data), tail=data[-OVERLAP_BYTES:].encode('hex'), lines=len(lines),
+                last=max(line[15:27] for line in lines) if lines else '', local=len(data))
+
+class StationYearCache(object):
+    def __init__(self, path=CACHE_DIR, max_bytes=CACHE_BYTES, revalidate_secs=REVALIDATE_SECS, incremental=True, store=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.revalidate_secs = revalidate_secs
+        self.incremental = incremental
+        self.store = store
+        # running size of the cache, as of this process's last walk plus what it has written since
+        self.total = None
+
+    def entry_path(self, stn, yr):
+        return os.path.join(self.path, str(yr), '{0}-{1}.gz'.format(stn, yr))
+
+    def is_closed(self, yr):
+        return int(yr) < dt.date.today().year
+
+    def get(self, stn, yr):
+        """ path of a usable cached entry (marking it as recently used), or None """
+        path = self.entry_path(stn, yr)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not self.is_closed(yr) and time.time() - st.st_mtime > self.revalidate_secs:
+            return None
+        self.touch(path)
+        return path
+
+    def touch(self, path):
+        # keep mtime (used for revalidation); atime records last use
+        try:
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except OSError:
+            pass
+
+    def fetch(self, stn, yr):
+        """
+        path of the cached station-year file, downloading or revalidating it first if needed.
+        returns None if NOAA has no such file
+        """
+        path = self.get(stn, yr)
+        if path:
+            STATS.count('cache_hits')
+            return path
+        STATS.count('cache_misses')
+        path = self.entry_path(stn, yr)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass    # another worker made it
+        if self.is_closed(yr):
+            return self.download(stn, yr)
+        # one process at a time revalidates a current-year entry; the others wait, then use what it got
+        with locked(path):
+            if self.get(stn, yr):
+                return path
+            if self.incremental and os.path.exists(path) and self.update(stn, yr):
+                return path
+            return self.download(stn, yr)
+
+    def download(self, stn, yr):
+        """ download the station-year file whole into the cache -> its path, or None if NOAA has no such file """
+        path = self.entry_path(stn, yr)
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+        # only download again if NOAA's copy is newer than ours
+        since = os.path.getmtime(path) if os.path.exists(path) else None
+        with os.fdopen(fd, 'wb') as f:
+            try:
+                isd.downloader().download(station_year_path(stn, yr), f, if_modified_since=since)
+            except (NotFound, DownloadError):
+                f.truncate(0)
+        if os.path.getsize(tmp) > 0:
+            if not self.is_closed(yr):
+                with open(tmp, 'rb') as f:
+                    self.save_state(path, source_state(f.read()))
+            added = os.path.getsize(tmp) - file_size(path)
+            os.rename(tmp, path)
+            self.evict(keep=path, added=added)
+        else:
+            os.remove(tmp)
+            if not os.path.exists(path):
+                return None
+            # not modified: reset the revalidation clock
+            os.utime(path, None)
+        return path if os.path.exists(path) else None
+
+    def load_state(self, path):
+        """ the state of the entry at 'path', or None """
+        try:
+            with open(state_path(path)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def save_state(self, path, state):
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp, state_path(path))
+
+    def update(self, stn, yr):
+        """
+        bring a current-year entry up to date with NOAA's growing file, adding only what is new.
+        first only the bytes past the ones already seen are asked for; if NOAA's file really
+        only grew (gzip members appended), those decompress to the new lines.  otherwise the whole
+        file is downloaded and its lines compared with the entry's: if it only has lines added at
+        the end, those are appended, and if earlier lines changed it replaces the entry.
+        returns False if the entry has to be downloaded whole instead: no state recorded, or the
+        entry isn't the one the state describes.  call with the entry's lock held
+        """
+        path = self.entry_path(stn, yr)
+        state = self.load_state(path)
+        before = os.path.getsize(path)
+        if state is None or state.get('local') != before:
+            return False
+        rel = station_year_path(stn, yr)
+        offset = max(0, state['size'] - OVERLAP_BYTES)
+        overlap = state['tail'].decode('hex')
+        info = {}
+        try:
+            data = ''.join(isd.downloader().chunks(rel, offset, if_modified_since=os.path.getmtime(path), info=info))
+        except NotRanged:
+            data = None
+        except NotFound:
+            return False
+        except DownloadError:
+            # keep serving what we have; try again at the next revalidation
+            os.utime(path, None)
+            return True
+        if info.get('not_modified'):
+            os.utime(path, None)
+            return True
+        if data is not None and data[:len(overlap)] == overlap:
+            tail = data[len(overlap):]
+            try:
+                lines = list(isd.gunzip_lines([tail])) if tail else []
+            except zlib.error:
+                lines = None
+            if lines is not None:
+                STATS.count('tail_updates' if lines else 'tail_unchanged')
+                STATS.count('lines_appended', len(lines))
+                self.append(stn, yr, lines, state)
+                state.update(size=state['size'] + len(tail), tail=(overlap + tail)[-OVERLAP_BYTES:].encode('hex'))
+                self.save_state(path, state)
+                self.evict(keep=path, added=state['local'] - before)
+                return True
+        # NOAA rewrote the file: fetch it whole, but only add the lines that are new
+        try:
+            data = ''.join(isd.downloader().chunks(rel))
+        except NotFound:
+            return False
+        except DownloadError:
+            os.utime(path, None)
+            return True
+        remote = list(isd.gunzip_lines([data]))
+        with open(path, 'rb') as f:
+            local = list(isd.gunzip_lines(isd.read_chunks(f)))
+        if len(remote) >= len(local) and remote[:len(local)] == local:
+            STATS.count('diff_updates')
+            STATS.count('lines_appended', len(remote) - len(local))
+            self.append(stn, yr, remote[len(local):], state)
+            size = state['local']
+        else:
+            # earlier observations changed: replace the entry
+            STATS.count('diff_replacements')
+            fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, path)
+            try:
+                os.remove(index_path(path))
+            except OSError:
+                pass
+            size = len(data)
+        self.save_state(path, dict(source_state(data, remote), local=size))
+        self.evict(keep=path, added=size - before)
+        return True
+
+    def append(self, stn, yr, lines, state):
+        """
+        add 'lines' to the end of the entry as one more gzip member (its mtime becomes now), and
+        to its seek index when they come after everything already in it.  'state' gets the entry's
+        new size.  the entry is written out whole and renamed into place rather than appended to:
+        readers don't take the lock, and must never see a member half written
+        """
+        path = self.entry_path(stn, yr)
+        if lines:
+            with open(path, 'rb') as f:
+                old = f.read()
+            index = SeekIndex.load(path)
+            days = [line[15:23] for line in lines]
+            member = gzip_member('\n'.join(lines) + '\n')
+            fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(old + member)
+            os.rename(tmp, path)
+            if index is not None and days == sorted(days) and days[0] >= state['last'][:8]:
+                index.days.append(days[0])
+                index.offsets.append(len(old))
+                index.size = len(old) + len(member)
+                index.save(path)
+            else:
+                try:
+                    os.remove(index_path(path))
+                except OSError:
+                    pass
+            state['local'] = len(old) + len(member)
+            state['lines'] += len(lines)
+            state['last'] = max([state['last']] + [line[15:27] for line in lines])
+        os.utime(path, None)
+
+    def narrow_read(self, path):
+        """ count a narrow read of the unindexed entry at 'path' -> how many it has had """
+        try:
+            with open(reads_path(path)) as f:
+                n = int(f.read()) + 1
+        except (IOError, ValueError):
+            n = 1
+        # a read lost to a concurrent one only delays the index
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            f.write('%d\n' % n)
+        os.rename(tmp, reads_path(path))
+        return n
+
+    def build_index(self, path):
+        """
+        gzindex.build() the entry at 'path' from its lines, under its lock so nothing is appended
+        to it meanwhile, keeping the entry's size in its state -> SeekIndex, or None
+        """
+        with locked(path):
+            size = os.path.getsize(path)
+            with open(path, 'rb') as f:
+                index = build(path, list(isd.gunzip_lines(isd.read_chunks(f))))
+            state = self.load_state(path)
+            if index is not None and state is not None and state.get('local') == size:
+                state['local'] = index.size
+                self.save_state(path, state)
+        if index is not None:
+            try:
+                os.remove(reads_path(path))
+            except OSError:
+                pass
+            self.evict(keep=path, added=index.size - size)
+        return index
+
+    def entries(self):
+        """
+        [(atime, size, [paths]), ...] for every complete entry in the cache: a station-year's
+        cached file and its stored columns, if any, are one entry
+        """
+        roots = [self.path]
+        if self.store is not None and not os.path.abspath(self.store.path).startswith(os.path.abspath(self.path) + os.sep):
+            roots.append(self.store.path)
+        # {stn}-{yr} -> [atime, size, paths]
+        groups = {}
+        for top in roots:
+            for root, dirs, files in os.walk(top):
+                for fn in files:
+                    if fn.startswith('.tmp-') or not fn.endswith(('.gz', '.col')):
+                        continue
+                    fp = os.path.join(root, fn)
+                    try:
+                        st = os.stat(fp)
+                    except OSError:
+                        continue
+                    entry = groups.setdefault(fn.rsplit('.', 1)[0], [0, 0, []])
+                    entry[0] = max(entry[0], st.st_atime)
+                    entry[1] += st.st_size
+                    entry[2].append(fp)
+        return [tuple(entry) for entry in groups.values()]
+
+    def size(self):
+        return sum(size for atime, size, paths in self.entries())
+
+    def evict(self, keep=None, added=0):
+        """
+        remove least recently used entries (other than 'keep') until the cache fits in max_bytes.
+        added: bytes this process just wrote to the cache (or its store).  the cache is only
+        walked the first time, and when the running total goes over max_bytes
+        """
+        if self.total is not None:
+            self.total += added
+            if self.total <= self.max_bytes:
+                return
+        entries = sorted(self.entries())
+        total = sum(size for atime, size, paths in entries)
+        for atime, size, paths in entries:
+            if total <= self.max_bytes:
+                break
+            if keep in paths:
+                continue
+            removed = False
+            for fp in paths:
+                try:
+                    os.remove(fp)
+                    removed = True
+                except OSError:
+                    continue    # already evicted by another worker
+                for extra in (index_path(fp), state_path(fp), reads_path(fp)):
+                    try:
+                        os.remove(extra)
+                    except OSError:
+                        pass
+            if removed:
+                STATS.count('cache_evictions')
+            total -= size
+        self.total = total
+
+class StationListings(object):
+    """ which station ids have a file on NOAA's site, by year (path=None: memory only) """
+    def __init__(self, path=os.path.join(CACHE_DIR, 'listings'), ttl_secs=LISTING_TTL_SECS,
+                 closed_ttl_secs=CLOSED_LISTING_TTL_SECS):
+        self.path = path
+        self.ttl_secs = ttl_secs
+        self.closed_ttl_secs = closed_ttl_secs
+        self.years = {}
+
+    def listing_path(self, yr):
+        return os.path.join(self.path, '%s.txt' % yr)
+
+    def ids(self, yr):
+        """ frozenset of station ids with data for year 'yr' """
+        yr = int(yr)
+        if yr not in self.years:
+            ids = self.load(yr)
+            if ids is None:
+                print "\nretrieving list of stations for year: %s ... \n" % str(yr)
+                with STATS.timer('listing'):
+                    ids = frozenset(station_ids_for_year(yr))
+                STATS.count('listings_fetched')
+                if ids:
+                    self.save(yr, ids)
+            else:
+                STATS.count('listings_cached')
+            self.years[yr] = ids
+        return self.years[yr]
+
+    def has(self, stn, yr):
+        return stn in self.ids(yr)
+
+    def load(self, yr):
+        """ ids from the on-disk listing, or None if it is missing or stale """
+        if self.path is None:
+            return None
+        fp = self.listing_path(yr)
+        ttl = self.closed_ttl_secs if yr < dt.date.today().year else self.ttl_secs
+        try:
+            if time.time() - os.path.getmtime(fp) > ttl:
+                return None
+            with open(fp) as f:
+                return frozenset(line.strip() for line in f if line.strip())
+        except (OSError, IOError):
+            return None
+
+    def save(self, yr, ids):
+        if self.path is None:
+            return
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                pass
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            f.write("\n".join(sorted(ids)) + "\n")
+        os.rename(tmp, self.listing_path(yr))
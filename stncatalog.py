@@ -0,0 +1,154 @@
+"""
+Precompiled station catalog
+
+NOAA's station history (ISH-HISTORY.TXT) and the field coverage log (stn_flds.txt) are compiled
+into one binary file: a one-line JSON header followed by packed columns, one row per station,
+sorted by USAFID-WBAN id.  Ids, names and states are fixed-width byte fields, coordinates are
+doubles, active dates are date ordinals and the fields each station reports are a bitmask.
+
+Opening the catalog mmaps the file and reads only the id column; the other columns are sliced
+out when first used, and a station's dict (the same shape stn_covg() gives) is only built when
+that station is looked at.  The header records the size and mtime of the text files it was
+compiled from, so the catalog is rebuilt whenever they change.
+
+Like obsstore.py, arrays are written in native byte order: the catalog is a local build
+artifact, not an exchange format.
+"""
+
+import os
+import json
+import mmap
+import array
+import tempfile
+import datetime as dt
+from collections import Mapping
+
+VERSION = 1
+CATALOG_PATH = 'static/stations.cat'
+# byte widths of the fixed-width text columns
+TEXT_WIDTHS = {'ID': 12, 'NAME': 30, 'STATE': 2}
+NUMERIC_COLUMNS = [('LAT', 'd'), ('LON', 'd'), ('SD', 'i'), ('ED', 'i'), ('FLDS', 'I')]
+
+def source_stamps(sources):
+    """ [(path, size, mtime), ...] identifying the current versions of the source files """
+    out = []
+    for path in sources:
+        st = os.stat(path)
+        out.append((path, st.st_size, st.st_mtime))
+    return out
+
+def write_catalog(path, stns, flds, sources):
+    """
+    compile 'stns' ({_id: {'name', 'state', 'lat', 'lon', 'sd', 'ed', 'flds'}} as from stn_covg(),
+    annotated with fields) into a catalog at 'path'.  'flds' orders the bits of the field mask
+    """
+    ids = sorted(stns)
+    bits = {fld: 1 << i for i, fld in enumerate(flds)}
+    def text(val, width):
+        return val.encode('ascii', 'replace')[:width].ljust(width)
+    blocks = [('ID', ''.join(text(_id, TEXT_WIDTHS['ID']) for _id in ids)),
+              ('NAME', ''.join(text(stns[_id]['name'], TEXT_WIDTHS['NAME']) for _id in ids)),
+              ('STATE', ''.join(text(stns[_id]['state'], TEXT_WIDTHS['STATE']) for _id in ids))]
+    values = {'LAT': [stns[_id]['lat'] for _id in ids], 'LON': [stns[_id]['lon'] for _id in ids],
+              'SD': [stns[_id]['sd'].toordinal() for _id in ids], 'ED': [stns[_id]['ed'].toordinal() for _id in ids],
+              'FLDS': [sum(bits[fld] for fld in set(stns[_id]['flds']) if fld in bits) for _id in ids]}
+    for name, typecode in NUMERIC_COLUMNS:
+        blocks.append((name, array.array(typecode, values[name]).tostring()))
+    columns, offset = {}, 0
+    for name, block in blocks:
+        columns[name] = offset
+        offset += len(block)
+    header = json.dumps(dict(version=VERSION, n=len(ids), flds=list(flds), columns=columns,
+                             sources=source_stamps(sources))) + "\n"
+
+    fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path) or '.')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(header)
+        for name, block in blocks:
+            f.write(block)
+    os.rename(tmp, path)
+    return path
+
+class StationCatalog(Mapping):
+    """
+    read-only {_id: station dict} view of a compiled catalog, usable wherever stn_covg()'s dict is
+    """
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'rb')
+        header = self.f.readline()
+        self.meta = json.loads(header)
+        self.start = len(header)
+        self.n = self.meta['n']
+        self.flds = self.meta['flds']
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ) if self.n else None
+        self._columns = {}
+        self._stns = {}
+        width = TEXT_WIDTHS['ID']
+        ids = self.block('ID', width)
+        self.ids = [ids[i * width:(i + 1) * width] for i in xrange(self.n)]
+        self.rows = {_id: i for i, _id in enumerate(self.ids)}
+
+    @classmethod
+    def load(cls, path, sources):
+        """ the catalog at 'path', or None if it is missing or older than the 'sources' files """
+        try:
+            with open(path, 'rb') as f:
+                meta = json.loads(f.readline())
+            stamps = source_stamps(sources)
+        except (IOError, OSError, ValueError):
+            return None
+        if meta.get('version') != VERSION or map(tuple, meta.get('sources', [])) != stamps:
+            return None
+        return cls(path)
+
+    def __reduce__(self):
+        # the mmap can't be pickled (e.g. to Pool workers): reopen the file instead
+        return (StationCatalog, (self.path,))
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.f.close()
+
+    def block(self, name, width):
+        start = self.start + self.meta['columns'][name]
+        return self.mm[start:start + self.n * width] if self.n else ''
+
+    def column(self, name):
+        """ all rows of column 'name', as an array (numeric) or a list of stripped strings (text) """
+        if name not in self._columns:
+            if name in TEXT_WIDTHS:
+                width = TEXT_WIDTHS[name]
+                block = self.block(name, width)
+                self._columns[name] = [block[i * width:(i + 1) * width].rstrip() for i in xrange(self.n)]
+            else:
+                typecode = dict(NUMERIC_COLUMNS)[name]
+                out = array.array(typecode)
+                out.fromstring(self.block(name, out.itemsize))
+                self._columns[name] = out
+        return self._columns[name]
+
+    def coords(self):
+        """ [(_id, lat, lon), ...] for every station, in id order """
+        return zip(self.ids, self.column('LAT'), self.column('LON'))
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, _id):
+        return _id in self.rows
+
+    def __getitem__(self, _id):
+        if _id not in self._stns:
+            i = self.rows[_id]
+            mask = self.column('FLDS')[i]
+            self._stns[_id] = dict(usafid_wban=_id, name=self.column('NAME')[i], state=self.column('STATE')[i],
+                                   lat=self.column('LAT')[i], lon=self.column('LON')[i],
+                                   sd=dt.date.fromordinal(self.column('SD')[i]),
+                                   ed=dt.date.fromordinal(self.column('ED')[i]),
+                                   flds=[fld for j, fld in enumerate(self.flds) if mask & (1 << j)])
+        return self._stns[_id]
@@ -2,6 +2,10 @@
 
 """
 Log which weather fields stations have
+
+./stnflds.py [N]: log the fields of N random unlogged stations, from one sample year, to stn_flds.txt
+./stnflds.py years [N]: scan N random station-years not in the per-year index (fldindex.py) yet,
+                        in parallel across stations and years (all of them if N is omitted)
 """
 
 import os
@@ -12,11 +16,13 @@ import datetime as dt
 import traceback
 from collections import OrderedDict
 from multiprocessing import Pool, cpu_count
-from subprocess import Popen, PIPE
+
+import isd
+from stncache import StationYearCache, StationListings
+from fldindex import FieldCoverage, scan_station_year, FLDS
 
 STN_LOG = "static/stn_flds.txt"
-header = ",".join(['ID','HR','MN','DIR','SPD','GUS','CLG','SKC','L','M','H','VSB','MW1','MW2','MW3','MW4','AW1','AW2','AW3','AW4','W',
-          'TEMP','DEWP','SLP','ALT','STP','MAX','MIN','PCP01','PCP06','PCP24','PCPXX','SD']) + "\n"
+header = ",".join(['ID'] + FLDS) + "\n"
 if not os.path.exists(STN_LOG):
     with open(STN_LOG, 'w') as f:
         f.write(header)
@@ -51,30 +57,10 @@ def log_station((_id, log_stns, us_stns)):
         return ''
     try:
         yr = get_stn_year(_id, us_stns)
-        url = 'ftp://ftp.ncdc.noaa.gov/pub/data/noaa/{0}/{1}-{0}.gz'.format(yr, _id)
         print '\nretrieving stn=%s  yr=%s ... \n' % (_id, str(yr))
-        p1 = Popen(["curl", url], stdout=PIPE)
-        p2 = Popen(["gunzip"], stdin=p1.stdout, stdout=PIPE)
-        p3 = Popen(['java', '-classpath', 'static', 'ishJava'], stdin=p2.stdout, stdout=PIPE)
-        data = p3.communicate()[0].split("\n")[1:-1]
-
-        flds = (
-            ['HR',      [21,23]], ['MN',      [23,25]], ['DIR',     [26,29]], ['SPD',     [30,33]], ['GUS',   [34,37]], 
-            ['CLG',     [38,41]], ['SKC',     [42,45]], ['L',       [46,47]], ['M',       [48,49]], ['H',     [50,51]], 
-            ['VSB',     [52,56]], ['MW1',     [57,59]], ['MW2',     [60,62]], ['MW3',     [63,65]], ['MW4',   [66,68]], 
-            ['AW1',     [69,71]], ['AW2',     [72,74]], ['AW3',     [75,77]], ['AW4',     [78,80]], ['W',     [81,82]], 
-            ['TEMP',    [83,87]], ['DEWP',    [88,92]], ['SLP',     [93,99]], ['ALT',   [100,105]], ['STP', [106,112]], 
-            ['MAX',   [113,116]], ['MIN',   [117,120]], ['PCP01', [121,126]], ['PCP06', [127,132]], 
-            ['PCP24', [133,138]], ['PCPXX', [139,144]], ['SD',    [145,147]], 
-            )
-
-        def get_col(data, fld):
-            return [dataline[fld[1][0]:fld[1][1]] for dataline in data]
-    
-        def fld_test(col):
-            return any(['*' not in x for x in col])
-    
-        line = ",".join([_id] + map(str, [1 if fld_test(get_col(data, fld)) else 0 for fld in flds])) + "\n"
+        seen = scan_station_year(_id, yr, FLDS)
+
+        line = ",".join([_id] + map(str, [1 if fld in seen else 0 for fld in FLDS])) + "\n"
         return line if '1' in "".join(line.split(',')[1:]) else ''
     except:
         traceback.print_exc()
@@ -162,8 +148,41 @@ def main(n):
         with open(STN_LOG, "a") as f:
             f.writelines(log_lines)
     
+def scan_task((_id, yr)):
+    try:
+        return (_id, yr, scan_station_year(_id, yr, FLDS))
+    except:
+        traceback.print_exc()
+        return (_id, yr, None)
+
+def main_years(n=None):
+    """ fill in the per-year field index for n random unscanned station-years (all if n is None) """
+    us_stns = stn_covg()
+    coverage = FieldCoverage()
+    listings = StationListings()
+    # every year each station was active, skipping ones already scanned or with no file on NOAA's site
+    tasks = [(_id, yr) for _id in us_stns for yr in range(us_stns[_id]['sd'].year, min(us_stns[_id]['ed'].year, dt.date.today().year) + 1)
+             if not coverage.has(_id, yr)]
+    tasks = [(_id, yr) for (_id, yr) in tasks if listings.has(_id, yr)]
+    print "\nunscanned station-years:", len(tasks), '\n'
+    random.shuffle(tasks)
+    if n is not None:
+        tasks = tasks[:n]
+
+    nprocs = max(1, cpu_count() - 1)
+    print "scanning in parallel on < %s > processors" % str(nprocs)
+    pool = Pool(processes=nprocs)
+    # record each station-year as soon as it's scanned, so an interrupted run keeps what it did
+    for _id, yr, seen in pool.imap_unordered(scan_task, tasks):
+        if seen is not None:
+            coverage.add(_id, yr, seen)
+    pool.close()
+
 if __name__ == "__main__":
-    if sys.argv[1:]:
+    isd.CACHE = StationYearCache()
+    if sys.argv[1:] and sys.argv[1] == 'years':
+        main_years(int(sys.argv[2]) if sys.argv[2:] else None)
+    elif sys.argv[1:]:
         if re.search("^\d{6}-\d{5}$", sys.argv[1]):
             log_station(re.search("^\d{6}-\d{5}$", sys.argv[1]).group(0))
         else:
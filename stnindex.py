@@ -0,0 +1,153 @@
+"""
+Spatial index over weather station coordinates
+
+Stations are placed on the unit sphere (x, y, z) and stored in a KD-tree, built once from
+stn_covg().  Straight-line (chord) distance on the sphere increases with great circle distance,
+so a best-first walk of the tree yields stations in order of distance from a point without
+computing haversine() against the whole catalog or sorting it.  Filters (active dates, fields,
+NOAA's yearly listing) are applied lazily as candidates come out of the walk.
+
+haversine_many() computes distances from one point to many in bulk, vectorized with numpy
+when it is available.
+"""
+
+import heapq
+from math import radians, cos, sin, asin, sqrt
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# same earth radius as noaahist.haversine()
+EARTH_RADIUS_MILES = 6367 * 0.621371
+LEAF_SIZE = 16
+
+def to_xyz(lat, lon):
+    lat, lon = radians(lat), radians(lon)
+    return (cos(lat) * cos(lon), cos(lat) * sin(lon), sin(lat))
+
+def miles_to_chord(miles):
+    return 2 * sin(min(miles / EARTH_RADIUS_MILES, 3.14159265358979) / 2)
+
+def chord_to_miles(chord):
+    return 2 * asin(min(chord / 2, 1.)) * EARTH_RADIUS_MILES
+
+def haversine_many(lat, lon, lats, lons):
+    """ great circle distances in miles from (lat, lon) to each of (lats[i], lons[i]) """
+    if np is not None:
+        lat1, lon1 = np.radians(lat), np.radians(lon)
+        lat2, lon2 = np.radians(np.asarray(lats, dtype=float)), np.radians(np.asarray(lons, dtype=float))
+        a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        return 2 * np.arcsin(np.sqrt(a)) * EARTH_RADIUS_MILES
+    lat1, lon1 = radians(lat), radians(lon)
+    out = []
+    for lat2, lon2 in zip(lats, lons):
+        lat2, lon2 = radians(lat2), radians(lon2)
+        a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+        out.append(2 * asin(sqrt(a)) * EARTH_RADIUS_MILES)
+    return out
+
+class _Node(object):
+    __slots__ = ('lo', 'hi', 'children', 'items')
+
+    def __init__(self, items):
+        # items: [(xyz, _id), ...]
+        self.lo = tuple(min(p[0][k] for p in items) for k in range(3))
+        self.hi = tuple(max(p[0][k] for p in items) for k in range(3))
+        if len(items) <= LEAF_SIZE:
+            self.items, self.children = items, ()
+        else:
+            # split on the widest axis at the median
+            axis = max(range(3), key=lambda k: self.hi[k] - self.lo[k])
+            items = sorted(items, key=lambda p: p[0][axis])
+            mid = len(items) // 2
+            self.items, self.children = (), (_Node(items[:mid]), _Node(items[mid:]))
+
+    def dist2(self, xyz):
+        """ squared distance from xyz to this node's bounding box """
+        d2 = 0.
+        for k in range(3):
+            if xyz[k] < self.lo[k]:
+                d2 += (self.lo[k] - xyz[k]) ** 2
+            elif xyz[k] > self.hi[k]:
+                d2 += (xyz[k] - self.hi[k]) ** 2
+        return d2
+
+class StationIndex(object):
+    """
+    stns: {_id: {'lat': float, 'lon': float, 'sd': date, 'ed': date, 'flds': [...], ...}} as from stn_covg(),
+          or a stncatalog.StationCatalog
+    """
+    def __init__(self, stns):
+        self.stns = stns
+        # a stncatalog.StationCatalog hands over its coordinate columns without building station dicts
+        coords = stns.coords() if hasattr(stns, 'coords') else [(_id, stns[_id]['lat'], stns[_id]['lon']) for _id in sorted(stns)]
+        items = [(to_xyz(lat, lon), _id) for (_id, lat, lon) in coords]
+        self.root = _Node(items) if items else None
+
+    def iter_nearest(self, lat, lon, filt=None):
+        """
+        yields (miles, _id) for every station passing 'filt' (a function of _id), closest first
+        """
+        if self.root is None:
+            return
+        xyz = to_xyz(lat, lon)
+        # best-first search: nodes are keyed by distance to their bounding box, stations by their
+        # own distance, so a station is yielded only once nothing left can be closer.
+        # ties go to nodes first, then to stations in id order
+        heap = [(self.root.dist2(xyz), 0, 0, self.root)]
+        counter = 1
+        while heap:
+            d2, is_stn, key, node = heapq.heappop(heap)
+            if is_stn:
+                yield (chord_to_miles(sqrt(d2)), key)
+                continue
+            for child in node.children:
+                heapq.heappush(heap, (child.dist2(xyz), 0, counter, child))
+                counter += 1
+            for (p, item_id) in node.items:
+                if filt is None or filt(item_id):
+                    heapq.heappush(heap, ((p[0]-xyz[0])**2 + (p[1]-xyz[1])**2 + (p[2]-xyz[2])**2, 1, item_id, None))
+
+    def nearest(self, lat, lon, k=1, filt=None):
+        """ [(miles, _id), ...] for the k closest stations passing 'filt' """
+        out = []
+        if k <= 0:
+            return out
+        for item in self.iter_nearest(lat, lon, filt):
+            out.append(item)
+            if len(out) == k:
+                break
+        return out
+
+    def within(self, lat, lon, miles, filt=None):
+        """ [(miles, _id), ...] for every station passing 'filt' within 'miles', closest first """
+        out = []
+        for item in self.iter_nearest(lat, lon, filt):
+            if item[0] > miles:
+                break
+            out.append(item)
+        return out
+
+    def active(self, date=None, year=None, fld=None, listed=None):
+        """
+        filter for iter_nearest/nearest/within:
+        date: station active strictly before and after this date
+        year: station active at some point during this year
+        fld: station is known to report this field
+        listed: collection of ids NOAA has a file for (e.g. StationListings.ids(year))
+        """
+        stns = self.stns
+        def filt(_id):
+            stn = stns[_id]
+            if date is not None and not (stn['sd'] < date < stn['ed']):
+                return False
+            if year is not None and not (stn['sd'].year <= year <= stn['ed'].year):
+                return False
+            if fld is not None and fld not in stn['flds']:
+                return False
+            if listed is not None and _id not in listed:
+                return False
+            return True
+        return filt
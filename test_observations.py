@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+"""
+iter_observations() against benchmark.py's synthetic file:// mirror, with more stations in a
+year than the downloader has connections.
+
+    $ python -m unittest test_observations
+"""
+
+import os
+import shutil
+import datetime as dt
+import tempfile
+import threading
+import unittest
+
+import isd
+import benchmark
+from download import Downloader
+from noaahist import load_stations
+from stncache import StationYearCache
+from stnindex import StationIndex
+from observations import iter_observations
+
+STATIONS = 8
+CONNECTIONS = 2
+FALLBACK = 4
+# long enough for the fixtures, short enough that a hang fails the test instead of the run
+TIMEOUT_SECS = 60
+
+class ObservationsTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='noaahist-obs-')
+        fx = benchmark.make_fixtures(self.workdir, n_stations=STATIONS, hours_step=3)
+        self.stns = load_stations(fx['covg_path'], fx['flds_path'], os.path.join(self.workdir, 'stations.cat'))
+        self.index = StationIndex(self.stns)
+        self.saved = isd.NOAA_URL, isd.DOWNLOADER, isd.CACHE, isd.STORE
+        isd.NOAA_URL = 'file://' + fx['mirror']
+        isd.DOWNLOADER = Downloader(isd.NOAA_URL, connections=CONNECTIONS)
+        isd.CACHE, isd.STORE = None, None
+
+    def tearDown(self):
+        isd.NOAA_URL, isd.DOWNLOADER, isd.CACHE, isd.STORE = self.saved
+        shutil.rmtree(self.workdir)
+
+    def observations(self):
+        lat, lon = [sum(r) / 2 for r in (benchmark.LAT_RANGE, benchmark.LON_RANGE)]
+        start, end = dt.date(benchmark.YEAR, 1, 1), dt.date(benchmark.YEAR, 2, 28)
+        return iter_observations(start, end, lat, lon, benchmark.REQ_FLDS, fallback=FALLBACK,
+                                 stns=self.stns, index=self.index)
+
+    def collect(self):
+        """ every record of observations(), read on a thread so a hang fails instead of blocking """
+        out = {}
+        def run():
+            out['rows'] = list(self.observations())
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(TIMEOUT_SECS)
+        self.assertFalse(thread.is_alive(), 'iter_observations() blocked on the downloader')
+        return out['rows']
+
+    def test_more_stations_than_connections(self):
+        years = self.observations().req.station_years()
+        self.assertGreater(len(years), CONNECTIONS)
+        rows = self.collect()
+        self.assertTrue(rows)
+        # the same records as when every station-year is read from the cache first
+        isd.CACHE = StationYearCache(os.path.join(self.workdir, 'cache'))
+        self.assertEqual(self.collect(), rows)
+
+if __name__ == '__main__':
+    unittest.main()
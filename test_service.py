@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""
+service.py on a localhost port, answering queries against benchmark.py's synthetic file://
+mirror: csv and json answers, coalescing of identical queries in flight, repeat queries served
+from HotStationYears, and the 400s for bad queries.
+
+    $ python -m unittest test_service
+"""
+
+import os
+import json
+import shutil
+import httplib
+import tempfile
+import threading
+import unittest
+
+import isd
+import zipgeo
+import service
+import benchmark
+from download import Downloader
+from stats import STATS
+
+STATIONS = 8
+TIMEOUT_SECS = 60
+LAT, LON = [sum(r) / 2 for r in (benchmark.LAT_RANGE, benchmark.LON_RANGE)]
+QUERY = '/query?lat=%s&lon=%s&start=%d0101&end=%d0107&flds=TEMP,SPD' % (LAT, LON, benchmark.YEAR, benchmark.YEAR)
+
+class ServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='noaahist-service-')
+        # the service reads its catalog from static/ under the working directory
+        static = os.path.join(self.workdir, 'static')
+        os.makedirs(static)
+        fx = benchmark.make_fixtures(static, n_stations=STATIONS, hours_step=3)
+        self.cwd = os.getcwd()
+        os.chdir(self.workdir)
+        self.saved = isd.NOAA_URL, isd.DOWNLOADER, isd.CACHE, isd.STORE, zipgeo.ZIPS
+        isd.NOAA_URL = 'file://' + fx['mirror']
+        isd.DOWNLOADER = Downloader(isd.NOAA_URL)
+        isd.CACHE, isd.STORE = None, None
+        STATS.reset()
+        # no request log on the test's stderr
+        self.log_message = service.Handler.log_message
+        service.Handler.log_message = lambda handler, format, *args: None
+        self.service = service.QueryService(service.HotStationYears())
+        self.server = service.make_server(self.service, port=0)
+        self.port = self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        service.Handler.log_message = self.log_message
+        os.chdir(self.cwd)
+        isd.NOAA_URL, isd.DOWNLOADER, isd.CACHE, isd.STORE, zipgeo.ZIPS = self.saved
+        shutil.rmtree(self.workdir)
+
+    def get(self, path):
+        """ GET path -> (status, content type, body) """
+        conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=TIMEOUT_SECS)
+        try:
+            conn.request('GET', path)
+            resp = conn.getresponse()
+            return resp.status, resp.getheader('Content-Type'), resp.read()
+        finally:
+            conn.close()
+
+    def counters(self):
+        return STATS.snapshot()['counters']
+
+    def test_csv_and_json(self):
+        status, ctype, body = self.get(QUERY)
+        self.assertEqual((status, ctype), (200, 'text/csv'))
+        lines = body.splitlines()
+        self.assertEqual(lines[0].split(',')[-2:], ['TEMP', 'SPD'])
+        self.assertTrue(len(lines) > 1)
+        status, ctype, body = self.get(QUERY + '&format=json')
+        self.assertEqual((status, ctype), (200, 'application/json'))
+        answer = json.loads(body)
+        self.assertEqual(answer['columns'], lines[0].split(','))
+        self.assertEqual([','.join(str(v) for v in row) for row in answer['rows']], lines[1:])
+
+    def test_repeat_query_is_a_hot_hit(self):
+        self.assertEqual(self.get(QUERY)[0], 200)
+        misses = self.counters().get('hot_misses', 0)
+        self.assertTrue(misses)
+        self.assertEqual(self.get(QUERY)[0], 200)
+        counters = self.counters()
+        self.assertEqual(counters.get('hot_misses', 0), misses)
+        self.assertTrue(counters.get('hot_hits', 0))
+
+    def test_identical_queries_in_flight_are_coalesced(self):
+        # hold the first query's answer until the second one is waiting on it
+        run, gate = self.service.run, threading.Event()
+        def gated_run(query):
+            gate.wait(TIMEOUT_SECS)
+            return run(query)
+        self.service.run = gated_run
+        answers = []
+        threads = [threading.Thread(target=lambda: answers.append(self.get(QUERY))) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for i in range(int(TIMEOUT_SECS / 0.01)):
+            if self.counters().get('coalesced'):
+                break
+            threading.Event().wait(0.01)
+        gate.set()
+        for thread in threads:
+            thread.join(TIMEOUT_SECS)
+        self.assertEqual(self.counters().get('coalesced'), 1)
+        self.assertEqual(len(answers), 2)
+        self.assertEqual(answers[0], answers[1])
+        self.assertEqual(answers[0][0], 200)
+
+    def test_bad_queries(self):
+        zipgeo.ZIPS = zipgeo.ZipIndex([(89101, 36.17, -115.14)])
+        start = '&start=%d0101' % benchmark.YEAR
+        for path in ['/query?flds=TEMP' + start,
+                     '/query?lat=%s&lon=%s%s' % (LAT, LON, start),
+                     '/query?lat=x&lon=%s&flds=TEMP%s' % (LON, start),
+                     '/query?zip=12345&flds=TEMP' + start,
+                     QUERY.replace('end=%d0107' % benchmark.YEAR, 'end=%d0101' % (benchmark.YEAR - 1)),
+                     QUERY + '&agg=weekly',
+                     QUERY + '&agg=daily&reducers=TEMP=median',
+                     QUERY + '&format=xml']:
+            self.assertEqual(self.get(path)[0], 400, path)
+        self.assertEqual(self.get('/nothing')[0], 404)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+"""
+--shard / --merge end to end: two worker processes split a batch over a shared run and cache
+directory, against benchmark.py's synthetic file:// mirror, and the merged output must equal a
+plain single-process run of the same batch.
+
+    $ python -m unittest test_shard
+"""
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+import benchmark
+
+NOAAHIST = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'noaahist.py')
+STATIONS = 8
+LOCATIONS = 12
+
+class ShardTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='noaahist-shard-')
+        # noaahist.py reads its catalog from static/ under the working directory
+        static = os.path.join(self.workdir, 'static')
+        os.makedirs(static)
+        fx = benchmark.make_fixtures(static, n_stations=STATIONS, hours_step=3)
+        self.mirror = 'file://' + fx['mirror']
+        self.infile = os.path.join(self.workdir, 'reqs.txt')
+        with open(self.infile, 'w') as f:
+            f.write("\n".join(benchmark.infile_lines(random.Random(1), LOCATIONS)) + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def noaahist(self, *args):
+        """ start noaahist.py on the batch -> Popen """
+        cmd = [sys.executable, NOAAHIST, '-i', self.infile, '--mirror', self.mirror, '-m'] + list(args)
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.Popen(cmd, cwd=self.workdir, stdout=devnull, stderr=subprocess.PIPE)
+
+    def check(self, proc):
+        err = proc.communicate()[1]
+        self.assertEqual(proc.returncode, 0, err)
+
+    def output(self, name):
+        with open(os.path.join(self.workdir, name)) as f:
+            out = f.read()
+        with open(os.path.join(self.workdir, name.replace('.csv', '_metadata.txt'))) as f:
+            return out, f.read()
+
+    def test_shards_merge_to_plain_run(self):
+        self.check(self.noaahist('--no-cache', '-o', os.path.join(self.workdir, 'plain.csv')))
+        shard_args = ['--run-dir', os.path.join(self.workdir, 'run'), '--cache-dir', os.path.join(self.workdir, 'cache')]
+        merge = self.noaahist('--merge', '-o', os.path.join(self.workdir, 'merged.csv'), *shard_args)
+        merge.communicate()
+        self.assertNotEqual(merge.returncode, 0, 'merge before any shard ran')
+        workers = [self.noaahist('--shard', '--shard-chunk', '3', *shard_args) for i in range(2)]
+        for proc in workers:
+            self.check(proc)
+        self.assertFalse([fn for fn in os.listdir(os.path.join(self.workdir, 'run', 'leases')) if fn.endswith('.lease')])
+        self.check(self.noaahist('--merge', '-o', os.path.join(self.workdir, 'merged.csv'), *shard_args))
+        self.assertEqual(self.output('merged.csv'), self.output('plain.csv'))
+
+if __name__ == '__main__':
+    unittest.main()
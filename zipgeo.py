@@ -0,0 +1,75 @@
+"""
+Zip code -> latitude, longitude
+
+pyzipcode answers each lookup with its own query against its SQLite database.  ZipIndex reads
+the whole table once (about 43k rows) into three sorted arrays, zip codes as ints and their
+coordinates as doubles, and answers lookups by binary search.  coords_from_zips() looks up a
+whole list at once, each distinct zip code once.
+
+The index is loaded on first use and shared by everything in the process (noaahist.py,
+explore_stations.py, service.py).  Needs pyzipcode < 3 for its database: the table is read
+straight from the SQLite file named by pyzipcode.settings.db_location, which later versions
+don't have.  Anything else raises ImportError, as a missing pyzipcode does.
+"""
+
+import array
+import sqlite3
+from bisect import bisect_left
+
+PYZIPCODE_NEEDED = "zip codes need pyzipcode < 3 (pip install 'pyzipcode<3')"
+
+class ZipIndex(object):
+    def __init__(self, rows):
+        """ rows: [(zip code, lat, lon), ...] in any order """
+        rows = sorted((int(zipcode), lat, lon) for zipcode, lat, lon in rows)
+        self.zips = array.array('i', [row[0] for row in rows])
+        self.lats = array.array('d', [row[1] for row in rows])
+        self.lons = array.array('d', [row[2] for row in rows])
+
+    @classmethod
+    def from_pyzipcode(cls):
+        try:
+            from pyzipcode.settings import db_location
+        except ImportError:
+            raise ImportError("%s: no pyzipcode.settings.db_location" % PYZIPCODE_NEEDED)
+        try:
+            conn = sqlite3.connect(db_location)
+            try:
+                rows = conn.execute("SELECT zip, latitude, longitude FROM ZipCodes").fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            raise ImportError("%s: can't read its ZipCodes table at %s (%s)" % (PYZIPCODE_NEEDED, db_location, e))
+        return cls(rows)
+
+    def __len__(self):
+        return len(self.zips)
+
+    def find(self, zipcode):
+        """ (lat, lon) of 'zipcode' (str or int), or None if it isn't known """
+        z = int(zipcode)
+        i = bisect_left(self.zips, z)
+        if i < len(self.zips) and self.zips[i] == z:
+            return self.lats[i], self.lons[i]
+        return None
+
+ZIPS = None
+
+def zip_index():
+    """ the shared ZipIndex, loaded on first use """
+    global ZIPS
+    if ZIPS is None:
+        ZIPS = ZipIndex.from_pyzipcode()
+    return ZIPS
+
+def coords_from_zip(zipcode):
+    coords = zip_index().find(zipcode)
+    if coords is None:
+        raise KeyError("Couldn't find zipcode: '%s'" % zipcode)
+    return coords
+
+def coords_from_zips(zipcodes):
+    """ [(lat, lon) or None for unknown zip codes, ...] in the order of 'zipcodes' """
+    index = zip_index()
+    found = {z: index.find(z) for z in set(int(z) for z in zipcodes)}
+    return [found[int(z)] for z in zipcodes]